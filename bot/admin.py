@@ -2,7 +2,7 @@ from django.contrib import admin
 from django.utils import timezone
 from django.utils.safestring import mark_safe
 from datetime import timedelta
-from .models import User, Subscription, Task, BotSettings
+from .models import User, Subscription, Task, BotSettings, OcrResult
 
 @admin.register(User)
 class UserAdmin(admin.ModelAdmin):
@@ -96,6 +96,7 @@ class TaskAdmin(admin.ModelAdmin):
     search_fields = ['user__telegram_id', 'user__username', 'description']
     readonly_fields = ['created_at', 'completed_at']
     date_hierarchy = 'created_at'
+    actions = ['resume_processing']
     
     fieldsets = (
         ('Пользователь', {
@@ -105,7 +106,11 @@ class TaskAdmin(admin.ModelAdmin):
             'fields': ('description', 'image')
         }),
         ('Статус', {
-            'fields': ('status', 'solution')
+            'fields': ('status', 'solution', 'error_message')
+        }),
+        ('Этапы обработки', {
+            'fields': ('processed_image', 'ocr_text', 'raw_solution', 'solution_image'),
+            'classes': ('collapse',)
         }),
         ('Временные метки', {
             'fields': ('created_at', 'completed_at'),
@@ -116,6 +121,19 @@ class TaskAdmin(admin.ModelAdmin):
     def description_short(self, obj):
         return obj.description[:100] + '...' if len(obj.description) > 100 else obj.description
     description_short.short_description = 'Описание'
+    
+    def resume_processing(self, request, queryset):
+        """Возобновить обработку упавших, отложенных и зависших задач с первого незавершенного этапа"""
+        from .scheduling import enqueue_task, resumable_tasks
+        count = 0
+        for task in resumable_tasks(queryset).select_related('user'):
+            # Отложенная задача больше не ждет resume_parked_task: иначе он запустил бы ее второй раз
+            Task.objects.filter(id=task.id).update(status='pending')
+            enqueue_task(task)
+            count += 1
+        skipped = queryset.count() - count
+        self.message_user(request, f"Возобновлена обработка задач: {count}, пропущено (завершены или еще выполняются): {skipped}")
+    resume_processing.short_description = "Возобновить обработку"
 
 @admin.register(BotSettings)
 class BotSettingsAdmin(admin.ModelAdmin):
@@ -127,3 +145,14 @@ class BotSettingsAdmin(admin.ModelAdmin):
             'fields': ('key', 'value', 'description')
         }),
     )
+
+
+@admin.register(OcrResult)
+class OcrResultAdmin(admin.ModelAdmin):
+    list_display = ['image_hash', 'text_short', 'hits', 'created_at', 'last_used_at']
+    search_fields = ['image_hash', 'text']
+    readonly_fields = ['image_hash', 'hash_band_0', 'hash_band_1', 'hash_band_2', 'hash_band_3', 'verify_hash', 'width', 'height', 'created_at', 'last_used_at']
+    
+    def text_short(self, obj):
+        return obj.text[:100] + '...' if len(obj.text) > 100 else obj.text
+    text_short.short_description = 'Текст'
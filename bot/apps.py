@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class BotConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'bot'
+
+    def ready(self):
+        # Общий клиент OpenAI создается один раз при старте процесса
+        from .llm import init_client
+        init_client()
@@ -0,0 +1,127 @@
+import logging
+import time
+import uuid
+from django.conf import settings
+from django.core.cache import caches
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Внешние зависимости под предохранителями
+BREAKERS = ('vision', 'completion', 'telegram')
+
+
+class CircuitOpen(Exception):
+    """Зависимость недоступна: предохранитель разомкнут, запрос не отправляется"""
+
+    def __init__(self, name, retry_in):
+        super().__init__(f"Сервис {name} временно недоступен, повтор через {retry_in:.0f} с")
+        self.name = name
+        self.retry_in = retry_in
+
+
+def _cache():
+    # Состояние общее для всех воркеров: кэш лимитера без вытеснения
+    return caches[settings.LLM_RATE_LIMIT_CACHE]
+
+
+def _keys(name):
+    prefix = f'breaker:{name}:'
+    return prefix + 'failures', prefix + 'opened', prefix + 'probe'
+
+
+def allow(name):
+    """Пропустить запрос к зависимости или бросить CircuitOpen; после паузы пропускается одна проба (вернется ее токен)"""
+    if not settings.BREAKER_ENABLED:
+        return None
+    failures_key, opened_key, probe_key = _keys(name)
+    cache = _cache()
+    opened_at = cache.get(opened_key)
+    if opened_at is None:
+        return None
+
+    retry_in = opened_at + settings.BREAKER_RESET_TIMEOUT - time.time()
+    if retry_in > 0:
+        metrics.incr(f'breaker.{name}.rejected')
+        raise CircuitOpen(name, retry_in)
+    # Полуоткрытое состояние: одна проба на кластер, остальные ждут ее результата
+    token = uuid.uuid4().hex
+    if not cache.add(probe_key, token, timeout=settings.BREAKER_PROBE_TIMEOUT):
+        metrics.incr(f'breaker.{name}.rejected')
+        raise CircuitOpen(name, settings.BREAKER_PROBE_TIMEOUT)
+    logger.info(f"Предохранитель {name}: пробный запрос")
+    return token
+
+
+def release_probe(name, token):
+    """Завершить пробу любым исходом: после 429 или ошибки запроса следующий запрос станет новой пробой"""
+    if token is None:
+        return
+    probe_key = _keys(name)[2]
+    cache = _cache()
+    # Ключ могла уже снять record_success/record_failure, а после новой паузы взять другая проба
+    if cache.get(probe_key) == token:
+        cache.delete(probe_key)
+
+
+def record_success(name):
+    """Успешный ответ: сбросить счетчик сбоев и замкнуть предохранитель"""
+    if not settings.BREAKER_ENABLED:
+        return
+    failures_key, opened_key, probe_key = _keys(name)
+    cache = _cache()
+    state = cache.get_many([failures_key, opened_key])
+    if not state:
+        return
+    cache.delete_many([failures_key, opened_key, probe_key])
+    if opened_key in state:
+        logger.info(f"Предохранитель {name} замкнут: сервис снова отвечает")
+
+
+def record_failure(name):
+    """Сбой зависимости: после BREAKER_FAILURE_THRESHOLD сбоев подряд или неудачной пробы — разомкнуть"""
+    if not settings.BREAKER_ENABLED:
+        return
+    failures_key, opened_key, probe_key = _keys(name)
+    cache = _cache()
+    cache.add(failures_key, 0, timeout=None)
+    failures = cache.incr(failures_key)
+    half_open = cache.get(opened_key) is not None
+    if failures >= settings.BREAKER_FAILURE_THRESHOLD or half_open:
+        cache.set(opened_key, time.time(), timeout=None)
+        cache.delete(probe_key)
+        metrics.incr(f'breaker.{name}.opened')
+        logger.warning(f"Предохранитель {name} разомкнут после {failures} сбоев подряд")
+
+
+def state(name):
+    """Состояние предохранителя: closed, open или half_open"""
+    failures_key, opened_key, _ = _keys(name)
+    values = _cache().get_many([failures_key, opened_key])
+    opened_at = values.get(opened_key)
+    if opened_at is None:
+        status, retry_in = 'closed', 0
+    else:
+        retry_in = max(0.0, opened_at + settings.BREAKER_RESET_TIMEOUT - time.time())
+        status = 'open' if retry_in > 0 else 'half_open'
+    return {'state': status, 'failures': int(values.get(failures_key, 0)), 'retry_in': round(retry_in, 1)}
+
+
+def is_available(name):
+    """Можно ли сейчас обращаться к зависимости (замкнут или готов к пробе)"""
+    return not settings.BREAKER_ENABLED or state(name)['state'] != 'open'
+
+
+def breaker_stats():
+    """Состояние и счетчики всех предохранителей"""
+    counters = metrics.get_counters(
+        [f'breaker.{name}.{event}' for name in BREAKERS for event in ('opened', 'rejected')]
+    )
+    return {
+        name: dict(
+            state(name),
+            opened=counters[f'breaker.{name}.opened'],
+            rejected=counters[f'breaker.{name}.rejected'],
+        )
+        for name in BREAKERS
+    }
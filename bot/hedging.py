@@ -0,0 +1,185 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from django.conf import settings
+from . import metrics
+from .llm import chat_completion
+
+logger = logging.getLogger(__name__)
+
+# Окно задержек первого токена по моделям и бюджет хеджей — на процесс, общие для потоков воркера
+_lock = threading.Lock()
+_first_token = {}
+_budget = None
+
+
+def record_first_token(model, seconds):
+    """Запомнить задержку первого токена модели в скользящем окне"""
+    with _lock:
+        window = _first_token.setdefault(model, deque(maxlen=settings.LLM_HEDGE_WINDOW))
+        window.append(seconds)
+    metrics.observe('llm.first_token', seconds)
+
+
+def hedge_delay(model):
+    """Через сколько секунд без первого токена отправлять хедж: скользящий p90; None — замеров мало, без хеджа"""
+    with _lock:
+        samples = sorted(_first_token.get(model, ()))
+    if len(samples) < settings.LLM_HEDGE_MIN_SAMPLES:
+        # По нескольким замерам p90 случаен: хедж по нему только удваивает запросы, не сокращая хвост
+        return None
+    index = min(len(samples) - 1, int(settings.LLM_HEDGE_PERCENTILE * len(samples)))
+    return max(settings.LLM_HEDGE_MIN_DELAY, samples[index])
+
+
+def _earn_budget():
+    """Каждый запрос добавляет LLM_HEDGE_MAX_RATIO хеджа в бюджет (не больше LLM_HEDGE_BURST)"""
+    global _budget
+    with _lock:
+        # Бюджет нового процесса полный, иначе первые медленные запросы после старта не хеджируются
+        current = settings.LLM_HEDGE_BURST if _budget is None else _budget
+        _budget = min(settings.LLM_HEDGE_BURST, current + settings.LLM_HEDGE_MAX_RATIO)
+
+
+def _spend_budget():
+    """Взять один хедж из бюджета; False — доля хеджей уже на пределе"""
+    global _budget
+    with _lock:
+        if _budget < 1:
+            return False
+        _budget -= 1
+        return True
+
+
+class Attempt:
+    """Один из параллельных запросов: открывает поток и ждет первый чанк в отдельном потоке"""
+
+    def __init__(self, request, results, hedge=False):
+        self.request = request
+        self.results = results
+        self.hedge = hedge
+        self.stream = None
+        self.chunks = None
+        self.cancelled = threading.Event()
+        self.started = time.monotonic()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        try:
+            self.stream = chat_completion(stream=True, **self.request)
+            if self.cancelled.is_set():
+                self.stream.close()
+                return
+            self.chunks = iter(self.stream)
+            first = []
+            for chunk in self.chunks:
+                first.append(chunk)
+                if chunk.choices and (chunk.choices[0].delta.content or chunk.choices[0].finish_reason):
+                    break
+            self.results.put((self, first, None))
+        except Exception as exc:
+            self.results.put((self, None, exc))
+
+    def cancel(self):
+        """Отменить запрос: закрытое соединение останавливает генерацию на стороне API"""
+        self.cancelled.set()
+        if self.stream is not None:
+            try:
+                self.stream.close()
+            except Exception as e:
+                logger.debug(f"Ошибка при отмене хедж-запроса: {e}")
+
+
+def stream_completion(**request):
+    """Потоковый запрос к chat completions; с LLM_HEDGING_ENABLED — с хеджированием по первому токену"""
+    if not settings.LLM_HEDGING_ENABLED:
+        return _timed_stream(request['model'], chat_completion(stream=True, **request))
+    return _hedged_stream(request)
+
+
+def _timed_stream(model, stream):
+    """Поток без хеджа, но с замером первого токена для окна задержек"""
+    started = time.monotonic()
+    first = True
+    for chunk in stream:
+        if first:
+            record_first_token(model, time.monotonic() - started)
+            first = False
+        yield chunk
+
+
+def _hedged_stream(request):
+    """Если за скользящий p90 нет первого токена, отправить второй запрос и взять тот, что ответит раньше"""
+    _earn_budget()
+    metrics.incr('llm.hedge.requests')
+    results = queue.Queue()
+    attempts = [Attempt(request, results)]
+    pending = 1
+    error = None
+    winner = None
+
+    try:
+        delay = hedge_delay(request['model'])
+        if delay is None:
+            metrics.incr('llm.hedge.warming_up')
+        while winner is None and pending:
+            timeout = delay if len(attempts) == 1 else None
+            try:
+                attempt, first, exc = results.get(timeout=timeout)
+            except queue.Empty:
+                # Основной запрос молчит дольше обычного: пробуем второй, если позволяет бюджет
+                delay = None
+                if _spend_budget():
+                    hedge_request = dict(request, model=settings.LLM_HEDGE_MODEL or request['model'])
+                    attempts.append(Attempt(hedge_request, results, hedge=True))
+                    pending += 1
+                    metrics.incr('llm.hedge.fired')
+                    logger.info(f"Нет первого токена за {timeout:.1f} с, отправлен хедж-запрос")
+                else:
+                    metrics.incr('llm.hedge.over_budget')
+                continue
+
+            pending -= 1
+            if exc is not None:
+                error = exc
+                logger.warning(f"{'Хедж' if attempt.hedge else 'Основной'} запрос завершился ошибкой: {exc}")
+                continue
+            winner = attempt
+            winner.first = first
+    finally:
+        # Проигравший запрос отменяем, чтобы не тратить токены и слот лимитера
+        for attempt in attempts:
+            if attempt is not winner:
+                attempt.cancel()
+
+    if winner is None:
+        raise error
+    if winner.hedge:
+        metrics.incr('llm.hedge.won')
+    record_first_token(winner.request['model'], time.monotonic() - winner.started)
+    try:
+        yield from winner.first
+        yield from winner.chunks
+    finally:
+        # Вызывающий мог бросить поток на середине: слот лимитера освобождается сразу
+        winner.chunks.close()
+
+
+def hedging_stats():
+    """Доля хеджированных запросов, выигрыши хеджа и задержка первого токена"""
+    counters = metrics.get_counters(
+        ['llm.hedge.requests', 'llm.hedge.fired', 'llm.hedge.won', 'llm.hedge.over_budget', 'llm.hedge.warming_up']
+    )
+    requests = counters['llm.hedge.requests']
+    return {
+        'enabled': settings.LLM_HEDGING_ENABLED,
+        'requests': requests,
+        'fired': counters['llm.hedge.fired'],
+        'won': counters['llm.hedge.won'],
+        'over_budget': counters['llm.hedge.over_budget'],
+        'warming_up': counters['llm.hedge.warming_up'],
+        'hedge_ratio': round(counters['llm.hedge.fired'] / requests, 3) if requests else 0.0,
+        'first_token': metrics.histogram('llm.first_token'),
+    }
@@ -0,0 +1,124 @@
+import hashlib
+import logging
+import os
+import threading
+from django.conf import settings
+from . import metrics
+from .rendering import IMAGE_FORMATS, render_solution_image
+
+logger = logging.getLogger(__name__)
+
+# Сохраненных изображений с последнего вытеснения в этом процессе
+_writes = 0
+_writes_lock = threading.Lock()
+
+
+def image_key(solution):
+    """Ключ изображения: хэш текста решения и версии оформления (он же ETag)"""
+    digest = hashlib.sha256(f'{settings.SOLUTION_IMAGE_VERSION}:{solution}'.encode('utf-8')).hexdigest()
+    return digest[:32]
+
+
+def _path(key, variant, image_format):
+    return os.path.join(settings.SOLUTION_IMAGE_CACHE_DIR, f'{key}-{variant}.{image_format}')
+
+
+def get_solution_image(solution, variant='full', image_format='png'):
+    """Изображение решения из дискового кэша; при промахе рисуется и сохраняется, кэш периодически подрезается до лимита"""
+    path = _path(image_key(solution), variant, image_format)
+    try:
+        with open(path, 'rb') as file:
+            image = file.read()
+        # mtime — время последнего запроса: по нему вытесняются давно не нужные изображения
+        os.utime(path)
+        metrics.incr('solution_image.hits')
+        return image
+    except FileNotFoundError:
+        pass
+
+    metrics.incr('solution_image.misses')
+    image = render_solution_image(solution, variant, image_format)
+    try:
+        store_image(path, image)
+        if _evict_due():
+            evict()
+    except OSError as e:
+        # Без диска изображение все равно отдается, просто нарисуется заново в следующий раз
+        logger.warning(f"Не удалось сохранить изображение решения в кэш: {e}")
+    return image
+
+
+def store_image(path, image):
+    """Атомарная запись: параллельный запрос того же решения не прочитает недописанный файл"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(image)
+    os.replace(temporary, path)
+
+
+def _evict_due():
+    """Пора ли вытеснять: раз в SOLUTION_IMAGE_EVICT_EVERY сохраненных изображений"""
+    global _writes
+    with _writes_lock:
+        _writes += 1
+        if _writes < settings.SOLUTION_IMAGE_EVICT_EVERY:
+            return False
+        _writes = 0
+        return True
+
+
+def _entries():
+    """Файлы кэша: (mtime, размер, путь)"""
+    entries = []
+    try:
+        with os.scandir(settings.SOLUTION_IMAGE_CACHE_DIR) as scan:
+            for entry in scan:
+                # Недописанные .tmp соседних запросов не считаются
+                if entry.name.rpartition('.')[2] not in IMAGE_FORMATS:
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue  # удален соседним процессом
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+def evict():
+    """Удалить давно не запрошенные изображения, пока кэш больше SOLUTION_IMAGE_CACHE_MAX_BYTES"""
+    entries = _entries()
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    for _, size, path in sorted(entries):
+        if total <= settings.SOLUTION_IMAGE_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        total -= size
+    if removed:
+        metrics.incr('solution_image.evicted', removed)
+        logger.info(f"Из кэша изображений решений вытеснено файлов: {removed}")
+    return removed
+
+
+def image_cache_stats():
+    """Попадания, промахи и вытеснения дискового кэша изображений, его текущий размер"""
+    counters = metrics.get_counters(['solution_image.hits', 'solution_image.misses', 'solution_image.evicted'])
+    hits = counters['solution_image.hits']
+    misses = counters['solution_image.misses']
+    entries = _entries()
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': metrics.hit_rate(hits, misses),
+        'evicted': counters['solution_image.evicted'],
+        'files': len(entries),
+        'bytes': sum(size for _, size, _ in entries),
+        'max_bytes': settings.SOLUTION_IMAGE_CACHE_MAX_BYTES,
+    }
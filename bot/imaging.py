@@ -0,0 +1,510 @@
+import io
+import logging
+import time
+import cv2
+import numpy as np
+from PIL import Image, ImageOps
+from django.conf import settings
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Анализ высоты строк делаем на уменьшенной копии: точности хватает, а времени — миллисекунды
+ANALYSIS_LONG_SIDE = 1600
+
+# Флаги OpenCV для декодирования JPEG сразу в уменьшенном масштабе
+REDUCED_GRAYSCALE = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+VISION_FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg', cv2.IMWRITE_JPEG_QUALITY),
+    'webp': ('.webp', 'image/webp', cv2.IMWRITE_WEBP_QUALITY),
+}
+
+
+def _shrink(gray, long_side):
+    """Уменьшенная копия для анализа и коэффициент уменьшения"""
+    ratio = min(1.0, long_side / max(gray.shape[:2]))
+    if ratio == 1.0:
+        return gray, ratio
+    return cv2.resize(gray, None, fx=ratio, fy=ratio, interpolation=cv2.INTER_AREA), ratio
+
+
+def _text_mask(gray):
+    """Пиксели заметно темнее своей окрестности (текст и линии) — белым на черном"""
+    return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 31, 15)
+
+
+def read_image_header(image_bytes):
+    """Формат и размеры изображения по заголовку, без декодирования пикселей"""
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as image:
+            return image.format, image.size
+    except Image.DecompressionBombError:
+        # Pillow не открывает больше 2 * MAX_IMAGE_PIXELS (~179 Мп): повтор задачи тут не поможет
+        raise image_too_large(f'больше {2 * Image.MAX_IMAGE_PIXELS} пикселей')
+    except OSError as e:
+        raise ValueError(f"Не удалось прочитать изображение: {e}")
+
+
+def image_too_large(size):
+    """Отказ без повторов: то же фото снова не поместится в бюджет, нужен снимок поменьше"""
+    logger.info(f"Изображение {size} превышает бюджет пикселей")
+    metrics.incr('quality_gate.rejected.too_large')
+    return ImageQualityError('too_large', RETAKE_MESSAGES['too_large'])
+
+
+def decode_factor(width, height, image_format):
+    """Во сколько раз уменьшить изображение при декодировании (1, 2, 4 или 8)"""
+    long_side = max(width, height)
+    pixels = width * height
+    # Уменьшенное декодирование дешево только для JPEG (масштабирование в DCT);
+    # остальные форматы сначала декодируются целиком, поэтому для них свой предел
+    if image_format == 'JPEG':
+        max_source_pixels = settings.PREPROCESS_MAX_SOURCE_PIXELS
+    else:
+        max_source_pixels = settings.PREPROCESS_MAX_FULL_DECODE_PIXELS
+    if pixels > max_source_pixels:
+        raise image_too_large(f'{width}x{height}')
+
+    factor = 1
+    # Не декодируем больше, чем уйдет в Vision, но и не меньше этого размера
+    while factor < 8 and long_side / (factor * 2) >= settings.VISION_MAX_LONG_SIDE:
+        factor *= 2
+    # Бюджет пикселей важнее качества: лучше уменьшить сильнее, чем упасть по памяти
+    while factor < 8 and pixels / factor ** 2 > settings.PREPROCESS_MAX_PIXELS:
+        factor *= 2
+    if pixels / factor ** 2 > settings.PREPROCESS_MAX_PIXELS:
+        raise image_too_large(f'{width}x{height}')
+    return factor
+
+
+def _decode_reduced(image_bytes, factor):
+    """Декодировать не-JPEG через Pillow: сразу в оттенки серого, затем уменьшить в factor раз"""
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as source:
+            # Полноразмерная копия в 'L' занимает байт на пиксель; поворот по EXIF — как у OpenCV
+            gray = ImageOps.exif_transpose(source.convert('L'))
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f"Не удалось загрузить изображение: {e}")
+    if factor > 1:
+        gray = gray.reduce(factor)
+    return np.array(gray)
+
+
+def decode_image(image_bytes):
+    """Декодировать файл изображения сразу в оттенки серого и в нужном масштабе"""
+    image_format, (width, height) = read_image_header(image_bytes)
+    factor = decode_factor(width, height, image_format)
+
+    if image_format == 'JPEG':
+        image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), REDUCED_GRAYSCALE[factor])
+    else:
+        image = _decode_reduced(image_bytes, factor)
+    if image is None:
+        raise ValueError("Не удалось загрузить изображение")
+    if factor > 1:
+        logger.info(f"Изображение {width}x{height} декодировано в 1/{factor}: {image.shape[1]}x{image.shape[0]}")
+    return image
+
+
+# Окно поиска NLM: 11 вместо 21 по умолчанию в 2,3 раза быстрее, для штрихов текста этого окна хватает
+NLM_SEARCH_WINDOW = 11
+
+
+def _clahe(gray):
+    """Выравнивание контраста по локальным гистограммам"""
+    return cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(gray)
+
+
+def preprocess_none(gray):
+    """Профиль none: изображение как есть"""
+    return gray
+
+
+def preprocess_fast(gray):
+    """Профиль fast: CLAHE и медианный фильтр 3x3 (десятки миллисекунд)"""
+    return cv2.medianBlur(_clahe(gray), 3)
+
+
+def preprocess_quality(gray):
+    """Профиль quality: CLAHE и шумоподавление NLM в разрешении для Vision (около 2 с на фото 12 Мп)"""
+    # Время NLM растет с числом пикселей: полный кадр 12 Мп занимал около 15 с, хотя
+    # encode_for_vision все равно уменьшит его до vision_scale
+    scale = vision_scale(gray)
+    if scale < 1.0:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return cv2.fastNlMeansDenoising(_clahe(gray), templateWindowSize=7, searchWindowSize=NLM_SEARCH_WINDOW)
+
+
+PREPROCESS_PROFILES = {
+    'none': preprocess_none,
+    'fast': preprocess_fast,
+    'quality': preprocess_quality,
+}
+
+
+def preprocess(gray, profile=None):
+    """Предобработка по профилю из настроек PREPROCESS_PROFILE"""
+    profile = profile or settings.PREPROCESS_PROFILE
+    if profile not in PREPROCESS_PROFILES:
+        raise ValueError(f"Неизвестный профиль предобработки {profile}")
+    return PREPROCESS_PROFILES[profile](gray)
+
+
+class ImageQualityError(ValueError):
+    """Фото непригодно для распознавания: нужно переснять"""
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+# Понятные пользователю причины отказа с подсказкой, как переснять
+RETAKE_MESSAGES = {
+    'blurry': 'Фото размыто. Переснимите, держа телефон неподвижно и дождавшись фокусировки.',
+    'dark': 'Фото слишком темное. Переснимите при хорошем освещении.',
+    'low_contrast': 'Фото засвечено или бледное. Уберите блики и переснимите при ровном свете.',
+    'no_text': 'На фото не найден текст. Сфотографируйте задачу крупнее, чтобы она занимала весь кадр.',
+    'too_large': 'Фото слишком большое. Отправьте обычный снимок камеры или скриншот с задачей.',
+}
+
+# Метрики качества считаются на уменьшенной копии: пороги не зависят от разрешения фото
+QUALITY_LONG_SIDE = 1000
+
+
+def measure_quality(gray):
+    """Резкость, экспозиция и плотность текста изображения в оттенках серого"""
+    small, _ = _shrink(gray, QUALITY_LONG_SIDE)
+
+    # Дисперсия лапласиана: у размытого фото мало резких перепадов яркости
+    sharpness = cv2.Laplacian(small, cv2.CV_64F).var()
+
+    # Экспозиция по гистограмме: яркость фона (95-й перцентиль) и размах от самых темных пикселей
+    # до самых светлых; текста на фото бывает меньше процента, поэтому крайние перцентили берутся узкими
+    cumulative = np.cumsum(np.bincount(small.ravel(), minlength=256)) / small.size
+    dark_level, background_level, bright_level = (int(level) for level in np.searchsorted(cumulative, [0.002, 0.95, 0.998]))
+
+    # Плотность текста: доля пикселей заметно темнее окрестности; у пустого листа она почти нулевая,
+    # а у размытого текста сохраняется, поэтому не путается с резкостью
+    foreground = _text_mask(small)
+    text_density = np.count_nonzero(foreground) / foreground.size
+
+    return {
+        'sharpness': float(sharpness),
+        'brightness': background_level,
+        'contrast': bright_level - dark_level,
+        'text_density': float(text_density),
+    }
+
+
+def check_quality(gray):
+    """Проверить, можно ли распознать фото; иначе ImageQualityError с подсказкой"""
+    started = time.monotonic()
+    quality = measure_quality(gray)
+    metrics.observe('quality_gate.latency', time.monotonic() - started)
+    if quality['brightness'] < settings.IMAGE_MIN_BRIGHTNESS:
+        reason = 'dark'
+    elif quality['text_density'] < settings.IMAGE_MIN_TEXT_DENSITY:
+        reason = 'no_text'
+    elif quality['contrast'] < settings.IMAGE_MIN_CONTRAST:
+        reason = 'low_contrast'
+    elif quality['sharpness'] < settings.IMAGE_MIN_SHARPNESS:
+        reason = 'blurry'
+    else:
+        metrics.incr('quality_gate.passed')
+        return quality
+
+    metrics.incr(f'quality_gate.rejected.{reason}')
+    logger.info(f"Фото отклонено ({reason}): {quality}")
+    raise ImageQualityError(reason, RETAKE_MESSAGES[reason])
+
+
+def estimate_text_height(gray):
+    """Медианная высота символов в пикселях исходного изображения или None"""
+    small, ratio = _shrink(gray, ANALYSIS_LONG_SIDE)
+
+    # Темный текст на светлом фоне -> белые компоненты на черном
+    _, binary = cv2.threshold(small, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    heights = stats[1:, cv2.CC_STAT_HEIGHT]
+    widths = stats[1:, cv2.CC_STAT_WIDTH]
+    areas = stats[1:, cv2.CC_STAT_AREA]
+
+    # Отбрасываем шум, линии разметки и крупные пятна — остаются похожие на символы компоненты
+    glyphs = (heights >= 4) & (heights <= small.shape[0] / 8) & (widths <= heights * 4) & (areas >= 8)
+    if np.count_nonzero(glyphs) < 10:
+        return None
+    return float(np.median(heights[glyphs])) / ratio
+
+
+# Контур документа ищем на копии 800 px: края листа крупные, мелкие детали только мешают
+DOCUMENT_LONG_SIDE = 800
+# Лист должен занимать не меньше четверти кадра, иначе это скорее рисунок или таблица на странице
+DOCUMENT_MIN_AREA = 0.25
+# Лист почти во весь кадр выпрямлять незачем
+DOCUMENT_MAX_AREA = 0.95
+
+
+def _order_corners(corners):
+    """Углы в порядке: левый верхний, правый верхний, правый нижний, левый нижний"""
+    sums = corners.sum(axis=1)
+    diffs = np.diff(corners, axis=1).ravel()
+    return np.array([
+        corners[np.argmin(sums)],
+        corners[np.argmin(diffs)],
+        corners[np.argmax(sums)],
+        corners[np.argmax(diffs)],
+    ], dtype=np.float32)
+
+
+def find_document(gray):
+    """Четыре угла листа в кадре или None"""
+    small, ratio = _shrink(gray, DOCUMENT_LONG_SIDE)
+    edges = cv2.Canny(cv2.GaussianBlur(small, (5, 5), 0), 50, 150)
+    edges = cv2.dilate(edges, np.ones((3, 3), np.uint8))
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    frame_area = small.shape[0] * small.shape[1]
+    for contour in sorted(contours, key=cv2.contourArea, reverse=True)[:5]:
+        area = cv2.contourArea(contour)
+        if area < frame_area * DOCUMENT_MIN_AREA:
+            break
+        approx = cv2.approxPolyDP(contour, 0.02 * cv2.arcLength(contour, True), True)
+        if len(approx) == 4 and cv2.isContourConvex(approx) and area < frame_area * DOCUMENT_MAX_AREA:
+            return _order_corners(approx.reshape(4, 2).astype(np.float32) / ratio)
+    return None
+
+
+def warp_document(gray, corners):
+    """Перспективная коррекция: лист по углам в прямоугольник"""
+    top_left, top_right, bottom_right, bottom_left = corners
+    width = int(max(np.linalg.norm(top_right - top_left), np.linalg.norm(bottom_right - bottom_left)))
+    height = int(max(np.linalg.norm(bottom_left - top_left), np.linalg.norm(bottom_right - top_right)))
+    target = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype=np.float32)
+    matrix = cv2.getPerspectiveTransform(corners, target)
+    return cv2.warpPerspective(gray, matrix, (width, height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+def estimate_skew(gray, text_height=None):
+    """Угол наклона строк в градусах (по часовой стрелке) или 0"""
+    text_height = text_height or estimate_text_height(gray)
+    if not text_height:
+        return 0.0
+    small, ratio = _shrink(gray, ANALYSIS_LONG_SIDE)
+    text_height *= ratio
+
+    # Склеиваем символы в строки и оцениваем направление каждой строки прямой
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(3, int(text_height * 2)), 1))
+    lines = cv2.morphologyEx(_text_mask(small), cv2.MORPH_CLOSE, kernel)
+    contours, _ = cv2.findContours(lines, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+
+    angles, weights = [], []
+    for contour in contours:
+        x, y, width, height = cv2.boundingRect(contour)
+        if width < text_height * 8:
+            continue
+        vx, vy, _, _ = cv2.fitLine(contour, cv2.DIST_L2, 0, 0.01, 0.01).ravel()
+        angle = np.degrees(np.arctan2(vy, vx))
+        # Направление прямой определено с точностью до 180 градусов
+        if angle > 90:
+            angle -= 180
+        elif angle < -90:
+            angle += 180
+        angles.append(angle)
+        weights.append(width)
+    if len(angles) < 3:
+        return 0.0
+
+    # Взвешенная медиана устойчива к формулам и рисункам, вытянутым под углом
+    order = np.argsort(angles)
+    cumulative = np.cumsum(np.array(weights)[order])
+    angle = float(np.array(angles)[order][np.searchsorted(cumulative, cumulative[-1] / 2)])
+    return angle if abs(angle) <= settings.PREPROCESS_MAX_SKEW else 0.0
+
+
+def rotate(gray, angle):
+    """Повернуть изображение, расширив холст, чтобы не обрезать углы"""
+    height, width = gray.shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    cos, sin = abs(matrix[0, 0]), abs(matrix[0, 1])
+    new_width = int(height * sin + width * cos)
+    new_height = int(height * cos + width * sin)
+    matrix[0, 2] += new_width / 2 - width / 2
+    matrix[1, 2] += new_height / 2 - height / 2
+    return cv2.warpAffine(gray, matrix, (new_width, new_height), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+
+def find_text_blocks(gray, text_height=None):
+    """Прямоугольники текстовых блоков (x, y, ширина, высота) в порядке чтения"""
+    text_height = text_height or estimate_text_height(gray)
+    if not text_height:
+        return []
+    small, ratio = _shrink(gray, ANALYSIS_LONG_SIDE)
+    text_height *= ratio
+
+    # Расширяем текст так, чтобы слова и соседние строки слились, а отступы между упражнениями — нет
+    kernel = cv2.getStructuringElement(
+        cv2.MORPH_RECT, (int(text_height * 3) | 1, int(text_height * 1.5) | 1)
+    )
+    mask = _text_mask(small)
+    # Края листа после выпрямления проходят по границе кадра и склеили бы всю страницу в один блок
+    margin = max(1, int(text_height))
+    mask[:margin, :] = mask[-margin:, :] = 0
+    mask[:, :margin] = mask[:, -margin:] = 0
+    merged = cv2.dilate(mask, kernel)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(merged, connectivity=8)
+
+    blocks = []
+    for x, y, width, height, _ in stats[1:]:
+        if width * height < (text_height * 4) ** 2:
+            continue
+        blocks.append(tuple(int(value / ratio) for value in (x, y, width, height)))
+    # Порядок чтения: сверху вниз, затем слева направо
+    return sorted(blocks, key=lambda block: (block[1], block[0]))
+
+
+def union_blocks(blocks):
+    """Прямоугольник, охватывающий все блоки текста"""
+    left = min(x for x, _, _, _ in blocks)
+    top = min(y for _, y, _, _ in blocks)
+    right = max(x + width for x, _, width, _ in blocks)
+    bottom = max(y + height for _, y, _, height in blocks)
+    return left, top, right - left, bottom - top
+
+
+def select_problem_block(gray, blocks):
+    """Блок в центре кадра или ближайший к нему (режим PREPROCESS_CROP_MODE = 'center')"""
+    center_x, center_y = gray.shape[1] / 2, gray.shape[0] / 2
+
+    def distance(block):
+        x, y, width, height = block
+        dx = max(x - center_x, 0, center_x - (x + width))
+        dy = max(y - center_y, 0, center_y - (y + height))
+        return (dx ** 2 + dy ** 2) ** 0.5, -width * height
+
+    return min(blocks, key=distance)
+
+
+def crop_block(gray, block, padding):
+    """Вырезать блок с полями"""
+    x, y, width, height = block
+    top, left = max(0, y - padding), max(0, x - padding)
+    bottom, right = min(gray.shape[0], y + height + padding), min(gray.shape[1], x + width + padding)
+    return gray[top:bottom, left:right]
+
+
+def extract_problem_region(gray):
+    """Выпрямить лист и обрезать поля вокруг текста: (изображение, изменено ли)"""
+    # Весь анализ идет на одной уменьшенной копии, которая трансформируется вместе с оригиналом
+    small, ratio = _shrink(gray, ANALYSIS_LONG_SIDE)
+    changed = False
+
+    corners = find_document(small)
+    if corners is not None:
+        gray = warp_document(gray, corners / ratio)
+        small = warp_document(small, corners)
+        metrics.incr('layout.document')
+        changed = True
+
+    text_height = estimate_text_height(small)
+    angle = estimate_skew(small, text_height)
+    if abs(angle) >= 0.5:
+        gray = rotate(gray, angle)
+        small = rotate(small, angle)
+        metrics.incr('layout.deskewed')
+        changed = True
+
+    # Вырезаем только со снимка целой страницы (мелкий относительно кадра текст): на снимке крупным планом
+    # все, что в кадре, и есть задача, а отдельные блоки — ее части или соседние задачи
+    blocks = []
+    if text_height and text_height <= small.shape[0] * settings.PREPROCESS_PAGE_MAX_TEXT_HEIGHT:
+        blocks = find_text_blocks(small, text_height)
+    if blocks:
+        # По умолчанию остаются все блоки: на странице может быть несколько нужных задач.
+        # Один блок у центра кадра — только по явной настройке
+        if settings.PREPROCESS_CROP_MODE == 'center':
+            block = select_problem_block(small, blocks)
+        else:
+            block = union_blocks(blocks)
+        # Вырезаем, только если текст заметно меньше страницы: иначе выигрыша нет, а край условия можно потерять
+        if block[2] * block[3] <= small.shape[0] * small.shape[1] * settings.PREPROCESS_CROP_MAX_AREA:
+            scale = gray.shape[1] / small.shape[1]
+            gray = crop_block(gray, [int(value * scale) for value in block], padding=int(text_height * scale))
+            metrics.incr('layout.cropped')
+            changed = True
+
+    logger.info(f"Разметка страницы: лист {corners is not None}, наклон {angle:.1f}°, блоков {len(blocks)}, итог {gray.shape[1]}x{gray.shape[0]}")
+    return gray, changed
+
+
+def vision_scale(gray):
+    """Коэффициент уменьшения до минимального читаемого размера"""
+    height, width = gray.shape[:2]
+    long_side = max(height, width)
+
+    scale = 1.0
+    text_height = estimate_text_height(gray)
+    if text_height:
+        scale = settings.VISION_TARGET_TEXT_HEIGHT / text_height
+
+    # Не уменьшаем меньше минимального размера и не превышаем максимальный
+    scale = max(scale, settings.VISION_MIN_LONG_SIDE / long_side)
+    scale = min(scale, settings.VISION_MAX_LONG_SIDE / long_side, 1.0)
+    return scale
+
+
+def encode_for_vision(gray):
+    """Сжатое изображение для Vision: (байты, MIME-тип)"""
+    if gray.ndim == 3:
+        gray = cv2.cvtColor(gray, cv2.COLOR_BGR2GRAY)
+
+    scale = vision_scale(gray)
+    if scale < 1.0:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    extension, mime, quality_flag = VISION_FORMATS[settings.VISION_IMAGE_FORMAT]
+    quality = settings.VISION_IMAGE_QUALITY
+    while True:
+        ok, buffer = cv2.imencode(extension, gray, [quality_flag, quality])
+        if not ok:
+            raise ValueError("Не удалось закодировать изображение для Vision")
+        # Снижаем качество, пока не уложимся в бюджет байтов
+        if buffer.nbytes <= settings.VISION_MAX_BYTES or quality <= settings.VISION_MIN_QUALITY:
+            break
+        quality -= 10
+
+    logger.info(
+        f"Изображение для Vision: {gray.shape[1]}x{gray.shape[0]}, {buffer.nbytes} байт, "
+        f"{settings.VISION_IMAGE_FORMAT} q={quality}"
+    )
+    return buffer.tobytes(), mime
+
+
+def vision_stats():
+    """Объем загрузок в Vision и задержка ответов"""
+    counters = metrics.get_counters(['vision.requests', 'vision.upload_bytes'])
+    requests = counters['vision.requests']
+    return {
+        'requests': requests,
+        'avg_upload_bytes': counters['vision.upload_bytes'] // requests if requests else None,
+        'latency': metrics.histogram('vision.latency'),
+    }
+
+
+def preprocess_stats():
+    """Проверка качества фото, разметка страниц и пиковая память процесса на задачу предобработки"""
+    rejected = metrics.get_counters([f'quality_gate.rejected.{reason}' for reason in RETAKE_MESSAGES])
+    return {
+        'quality_gate': {
+            'passed': metrics.get_counters(['quality_gate.passed'])['quality_gate.passed'],
+            'rejected': {reason: rejected[f'quality_gate.rejected.{reason}'] for reason in RETAKE_MESSAGES},
+            'latency': metrics.histogram('quality_gate.latency'),
+        },
+        'layout': metrics.get_counters(['layout.document', 'layout.deskewed', 'layout.cropped']),
+        'peak_rss': metrics.histogram('preprocess.peak_rss', buckets=metrics.MEMORY_BUCKETS_MB, unit='mb'),
+    }
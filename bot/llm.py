@@ -0,0 +1,181 @@
+import logging
+import os
+import threading
+import time
+import httpx
+import openai
+from django.conf import settings
+from config import OPENAI_API_KEY
+from . import breaker, ratelimit
+
+logger = logging.getLogger(__name__)
+
+# Один клиент на процесс: пул keep-alive соединений переиспользуется всеми вызовами
+_client = None
+_client_pid = None
+_client_lock = threading.RLock()
+
+
+def _build_http_client():
+    """HTTP-клиент с пулом соединений для OpenAI"""
+    limits = httpx.Limits(
+        max_connections=settings.LLM_POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.LLM_POOL_MAX_KEEPALIVE,
+        keepalive_expiry=settings.LLM_POOL_KEEPALIVE_EXPIRY,
+    )
+    timeout = httpx.Timeout(settings.LLM_TIMEOUT, connect=settings.LLM_CONNECT_TIMEOUT)
+    return httpx.Client(limits=limits, timeout=timeout)
+
+
+def create_client(base_url=None):
+    """Новый клиент OpenAI с настройками пула"""
+    return openai.OpenAI(
+        api_key=OPENAI_API_KEY,
+        base_url=base_url or settings.LLM_BASE_URL or None,
+        http_client=_build_http_client(),
+        # Повторы делает chat_completion, чтобы лимитер видел каждый ответ 429
+        max_retries=0,
+    )
+
+
+def init_client():
+    """Создать клиент процесса (старт Django, worker_process_init в Celery)"""
+    global _client, _client_pid
+    # Клиент, унаследованный от родителя при fork, не закрываем: его сокеты общие с родителем
+    _client = create_client()
+    _client_pid = os.getpid()
+    logger.info(f"Клиент OpenAI инициализирован в процессе {_client_pid}")
+    return _client
+
+
+def get_client():
+    """Общий клиент OpenAI текущего процесса"""
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                return init_client()
+    return _client
+
+
+# Ошибки, после которых запрос имеет смысл быстро повторить внутри того же вызова
+TRANSIENT_ERRORS = (openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError)
+
+
+def estimate_tokens(request):
+    """Оценка расхода токенов запроса для лимита TPM"""
+    chars = 0
+    images = 0
+    for message in request.get('messages', []):
+        content = message.get('content')
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for part in content or []:
+            if part.get('type') == 'text':
+                chars += len(part.get('text', ''))
+            elif part.get('type') == 'image_url':
+                images += 1
+    # Кириллица в среднем ~3 символа на токен
+    return chars // 3 + images * settings.LLM_IMAGE_TOKEN_ESTIMATE + request.get('max_tokens', 0)
+
+
+def _retry_after(exc):
+    """Пауза из заголовков ответа 429 или None"""
+    headers = getattr(getattr(exc, 'response', None), 'headers', None) or {}
+    for header in ('retry-after-ms', 'retry-after'):
+        value = headers.get(header)
+        if value:
+            try:
+                seconds = float(value)
+            except ValueError:
+                continue
+            return seconds / 1000 if header == 'retry-after-ms' else seconds
+    return None
+
+
+def chat_completion(breaker_name='completion', **request):
+    """Запрос к chat completions через общий клиент, предохранитель и кластерный лимитер.
+
+    При 429 и сетевых сбоях запрос ждет в очереди лимитера и повторяется
+    в пределах LLM_RATE_LIMIT_RETRIES вместо падения задачи с долгим ретраем.
+    Если сервис лежит (предохранитель breaker_name разомкнут), сразу бросается CircuitOpen.
+    """
+    probe = breaker.allow(breaker_name)
+    try:
+        return _chat_completion(breaker_name, request)
+    finally:
+        # Проба, закончившаяся 429 или ошибкой запроса, не держит предохранитель до BREAKER_PROBE_TIMEOUT
+        breaker.release_probe(breaker_name, probe)
+
+
+def _chat_completion(breaker_name, request):
+    """Запрос с повторами при 429 и сетевых сбоях; учет в лимитере и предохранителе"""
+    tokens = estimate_tokens(request)
+    attempts = settings.LLM_RATE_LIMIT_RETRIES + 1
+    for attempt in range(attempts):
+        permit = ratelimit.acquire(tokens)
+        try:
+            response = get_client().chat.completions.create(**request)
+        except openai.RateLimitError as exc:
+            ratelimit.release(permit, rate_limited=True)
+            if attempt == attempts - 1:
+                raise
+            delay = _retry_after(exc) or min(2 ** attempt, settings.LLM_RATE_LIMIT_MAX_WAIT)
+            logger.warning(f"OpenAI 429, повтор через {delay:.1f} с")
+            time.sleep(min(delay, settings.LLM_RATE_LIMIT_MAX_WAIT))
+            continue
+        except TRANSIENT_ERRORS as exc:
+            ratelimit.release(permit, failed=True)
+            if attempt == attempts - 1:
+                breaker.record_failure(breaker_name)
+                raise
+            logger.warning(f"Сбой запроса к OpenAI ({exc}), повтор")
+            time.sleep(min(2 ** attempt, settings.LLM_RATE_LIMIT_MAX_WAIT))
+            if not breaker.is_available(breaker_name):
+                # Другие воркеры уже признали сервис недоступным: не тратим оставшиеся попытки
+                raise breaker.CircuitOpen(breaker_name, breaker.state(breaker_name)['retry_in'])
+            continue
+        except Exception:
+            ratelimit.release(permit, failed=True)
+            raise
+
+        breaker.record_success(breaker_name)
+        if request.get('stream'):
+            return PermitStream(response, permit)
+
+        usage = getattr(response, 'usage', None)
+        ratelimit.release(permit, used_tokens=getattr(usage, 'total_tokens', None))
+        return response
+
+
+class PermitStream:
+    """Поток ответа, освобождающий слот лимитера, когда он дочитан, прерван или закрыт"""
+
+    def __init__(self, stream, permit):
+        self.stream = stream
+        self.permit = permit
+        self._released = False
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        failed = True
+        try:
+            for chunk in self.stream:
+                yield chunk
+            failed = False
+        finally:
+            self._release(failed)
+
+    def close(self):
+        """Оборвать соединение, например проигравшего хедж-запроса; можно вызывать из другого потока"""
+        try:
+            self.stream.close()
+        finally:
+            self._release(True)
+
+    def _release(self, failed):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        ratelimit.release(self.permit, failed=failed)
@@ -0,0 +1,270 @@
+import logging
+import re
+import time
+import sympy
+from sympy.parsing.sympy_parser import (
+    convert_xor, implicit_multiplication_application, parse_expr, rationalize, standard_transformations,
+)
+from django.conf import settings
+from django.utils.html import escape
+from . import metrics
+from .solution_cache import normalize_problem_text
+
+logger = logging.getLogger(__name__)
+
+# Слова условия, при которых смысл задачи однозначно «реши / вычисли / упрости то, что после них».
+# Любое другое слово («сумма корней», «при каком a») отправляет задачу в LLM
+INSTRUCTION_WORDS = {
+    'реши', 'решите', 'решить', 'уравнение', 'уравнения', 'пример', 'задача', 'задачу', 'задание',
+    'вычисли', 'вычислите', 'вычислить', 'найди', 'найдите', 'найти', 'значение', 'выражения', 'выражение',
+    'корни', 'корень', 'чему', 'равно', 'сколько', 'будет', 'неизвестное',
+    'упрости', 'упростите', 'упростить', 'разложи', 'разложите', 'на', 'множители', 'раскрой', 'раскройте', 'скобки',
+    'solve', 'calculate', 'compute', 'evaluate', 'simplify', 'factor', 'expand', 'find', 'the', 'equation', 'expression', 'value', 'of',
+}
+SIMPLIFY_WORDS = {'упрости', 'упростите', 'упростить', 'simplify'}
+FACTOR_WORDS = {'разложи', 'разложите', 'множители', 'factor'}
+EXPAND_WORDS = {'раскрой', 'раскройте', 'скобки', 'expand'}
+
+# Кириллические буквы, которые пишут вместо латинских переменных
+CYRILLIC_VARIABLES = str.maketrans({'х': 'x', 'у': 'y', 'а': 'a', 'в': 'b', 'с': 'c'})
+VARIABLES = 'abcmnpqtxyz'
+# Только цифры, операторы, скобки, sqrt и однобуквенные переменные: до парсера не доходит ничего другого
+MATH_TOKEN_RE = re.compile(r'^(?:sqrt|[0-9.+\-*/^()=?' + VARIABLES + r'])+$')
+# Номер задачи в начале строки: «2)», «3. », «№ 4)», «Задача 5: »
+ITEM_NUMBER_RE = re.compile(
+    r'^\s*(?:(?:№|задача|задание|пример|упражнение|exercise|problem)\s*\d{1,3}[.):]\s|(?:№\s*)?\d{1,3}(?:\)|\.\s))',
+    re.IGNORECASE | re.MULTILINE,
+)
+# Двоеточие между числом (или скобкой) и операндом — знак деления «48 : 6»; после слова — конец условия
+DIVISION_COLON_RE = re.compile(r'(?<=[\d)]):(?=[\w(])')
+TOKEN_RE = re.compile(r'[^\s:,;]+')
+# Нормализация убирает пробел перед скобкой: «упростите (a+b)^2» -> «упростите(a+b)^2», слово условия отделяем снова
+INSTRUCTION_BRACKET_RE = re.compile(
+    r'\b(' + '|'.join(sorted(INSTRUCTION_WORDS, key=len, reverse=True)) + r')(?=[(\[])', re.IGNORECASE
+)
+# Соседние части одного выражения стыкуются через оператор: «2 +», «- 3»
+JOIN_END = ('+', '-', '*', '/', '^', '=', '(', 'sqrt')
+JOIN_START = ('+', '-', '*', '/', '^', '=', ')')
+
+TRANSFORMATIONS = standard_transformations + (implicit_multiplication_application, convert_xor, rationalize)
+SYMBOLS = {name: sympy.Symbol(name) for name in VARIABLES}
+MAX_TEXT_LENGTH = 120
+MAX_EXPONENT = 100
+
+SUPERSCRIPT_DIGITS = str.maketrans('0123456789-', '⁰¹²³⁴⁵⁶⁷⁸⁹⁻')
+POWER_RE = re.compile(r'\*\*(-?\d+)')
+COEFFICIENT_RE = re.compile(r'(\d)\*(?=[a-z(])')
+
+
+class NotSupported(Exception):
+    """Задача вне классов, которые решаются локально"""
+
+
+def split_problem(text):
+    """Слова условия и математическое выражение из текста задачи"""
+    # Номер задачи («2)») убираем до нормализации, пока он еще в начале строки
+    text = normalize_problem_text(ITEM_NUMBER_RE.sub(' ', text))
+    if len(text) > MAX_TEXT_LENGTH:
+        raise NotSupported('длинное условие')
+    text = DIVISION_COLON_RE.sub('/', text)
+    text = INSTRUCTION_BRACKET_RE.sub(r'\1 ', text)
+
+    words, math = set(), []
+    end = 0
+    for match in TOKEN_RE.finditer(text):
+        token, gap, end = match.group(), text[end:match.start()], match.end()
+        candidate = token.translate(CYRILLIC_VARIABLES)
+        if token in INSTRUCTION_WORDS or (len(candidate) == 1 and candidate in VARIABLES and not math):
+            # «найдите x: ...» — одиночная переменная перед выражением относится к условию
+            if math:
+                raise NotSupported('слова после выражения')
+            words.add(token)
+        elif MATH_TOKEN_RE.match(candidate):
+            # «3, 4» или «2 x» — не одно выражение: склеивать числа нельзя
+            if math and (gap.strip() or not (math[-1].endswith(JOIN_END) or candidate.startswith(JOIN_START))):
+                raise NotSupported('несколько выражений')
+            math.append(candidate)
+        else:
+            raise NotSupported(f'неизвестное слово {token}')
+    if not math:
+        raise NotSupported('нет выражения')
+    return words, ''.join(math).rstrip('?').rstrip('=')
+
+
+def parse(expression):
+    """Безопасный разбор выражения: только известные символы и разумные степени"""
+    try:
+        expr = parse_expr(expression, local_dict=dict(SYMBOLS), transformations=TRANSFORMATIONS, evaluate=False)
+    except Exception as e:
+        raise NotSupported(f'не разобрано: {e}')
+    for power in expr.atoms(sympy.Pow):
+        # 9^9^9 и подобное посчиталось бы за минуты
+        if not power.exp.is_Number or abs(power.exp) > MAX_EXPONENT:
+            raise NotSupported('слишком большая степень')
+    return expr
+
+
+def fmt(expr):
+    """Выражение в формате решений: x², 2x, ×, √"""
+    text = sympy.sstr(expr)
+    text = POWER_RE.sub(lambda match: match.group(1).translate(SUPERSCRIPT_DIGITS), text)
+    text = COEFFICIENT_RE.sub(r'\1', text)
+    return escape(text.replace('*', '×').replace('sqrt', '√'))
+
+
+def fmt_source(expression):
+    """Исходное выражение пользователя в формате решений"""
+    text = re.sub(r'\^(-?\d+)', lambda match: match.group(1).translate(SUPERSCRIPT_DIGITS), expression.replace('**', '^'))
+    text = re.sub(r'([-+*/=])', r' \1 ', text)
+    return escape(' '.join(text.split()).replace('*', '×').replace('sqrt', '√'))
+
+
+def wrap(value):
+    """Число в скобках, если оно отрицательное или дробное"""
+    return f'({fmt(value)})' if value < 0 or not value.is_Integer else fmt(value)
+
+
+def fmt_value(value):
+    """Число: целое, дробь с десятичным приближением или корень с приближением"""
+    value = sympy.nsimplify(value) if value.is_Float else value
+    if value.is_Integer:
+        return fmt(value)
+    approx = sympy.N(value, 6)
+    return f'{fmt(value)} ≈ {fmt(approx.round(4))}'
+
+
+def render(steps, answer):
+    """HTML решения в том же формате, что и ответы модели"""
+    items = [f'<li><strong>Шаг {number}:</strong> {step}</li>' for number, step in enumerate(steps, 1)]
+    items.append(f'<li><strong>Ответ:</strong> {answer}</li>')
+    return '<ol>\n' + '\n'.join(items) + '\n</ol>'
+
+
+def solve_arithmetic(expr, source):
+    value = sympy.simplify(expr.doit())
+    if not value.is_number or value.has(sympy.zoo, sympy.nan) or not value.is_real:
+        raise NotSupported('не число')
+    steps = [f'Выполняем действия по порядку (скобки, степени, умножение и деление, сложение и вычитание): {source} = {fmt_value(value)}']
+    return render(steps, fmt_value(value))
+
+
+def solve_equation(lhs, rhs):
+    equation = sympy.expand(lhs.doit() - rhs.doit())
+    variables = equation.free_symbols
+    if len(variables) != 1:
+        raise NotSupported('не одна переменная')
+    variable = variables.pop()
+    try:
+        polynomial = sympy.Poly(equation, variable)
+    except sympy.PolynomialError:
+        raise NotSupported('не многочлен')
+    if not all(coefficient.is_Rational for coefficient in polynomial.all_coeffs()):
+        raise NotSupported('нерациональные коэффициенты')
+
+    name = fmt(variable)
+    degree = polynomial.degree()
+    if degree == 1:
+        a, b = polynomial.all_coeffs()
+        root = -b / a
+        steps = [
+            f'Переносим всё в левую часть: {fmt(equation)} = 0',
+            f'{fmt(a * variable)} = {fmt(-b)}',
+        ]
+        if a != 1:
+            steps.append(f'{name} = {fmt(-b)} / {wrap(a)} = {fmt_value(root)}')
+        return render(steps, f'{name} = {fmt_value(root)}')
+
+    if degree == 2:
+        a, b, c = polynomial.all_coeffs()
+        discriminant = b ** 2 - 4 * a * c
+        steps = [
+            f'Приводим к виду ax² + bx + c = 0: {fmt(equation)} = 0',
+            f'D = b² − 4ac = {wrap(b)}² − 4 × {wrap(a)} × {wrap(c)} = {fmt(discriminant)}',
+        ]
+        if discriminant < 0:
+            steps.append('D < 0, действительных корней нет')
+            return render(steps, 'действительных корней нет')
+        if discriminant == 0:
+            root = -b / (2 * a)
+            steps.append(f'D = 0, один корень: {name} = −b / 2a = {fmt_value(root)}')
+            return render(steps, f'{name} = {fmt_value(root)}')
+        first = sympy.simplify((-b - sympy.sqrt(discriminant)) / (2 * a))
+        second = sympy.simplify((-b + sympy.sqrt(discriminant)) / (2 * a))
+        steps.append(f'D > 0, два корня: {name}₁,₂ = (−b ± √D) / 2a')
+        steps.append(f'{name}₁ = {fmt_value(first)}, {name}₂ = {fmt_value(second)}')
+        return render(steps, f'{name}₁ = {fmt_value(first)}, {name}₂ = {fmt_value(second)}')
+
+    raise NotSupported(f'степень {degree}')
+
+
+def transform(expr, expression, words):
+    if words & FACTOR_WORDS:
+        result, action = sympy.factor(expr), 'Раскладываем на множители'
+    elif words & EXPAND_WORDS:
+        result, action = sympy.expand(expr), 'Раскрываем скобки и приводим подобные'
+    else:
+        # Школьное «упростите» — многочлен или несократимая дробь: simplify оставил бы (a + b)² как есть
+        result, action = sympy.cancel(expr), 'Раскрываем скобки, приводим подобные и сокращаем'
+    steps = [f'{action}: {fmt_source(expression)} = {fmt(result)}']
+    return render(steps, fmt(result))
+
+
+def solve_problem(text):
+    """Решить задачу локально или бросить NotSupported"""
+    words, expression = split_problem(text)
+    if expression.count('=') > 1:
+        raise NotSupported('несколько знаков =')
+
+    if '=' in expression:
+        lhs, rhs = (parse(part) for part in expression.split('='))
+        return solve_equation(lhs, rhs)
+
+    expr = parse(expression)
+    if not expr.free_symbols:
+        return solve_arithmetic(expr, fmt_source(expression))
+    if words & (SIMPLIFY_WORDS | FACTOR_WORDS | EXPAND_WORDS) and len(expr.free_symbols) <= 2:
+        return transform(expr, expression, words)
+    raise NotSupported('выражение с переменными без указания, что сделать')
+
+
+def solve_locally(text):
+    """Локальное решение простой задачи (арифметика, линейные и квадратные уравнения, упрощение) или None"""
+    if not settings.LOCAL_SOLVER_ENABLED or not (text or '').strip():
+        return None
+
+    started = time.monotonic()
+    try:
+        solution = solve_problem(text)
+    except NotSupported as e:
+        metrics.incr('local_solver.misses')
+        logger.debug(f"Локальный решатель пропустил задачу: {e}")
+        return None
+    except Exception as e:
+        # Ошибка SymPy не должна мешать решению через LLM
+        metrics.incr('local_solver.misses')
+        logger.warning(f"Ошибка локального решателя: {e}")
+        return None
+
+    metrics.incr('local_solver.hits')
+    metrics.observe('local_solver.latency', time.monotonic() - started)
+    return solution
+
+
+def local_solver_stats():
+    """Доля задач, решенных без LLM, и оценка сэкономленного времени"""
+    counters = metrics.get_counters(['local_solver.hits', 'local_solver.misses'])
+    hits = counters['local_solver.hits']
+    latency = metrics.histogram('local_solver.latency')
+    llm_latency = metrics.histogram('llm.solve_latency')
+    saved = None
+    if llm_latency['mean_ms'] is not None:
+        # Каждое локальное решение экономит средний вызов LLM за вычетом собственного времени
+        saved = round(hits * (llm_latency['mean_ms'] - (latency['mean_ms'] or 0)) / 1000, 1)
+    return {
+        'hits': hits,
+        'misses': counters['local_solver.misses'],
+        'hit_rate': metrics.hit_rate(hits, counters['local_solver.misses']),
+        'latency': latency,
+        'llm_solve_mean_ms': llm_latency['mean_ms'],
+        'time_saved_seconds': saved,
+    }
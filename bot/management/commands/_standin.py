@@ -0,0 +1,131 @@
+"""Локальная заглушка OpenAI-совместимого API для бенчмарков"""
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_REPLY = """<ol>
+<li><strong>Шаг 1:</strong> 2 + 2 = 4</li>
+<li><strong>Ответ:</strong> 4</li>
+</ol>"""
+
+
+class StandinHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 с Content-Length позволяет клиенту держать keep-alive соединение
+    protocol_version = 'HTTP/1.1'
+    # Без TCP_NODELAY заголовки и тело уходят с задержкой Nagle и искажают замеры
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # Новое соединение: до api.openai.com это TCP и TLS рукопожатия, на localhost их почти нет
+        self.server.connections += 1
+        time.sleep(self.server.connect_latency)
+        super().setup()
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        self.server.requests += 1
+
+        model = body.get('model', 'standin')
+        delay = self.server.latency()
+        if body.get('stream'):
+            self.send_stream(model, delay)
+        else:
+            time.sleep(delay)
+            self.send_json(model)
+
+    def send_json(self, model):
+        reply = self.server.reply
+        payload = json.dumps({
+            'id': 'chatcmpl-standin',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': model,
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': reply},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': 50, 'completion_tokens': len(reply) // 4, 'total_tokens': 50 + len(reply) // 4},
+        }, ensure_ascii=False).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_stream(self, model, first_token_delay):
+        pieces = [self.server.reply[i:i + 16] for i in range(0, len(self.server.reply), 16)]
+        events = []
+        for piece in pieces:
+            chunk = {
+                'id': 'chatcmpl-standin',
+                'object': 'chat.completion.chunk',
+                'created': int(time.time()),
+                'model': model,
+                'choices': [{'index': 0, 'delta': {'content': piece}, 'finish_reason': None}],
+            }
+            events.append(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode())
+        events.append(b'data: [DONE]\n\n')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Content-Length', str(sum(len(event) for event in events)))
+        self.end_headers()
+        time.sleep(first_token_delay)
+        try:
+            for event in events:
+                self.wfile.write(event)
+                self.wfile.flush()
+                time.sleep(self.server.token_interval)
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент отменил запрос (например, проигравший хедж-запрос)
+            self.server.cancelled += 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandinServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0, slow_ratio=0.0, slow_latency=0.0,
+                 token_interval=0.0, connect_latency=0.0, reply=DEFAULT_REPLY, seed=0):
+        super().__init__(('127.0.0.1', 0), StandinHandler)
+        self.base_latency = latency
+        self.connect_latency = connect_latency
+        self.slow_ratio = slow_ratio
+        self.slow_latency = slow_latency
+        self.token_interval = token_interval
+        self.reply = reply
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.connections = 0
+        self.cancelled = 0
+
+    def latency(self):
+        """Задержка ответа: редкие медленные ответы моделируют хвост распределения"""
+        if self.slow_ratio and self.random.random() < self.slow_ratio:
+            return self.slow_latency
+        return self.base_latency
+
+    @property
+    def base_url(self):
+        host, port = self.server_address
+        return f'http://{host}:{port}/v1'
+
+
+@contextmanager
+def run_standin_server(**options):
+    """Запустить заглушку в фоновом потоке на свободном порту"""
+    server = StandinServer(**options)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
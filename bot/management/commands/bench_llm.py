@@ -0,0 +1,160 @@
+import json
+import mimetypes
+import statistics
+import time
+import cv2
+import numpy as np
+import openai
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from bot import llm
+from bot.llm import create_client
+from config import OPENAI_API_KEY
+from ._standin import DEFAULT_REPLY, run_standin_server
+
+MESSAGES = [{'role': 'user', 'content': 'Реши эту задачу: 2+2'}]
+
+
+def percentile(values, fraction):
+    """Перцентиль по отсортированной выборке"""
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = 'Бенчмарк обращений к LLM на локальной заглушке OpenAI API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', choices=['gateway', 'image', 'hedge'], default='gateway')
+        parser.add_argument('--calls', type=int, default=200)
+        parser.add_argument('--latency', type=float, default=0.0, help='Задержка ответа заглушки, с')
+        parser.add_argument('--slow-ratio', type=float, default=0.0, help='Доля медленных ответов заглушки (для hedge, например 0.05)')
+        parser.add_argument('--slow-latency', type=float, default=2.0, help='Задержка медленного ответа, с')
+        parser.add_argument('--image', help='Фото задачи для сценария image (по умолчанию синтетическое)')
+        parser.add_argument('--connect-latency', type=float, default=0.0,
+                            help='Задержка установки соединения, с (TCP и TLS до api.openai.com, например 0.1)')
+
+    def handle(self, *args, **options):
+        with run_standin_server(
+            latency=options['latency'], slow_ratio=options['slow_ratio'], slow_latency=options['slow_latency'],
+            connect_latency=options['connect_latency'],
+        ) as server:
+            getattr(self, f"bench_{options['scenario']}")(server, options)
+
+    def bench_gateway(self, server, options):
+        """Новый клиент на каждый вызов против общего пула соединений"""
+        calls = options['calls']
+
+        def fresh_call():
+            client = openai.OpenAI(api_key=OPENAI_API_KEY, base_url=server.base_url)
+            client.chat.completions.create(model='gpt-4', messages=MESSAGES)
+            client.close()
+
+        pooled_client = create_client(base_url=server.base_url)
+
+        def pooled_call():
+            pooled_client.chat.completions.create(model='gpt-4', messages=MESSAGES)
+
+        fresh = self.measure(fresh_call, calls)
+        fresh_connections = server.connections
+        pooled = self.measure(pooled_call, calls)
+        pooled_connections = server.connections - fresh_connections
+        pooled_client.close()
+
+        self.report('Новый клиент на вызов', fresh)
+        self.report('Общий клиент процесса', pooled)
+        saved = statistics.mean(fresh) - statistics.mean(pooled)
+        # Экономия складывается из создания клиента и рукопожатий: число соединений показывает вторую часть
+        self.stdout.write(self.style.SUCCESS(
+            f'Экономия на вызов: {saved * 1000:.2f} мс, '
+            f'соединений: {fresh_connections} против {pooled_connections} на {calls + 1} вызовов'
+        ))
+
+    def bench_image(self, server, options):
+        """Фото задачи: OCR и решение двумя запросами против одного совмещенного запроса Vision"""
+        from bot.ocr import extract_text_from_image
+        from bot.tasks import generate_solution, generate_solution_from_image
+
+        image_bytes, mime = self.load_image(options['image'])
+        # Сравниваем только сетевой путь: лимитер и кэши замеры не искажают
+        settings.LLM_BASE_URL = server.base_url
+        settings.LLM_RATE_LIMIT_ENABLED = False
+        llm.init_client()
+        calls = options['calls']
+
+        def separate_call():
+            text, _ = extract_text_from_image(image_bytes, mime)
+            generate_solution(text)
+
+        server.reply = DEFAULT_REPLY
+        separate = self.measure(separate_call, calls)
+        separate_requests = server.requests
+
+        server.reply = json.dumps({'text': '2+2', 'solution': DEFAULT_REPLY}, ensure_ascii=False)
+        combined = self.measure(lambda: generate_solution_from_image(image_bytes, mime), calls)
+
+        self.report('Два запроса (OCR, затем решение)', separate)
+        self.report('Один совмещенный запрос', combined)
+        saved = statistics.mean(separate) - statistics.mean(combined)
+        self.stdout.write(self.style.SUCCESS(
+            f'Экономия на фото: {saved * 1000:.2f} мс без учета ожидания в очереди этапа решения, '
+            f'запросов к API: {separate_requests} против {server.requests - separate_requests}'
+        ))
+
+    def bench_hedge(self, server, options):
+        """Хвост задержки потоковых запросов без хеджирования и с ним при редких медленных ответах"""
+        from bot.hedging import hedging_stats, stream_completion
+
+        settings.LLM_BASE_URL = server.base_url
+        settings.LLM_RATE_LIMIT_ENABLED = False
+        llm.init_client()
+        request = dict(model='gpt-4', messages=MESSAGES)
+
+        def call():
+            for _ in stream_completion(**request):
+                pass
+
+        # Прогон без хеджа заодно наполняет окно задержек первого токена для p90
+        settings.LLM_HEDGING_ENABLED = False
+        plain = self.measure(call, options['calls'])
+        settings.LLM_HEDGING_ENABLED = True
+        before = hedging_stats()
+        hedged = self.measure(call, options['calls'])
+        after = hedging_stats()
+
+        self.report('Без хеджирования', plain)
+        self.report('С хеджированием', hedged)
+        fired = after['fired'] - before['fired']
+        self.stdout.write(self.style.SUCCESS(
+            f'Хеджей: {fired} из {after["requests"] - before["requests"]} запросов, '
+            f'выиграли {after["won"] - before["won"]}, отменено на заглушке {server.cancelled}, '
+            f'не хватило бюджета {after["over_budget"] - before["over_budget"]}'
+        ))
+
+    def load_image(self, path):
+        """Байты и MIME-тип фото для сценария image"""
+        if path:
+            with open(path, 'rb') as image_file:
+                return image_file.read(), mimetypes.guess_type(path)[0] or 'image/jpeg'
+        image = np.full((300, 800), 255, np.uint8)
+        cv2.putText(image, '2x + 3 = 7', (40, 170), cv2.FONT_HERSHEY_SIMPLEX, 2.5, 0, 5)
+        return cv2.imencode('.png', image)[1].tobytes(), 'image/png'
+
+    def measure(self, call, calls):
+        # Прогрев: первый вызов включает импорт и установку соединения
+        call()
+        durations = []
+        for _ in range(calls):
+            started = time.perf_counter()
+            call()
+            durations.append(time.perf_counter() - started)
+        return durations
+
+    def report(self, title, durations):
+        self.stdout.write(
+            f'{title}: среднее {statistics.mean(durations) * 1000:.2f} мс, '
+            f'p50 {percentile(durations, 0.5) * 1000:.2f} мс, '
+            f'p95 {percentile(durations, 0.95) * 1000:.2f} мс, '
+            f'p99 {percentile(durations, 0.99) * 1000:.2f} мс'
+        )
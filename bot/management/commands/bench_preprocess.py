@@ -0,0 +1,91 @@
+import multiprocessing
+import os
+import statistics
+import time
+import cv2
+import django
+from django.core.management.base import BaseCommand, CommandError
+from bot.imaging import PREPROCESS_PROFILES, decode_image, extract_problem_region, preprocess, encode_for_vision
+from bot.metrics import reset_peak_rss, peak_rss_mb
+from .bench_llm import percentile
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.bmp')
+STAGES = ('decode', 'layout', 'preprocess', 'encode')
+
+
+def init_worker():
+    """Инициализация процесса пула: Django и один поток OpenCV на процесс"""
+    django.setup()
+    # Параллелим по процессам, внутренние потоки OpenCV только мешали бы друг другу
+    cv2.setNumThreads(1)
+
+
+def run_sample(job):
+    """Прогнать одно изображение через этапы предобработки и замерить каждый"""
+    path, profile = job
+    with open(path, 'rb') as image_file:
+        image_bytes = image_file.read()
+
+    reset_peak_rss()
+    timings = {}
+    started = time.perf_counter()
+    gray = decode_image(image_bytes)
+    timings['decode'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    gray, _ = extract_problem_region(gray)
+    timings['layout'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    processed = preprocess(gray, profile)
+    timings['preprocess'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    output, _ = encode_for_vision(processed)
+    timings['encode'] = time.perf_counter() - started
+    return timings, len(output), peak_rss_mb()
+
+
+class Command(BaseCommand):
+    help = 'Бенчмарк профилей предобработки изображений на каталоге с примерами фото'
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help='Каталог с примерами изображений')
+        parser.add_argument('--profiles', nargs='+', choices=list(PREPROCESS_PROFILES), default=list(PREPROCESS_PROFILES))
+        parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Число процессов')
+        parser.add_argument('--repeat', type=int, default=1, help='Сколько раз прогнать каждый файл')
+
+    def handle(self, *args, **options):
+        directory = options['directory']
+        if not os.path.isdir(directory):
+            raise CommandError(f"Каталог {directory} не найден")
+        paths = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory)
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        )
+        if not paths:
+            raise CommandError(f"В каталоге {directory} нет изображений")
+
+        workers = max(1, options['workers'])
+        self.stdout.write(f'Изображений: {len(paths)}, повторов: {options["repeat"]}, процессов: {workers}')
+        with multiprocessing.Pool(workers, initializer=init_worker) as pool:
+            for profile in options['profiles']:
+                jobs = [(path, profile) for path in paths] * options['repeat']
+                started = time.perf_counter()
+                results = pool.map(run_sample, jobs)
+                elapsed = time.perf_counter() - started
+                self.report(profile, results, elapsed)
+
+    def report(self, profile, results, elapsed):
+        self.stdout.write(self.style.SUCCESS(
+            f'Профиль {profile}: {len(results) / elapsed:.1f} изобр./с, '
+            f'средний размер для OCR {statistics.mean(size for _, size, _ in results) / 1024:.1f} КБ, '
+            f'пик RSS {max(peak for _, _, peak in results):.0f} МБ'
+        ))
+        for stage in STAGES:
+            durations = [timings[stage] for timings, _, _ in results]
+            self.stdout.write(
+                f'  {stage}: среднее {statistics.mean(durations) * 1000:.1f} мс, '
+                f'p50 {percentile(durations, 0.5) * 1000:.1f} мс, '
+                f'p95 {percentile(durations, 0.95) * 1000:.1f} мс'
+            )
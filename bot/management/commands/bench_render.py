@@ -0,0 +1,75 @@
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from bot.metrics import reset_peak_rss, peak_rss_mb
+from bot.models import Task
+from bot.rendering import IMAGE_FORMATS, _init_worker, render_solution
+from .bench_llm import percentile
+
+STEP = 'Вычисляем дискриминант \\(D = b^2 - 4ac = 25 - 24 = 1\\), затем корни \\(x_{1,2} = \\frac{5 \\pm 1}{2}\\)'
+SAMPLES = {
+    'short': '<ol>\n<li><strong>Шаг 1:</strong> 2 + 2 = 4</li>\n<li><strong>Ответ:</strong> 4</li>\n</ol>',
+    'medium': '<ol>\n' + '\n'.join(f'<li><strong>Шаг {i}:</strong> {STEP}</li>' for i in range(1, 7))
+              + '\n<li><strong>Ответ:</strong> x₁ = 2, x₂ = 3</li>\n</ol>',
+    'long': '<ol>\n' + '\n'.join(f'<li><strong>Шаг {i}:</strong> {STEP}. {STEP}</li>' for i in range(1, 41))
+            + '\n<li><strong>Ответ:</strong> x₁ = 2, x₂ = 3</li>\n</ol>',
+}
+
+
+def run_sample(job):
+    """Нарисовать одно решение и замерить время и пик памяти"""
+    solution, variant, image_format = job
+    reset_peak_rss()
+    started = time.perf_counter()
+    image = render_solution(solution, variant, image_format)
+    return time.perf_counter() - started, len(image), peak_rss_mb()
+
+
+class Command(BaseCommand):
+    help = 'Бенчмарк рисования изображений решений: время, размер файла и память'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--samples', nargs='+', choices=list(SAMPLES) + ['db'], default=list(SAMPLES),
+                            help='Синтетические решения или db — последние решения из базы')
+        parser.add_argument('--repeat', type=int, default=20, help='Сколько раз нарисовать каждое решение')
+        parser.add_argument('--workers', type=int, default=0, help='Процессов пула (0 — в текущем процессе)')
+        parser.add_argument('--variant', choices=list(settings.SOLUTION_IMAGE_VARIANTS), default='full',
+                            help='Вариант изображения из SOLUTION_IMAGE_VARIANTS')
+        parser.add_argument('--format', dest='image_format', choices=list(IMAGE_FORMATS), default='png')
+
+    def handle(self, *args, **options):
+        for name in options['samples']:
+            if name == 'db':
+                solutions = list(Task.objects.exclude(solution='').values_list('solution', flat=True)[:50])
+            else:
+                solutions = [SAMPLES[name]]
+            if not solutions:
+                self.stdout.write(f'{name}: решений нет')
+                continue
+            jobs = [(solution, options['variant'], options['image_format']) for solution in solutions]
+            jobs *= options['repeat']
+            started = time.perf_counter()
+            results = self.run(jobs, options['workers'])
+            self.report(name, results, time.perf_counter() - started)
+
+    def run(self, jobs, workers):
+        if workers <= 0:
+            # Прогрев: первый вызов загружает шрифты
+            run_sample(jobs[0])
+            return [run_sample(job) for job in jobs]
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker) as pool:
+            list(pool.map(run_sample, jobs[:workers]))
+            return list(pool.map(run_sample, jobs))
+
+    def report(self, name, results, elapsed):
+        durations = [duration for duration, _, _ in results]
+        self.stdout.write(self.style.SUCCESS(
+            f'{name}: {len(results) / elapsed:.1f} изобр./с, '
+            f'среднее {statistics.mean(durations) * 1000:.1f} мс, '
+            f'p50 {percentile(durations, 0.5) * 1000:.1f} мс, '
+            f'p95 {percentile(durations, 0.95) * 1000:.1f} мс, '
+            f'файл {statistics.mean(size for _, size, _ in results) / 1024:.1f} КБ, '
+            f'пик RSS {max(peak for _, _, peak in results):.0f} МБ'
+        ))
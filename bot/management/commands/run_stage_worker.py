@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from zerotask_backend.celery import app
+
+
+class Command(BaseCommand):
+    help = 'Запуск Celery воркера для очереди этапов с пулом из настроек CELERY_STAGE_WORKERS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('worker', help='Имя воркера из CELERY_STAGE_WORKERS (cpu, io, telegram)')
+        parser.add_argument('--loglevel', default='info')
+
+    def handle(self, *args, **options):
+        name = options['worker']
+        config = settings.CELERY_STAGE_WORKERS.get(name)
+        if config is None:
+            raise CommandError(f"Неизвестный воркер {name}, доступны: {', '.join(settings.CELERY_STAGE_WORKERS)}")
+
+        argv = [
+            'worker',
+            f"--loglevel={options['loglevel']}",
+            f"--pool={config['pool']}",
+            f"--concurrency={config['concurrency']}",
+            f"--prefetch-multiplier={config['prefetch_multiplier']}",
+            f"--queues={','.join(config['queues'])}",
+            f'--hostname={name}@%h',
+        ]
+        if config.get('max_memory_per_child'):
+            argv.append(f"--max-memory-per-child={config['max_memory_per_child']}")
+        self.stdout.write(f"Запуск воркера {name}: {' '.join(argv)}")
+        app.worker_main(argv)
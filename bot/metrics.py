@@ -0,0 +1,108 @@
+import logging
+import sys
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+# Счетчики хранятся в общем кэше, чтобы их видели и Django, и Celery воркеры
+METRICS_CACHE = 'default'
+METRICS_PREFIX = 'metrics:'
+
+
+def incr(name, delta=1):
+    """Увеличить счетчик метрики"""
+    cache = caches[METRICS_CACHE]
+    key = f'{METRICS_PREFIX}{name}'
+    try:
+        # add не перезаписывает существующее значение, incr атомарен в Redis
+        cache.add(key, 0, timeout=None)
+        cache.incr(key, delta)
+    except Exception as e:
+        # Метрики не должны ломать обработку задач
+        logger.warning(f"Не удалось обновить метрику {name}: {e}")
+
+
+def get_counters(names):
+    """Получить значения нескольких счетчиков"""
+    cache = caches[METRICS_CACHE]
+    keys = {f'{METRICS_PREFIX}{name}': name for name in names}
+    try:
+        values = cache.get_many(list(keys))
+    except Exception as e:
+        logger.warning(f"Не удалось прочитать метрики: {e}")
+        values = {}
+    return {name: int(values.get(key, 0)) for key, name in keys.items()}
+
+
+def hit_rate(hits, misses):
+    """Доля попаданий в кэш"""
+    total = hits + misses
+    return round(hits / total, 4) if total else 0.0
+
+
+# Границы корзин гистограмм задержек, мс
+LATENCY_BUCKETS_MS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000, 300000]
+# Границы корзин гистограмм памяти, МБ
+MEMORY_BUCKETS_MB = [64, 128, 256, 384, 512, 768, 1024, 1536, 2048, 4096]
+
+
+def observe(name, seconds):
+    """Записать наблюдение задержки в гистограмму"""
+    observe_value(name, seconds * 1000, LATENCY_BUCKETS_MS, 'ms')
+
+
+def observe_value(name, value, buckets, unit):
+    """Записать наблюдение в гистограмму с заданными границами корзин"""
+    bucket = next((str(bound) for bound in buckets if value <= bound), 'inf')
+    incr(f'{name}.bucket.{bucket}')
+    incr(f'{name}.count')
+    incr(f'{name}.sum_{unit}', int(value))
+
+
+def histogram(name, quantiles=(0.5, 0.9, 0.99), buckets=LATENCY_BUCKETS_MS, unit='ms'):
+    """Число наблюдений, среднее и оценки перцентилей (верхняя граница корзины)"""
+    bucket_names = [str(bound) for bound in buckets] + ['inf']
+    counters = get_counters(
+        [f'{name}.bucket.{bucket}' for bucket in bucket_names] + [f'{name}.count', f'{name}.sum_{unit}']
+    )
+    total = counters[f'{name}.count']
+    result = {
+        'count': total,
+        f'mean_{unit}': round(counters[f'{name}.sum_{unit}'] / total, 1) if total else None,
+    }
+
+    for quantile in quantiles:
+        label = f'p{int(quantile * 100)}_{unit}'
+        result[label] = None
+        cumulative = 0
+        for bucket in bucket_names:
+            cumulative += counters[f'{name}.bucket.{bucket}']
+            if total and cumulative >= quantile * total:
+                result[label] = int(bucket) if bucket != 'inf' else f'>{buckets[-1]}'
+                break
+    return result
+
+
+def reset_peak_rss():
+    """Сбросить пик RSS процесса (Linux), чтобы следующий замер относился к одной задаче"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """Пик RSS процесса в МБ: с последнего reset_peak_rss или за все время жизни"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # Вне Linux доступен только пик за всю жизнь процесса (в КБ, на macOS — в байтах)
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:13
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0004_task_error_message_task_source'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OcrResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('image_hash', models.CharField(max_length=16, verbose_name='Перцептивный хэш')),
+                ('hash_band_0', models.PositiveIntegerField(db_index=True)),
+                ('hash_band_1', models.PositiveIntegerField(db_index=True)),
+                ('hash_band_2', models.PositiveIntegerField(db_index=True)),
+                ('hash_band_3', models.PositiveIntegerField(db_index=True)),
+                ('text', models.TextField(verbose_name='Распознанный текст')),
+                ('hits', models.IntegerField(default=0, verbose_name='Повторных использований')),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Дата создания')),
+                ('last_used_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Последнее использование')),
+            ],
+            options={
+                'verbose_name': 'Результат OCR',
+                'verbose_name_plural': 'Результаты OCR',
+                'ordering': ['-last_used_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0005_ocrresult'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='ocr_text',
+            field=models.TextField(blank=True, verbose_name='Распознанный текст'),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='processed_image',
+            field=models.ImageField(blank=True, null=True, upload_to='tasks/', verbose_name='Обработанное фото'),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='raw_solution',
+            field=models.TextField(blank=True, verbose_name='Ответ модели'),
+        ),
+        migrations.AlterField(
+            model_name='task',
+            name='status',
+            field=models.CharField(choices=[('pending', 'В ожидании'), ('processing', 'В обработке'), ('preprocessing', 'Обработка изображения'), ('recognizing', 'Распознавание текста'), ('solving', 'Решение'), ('rendering', 'Оформление решения'), ('completed', 'Завершена'), ('failed', 'Ошибка')], default='pending', max_length=20, verbose_name='Статус'),
+        ),
+    ]
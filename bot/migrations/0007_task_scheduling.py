@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0006_task_stage_checkpoints'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='lane',
+            field=models.CharField(default='trial', max_length=20, verbose_name='Полоса приоритета'),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='priority',
+            field=models.PositiveSmallIntegerField(default=5, verbose_name='Приоритет в очереди'),
+        ),
+        migrations.AddField(
+            model_name='task',
+            name='queued_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Поставлена в очередь'),
+        ),
+    ]
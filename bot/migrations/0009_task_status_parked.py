@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 01:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0008_task_status_retake'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='task',
+            name='status',
+            field=models.CharField(choices=[('pending', 'В ожидании'), ('processing', 'В обработке'), ('preprocessing', 'Обработка изображения'), ('recognizing', 'Распознавание текста'), ('solving', 'Решение'), ('rendering', 'Оформление решения'), ('completed', 'Завершена'), ('failed', 'Ошибка'), ('retake', 'Нужно переснять фото'), ('parked', 'Отложена')], default='pending', max_length=20, verbose_name='Статус'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0009_task_status_parked'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ocrresult',
+            name='height',
+            field=models.PositiveIntegerField(default=0, verbose_name='Высота'),
+        ),
+        migrations.AddField(
+            model_name='ocrresult',
+            name='verify_hash',
+            field=models.CharField(blank=True, default='', max_length=16, verbose_name='Проверочный хэш (dHash)'),
+        ),
+        migrations.AddField(
+            model_name='ocrresult',
+            name='width',
+            field=models.PositiveIntegerField(default=0, verbose_name='Ширина'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:19
+
+from django.db import migrations, models
+
+
+def reset_removed_statuses(apps, schema_editor):
+    """Задачи в удаленных статусах возвращаются в ожидание: повторная обработка продолжит с готовых этапов"""
+    Task = apps.get_model('bot', 'Task')
+    Task.objects.filter(status__in=['processing', 'rendering']).update(status='pending')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('bot', '0010_ocrresult_verification'),
+    ]
+
+    operations = [
+        migrations.RunPython(reset_removed_statuses, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='task',
+            name='status',
+            field=models.CharField(choices=[('pending', 'В ожидании'), ('preprocessing', 'Обработка изображения'), ('recognizing', 'Распознавание текста'), ('solving', 'Решение'), ('completed', 'Завершена'), ('failed', 'Ошибка'), ('retake', 'Нужно переснять фото'), ('parked', 'Отложена')], default='pending', max_length=20, verbose_name='Статус'),
+        ),
+    ]
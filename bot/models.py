@@ -93,9 +93,13 @@ class Task(models.Model):
     """Модель задачи пользователя"""
     STATUS_CHOICES = [
         ('pending', 'В ожидании'),
-        ('processing', 'В обработке'),
+        ('preprocessing', 'Обработка изображения'),
+        ('recognizing', 'Распознавание текста'),
+        ('solving', 'Решение'),
         ('completed', 'Завершена'),
         ('failed', 'Ошибка'),
+        ('retake', 'Нужно переснять фото'),
+        ('parked', 'Отложена'),
     ]
     
     SOURCE_CHOICES = [
@@ -113,6 +117,14 @@ class Task(models.Model):
     solution = models.TextField(blank=True, verbose_name="Решение")
     solution_image = models.ImageField(upload_to='solutions/', blank=True, null=True, verbose_name="Фото решения")
     completed_at = models.DateTimeField(null=True, blank=True, verbose_name="Дата завершения")
+    # Планирование: полоса приоритета и приоритет Celery, выбранные при постановке в очередь
+    lane = models.CharField(max_length=20, default='trial', verbose_name="Полоса приоритета")
+    priority = models.PositiveSmallIntegerField(default=5, verbose_name="Приоритет в очереди")
+    queued_at = models.DateTimeField(null=True, blank=True, verbose_name="Поставлена в очередь")
+    # Результаты этапов обработки: повторная попытка продолжает с первого незавершенного этапа
+    processed_image = models.ImageField(upload_to='tasks/', blank=True, null=True, verbose_name="Обработанное фото")
+    ocr_text = models.TextField(blank=True, verbose_name="Распознанный текст")
+    raw_solution = models.TextField(blank=True, verbose_name="Ответ модели")
     error_message = models.TextField(blank=True, null=True, verbose_name="Сообщение об ошибке")
     
     class Meta:
@@ -140,3 +152,28 @@ class BotSettings(models.Model):
     
     def __str__(self):
         return f"{self.key}: {self.value}"
+
+class OcrResult(models.Model):
+    """Результат распознавания изображения, найденный по перцептивному хэшу"""
+    image_hash = models.CharField(max_length=16, verbose_name="Перцептивный хэш")
+    # 64-битный хэш разбит на 4 полосы по 16 бит для быстрого поиска похожих хэшей
+    hash_band_0 = models.PositiveIntegerField(db_index=True)
+    hash_band_1 = models.PositiveIntegerField(db_index=True)
+    hash_band_2 = models.PositiveIntegerField(db_index=True)
+    hash_band_3 = models.PositiveIntegerField(db_index=True)
+    # Проверка совпадения: похожая верстка дает близкий pHash и у разных страниц
+    verify_hash = models.CharField(max_length=16, blank=True, default='', verbose_name="Проверочный хэш (dHash)")
+    width = models.PositiveIntegerField(default=0, verbose_name="Ширина")
+    height = models.PositiveIntegerField(default=0, verbose_name="Высота")
+    text = models.TextField(verbose_name="Распознанный текст")
+    hits = models.IntegerField(default=0, verbose_name="Повторных использований")
+    created_at = models.DateTimeField(default=timezone.now, verbose_name="Дата создания")
+    last_used_at = models.DateTimeField(default=timezone.now, verbose_name="Последнее использование")
+    
+    class Meta:
+        verbose_name = "Результат OCR"
+        verbose_name_plural = "Результаты OCR"
+        ordering = ['-last_used_at']
+    
+    def __str__(self):
+        return f"OCR {self.image_hash}: {self.text[:50]}"
@@ -0,0 +1,173 @@
+import base64
+import csv
+import io
+import logging
+import subprocess
+import time
+from django.conf import settings
+from . import metrics
+from .breaker import CircuitOpen
+from .llm import chat_completion
+
+logger = logging.getLogger(__name__)
+
+# Реестр OCR-движков: имя -> функция (байты изображения, MIME-тип) -> (текст, уверенность 0..1)
+OCR_BACKENDS = {}
+
+
+class OcrEngineError(Exception):
+    """Локальный OCR-движок недоступен или завершился с ошибкой"""
+
+
+def register_backend(name):
+    """Зарегистрировать OCR-движок под именем для настройки OCR_BACKEND"""
+    def decorator(func):
+        OCR_BACKENDS[name] = func
+        return func
+    return decorator
+
+
+def recognize(image_bytes, mime, backend=None):
+    """Распознать текст движком из настройки OCR_BACKEND"""
+    backend = backend or settings.OCR_BACKEND
+    if backend not in OCR_BACKENDS:
+        raise ValueError(f"Неизвестный OCR-движок {backend}, доступны: {', '.join(OCR_BACKENDS)}")
+
+    metrics.incr(f'ocr.{backend}.requests')
+    text, confidence = OCR_BACKENDS[backend](image_bytes, mime)
+    logger.info(f"Extracted text ({backend}, confidence {confidence:.2f}): {text}")
+    return text
+
+
+@register_backend('vision')
+def extract_text_from_image(image_bytes, mime):
+    """Извлечение текста из подготовленного изображения с помощью OpenAI Vision"""
+    try:
+        metrics.incr('vision.requests')
+        metrics.incr('vision.upload_bytes', len(image_bytes))
+
+        started = time.monotonic()
+        response = chat_completion(
+            breaker_name='vision',
+            model="gpt-4o",
+            messages=[
+                {
+                    "role": "system",
+                    "content": "Ты - эксперт по извлечению текста из изображений. Извлеки весь текст из изображения, особенно математические задачи, формулы и уравнения. Сохрани точность математических выражений. Отвечай только текстом задачи, без дополнительных комментариев."
+                },
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": "Извлеки текст из этого изображения. Если это математическая задача, сохрани все формулы и символы точно."
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:{mime};base64,{base64.b64encode(image_bytes).decode()}"
+                            }
+                        }
+                    ]
+                }
+            ],
+            max_tokens=1000,
+            timeout=30
+        )
+        metrics.observe('vision.latency', time.monotonic() - started)
+
+        return response.choices[0].message.content.strip(), 1.0
+
+    except Exception as e:
+        logger.error(f"Error extracting text: {e}")
+        raise
+
+
+@register_backend('tesseract')
+def extract_text_tesseract(image_bytes, mime):
+    """Локальное распознавание Tesseract в отдельном процессе (CPU, без сети)"""
+    command = [
+        settings.OCR_TESSERACT_CMD, 'stdin', 'stdout',
+        '-l', settings.OCR_TESSERACT_LANG,
+        '--psm', '6',  # один блок текста: после вырезания задачи так и есть
+        'tsv',
+    ]
+    started = time.monotonic()
+    try:
+        result = subprocess.run(
+            command, input=image_bytes, capture_output=True, timeout=settings.OCR_TESSERACT_TIMEOUT
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise OcrEngineError(f"Tesseract недоступен: {e}")
+    if result.returncode != 0:
+        raise OcrEngineError(f"Tesseract завершился с кодом {result.returncode}: {result.stderr.decode(errors='replace')[:200]}")
+    metrics.observe('ocr.tesseract.latency', time.monotonic() - started)
+
+    return parse_tesseract_tsv(result.stdout.decode('utf-8', errors='replace'))
+
+
+def parse_tesseract_tsv(output):
+    """Текст по строкам и средняя уверенность слов, взвешенная по длине"""
+    lines = {}
+    weighted_confidence = 0.0
+    characters = 0
+    for row in csv.DictReader(io.StringIO(output), delimiter='\t', quoting=csv.QUOTE_NONE):
+        word = (row.get('text') or '').strip()
+        confidence = float(row.get('conf') or -1)
+        if not word or confidence < 0:
+            continue
+        line = (int(row['block_num']), int(row['par_num']), int(row['line_num']))
+        lines.setdefault(line, []).append(word)
+        weighted_confidence += confidence * len(word)
+        characters += len(word)
+
+    text = '\n'.join(' '.join(words) for _, words in sorted(lines.items()))
+    return text, (weighted_confidence / characters / 100 if characters else 0.0)
+
+
+@register_backend('hybrid')
+def extract_text_hybrid(image_bytes, mime):
+    """Сначала локальный движок; Vision только для неуверенно распознанного или рукописного текста"""
+    try:
+        text, confidence = extract_text_tesseract(image_bytes, mime)
+    except OcrEngineError as e:
+        logger.warning(f"Локальный OCR не сработал, используем Vision: {e}")
+        text, confidence = '', 0.0
+
+    if confidence >= settings.OCR_HYBRID_MIN_CONFIDENCE and len(text) >= settings.OCR_HYBRID_MIN_CHARS:
+        metrics.incr('ocr.hybrid.local')
+        return text, confidence
+
+    metrics.incr('ocr.hybrid.escalated')
+    logger.info(f"Уверенность локального OCR {confidence:.2f}, распознаем через Vision")
+    try:
+        return extract_text_from_image(image_bytes, mime)
+    except CircuitOpen:
+        if not text:
+            raise
+        # Vision недоступен: неуверенный локальный текст лучше, чем ожидание
+        metrics.incr('ocr.hybrid.degraded')
+        logger.warning(f"Vision недоступен, используем текст Tesseract с уверенностью {confidence:.2f}")
+        return text, confidence
+
+
+def ocr_stats():
+    """Выбранный OCR-движок, число запросов, доля фото, распознанных без сети, и совмещенные запросы"""
+    counters = metrics.get_counters(
+        [f'ocr.{backend}.requests' for backend in OCR_BACKENDS]
+        + ['ocr.hybrid.local', 'ocr.hybrid.escalated', 'combined.requests', 'combined.fallbacks']
+    )
+    local = counters['ocr.hybrid.local']
+    escalated = counters['ocr.hybrid.escalated']
+    return {
+        'backend': settings.OCR_BACKEND,
+        'requests': {backend: counters[f'ocr.{backend}.requests'] for backend in OCR_BACKENDS},
+        'hybrid_local_rate': metrics.hit_rate(local, escalated),
+        'hybrid_escalated': escalated,
+        'tesseract_latency': metrics.histogram('ocr.tesseract.latency'),
+        # Совмещенный режим: текст и решение одним запросом (см. IMAGE_SOLVE_MODE)
+        'solve_mode': settings.IMAGE_SOLVE_MODE,
+        'combined_requests': counters['combined.requests'],
+        'combined_fallbacks': counters['combined.fallbacks'],
+        'combined_latency': metrics.histogram('combined.latency'),
+    }
@@ -0,0 +1,193 @@
+import logging
+from datetime import timedelta
+import cv2
+import numpy as np
+from django.conf import settings
+from django.db.models import Q, F
+from django.utils import timezone
+from . import metrics
+from .models import OcrResult
+
+logger = logging.getLogger(__name__)
+
+HASH_BANDS = 4
+BAND_BITS = 16
+BAND_MASK = (1 << BAND_BITS) - 1
+# Сколько кандидатов проверяем на расстояние Хэмминга за один поиск
+MAX_CANDIDATES = 200
+
+
+def perceptual_hash(image):
+    """64-битный pHash изображения в оттенках серого"""
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    small = cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    # Низкочастотные коэффициенты DCT устойчивы к шуму, сжатию и небольшому масштабированию
+    low_freq = cv2.dct(small)[:8, :8].flatten()
+    median = np.median(low_freq[1:])
+    bits = low_freq > median
+
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def difference_hash(image):
+    """64-битный dHash: знаки горизонтальных градиентов, независимая от pHash проверка совпадения"""
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def image_fingerprint(image):
+    """Отпечаток изображения для OCR-кэша: pHash для поиска, dHash и размеры для проверки"""
+    height, width = image.shape[:2]
+    return {
+        'phash': perceptual_hash(image),
+        'dhash': difference_hash(image),
+        'width': width,
+        'height': height,
+    }
+
+
+def image_fingerprint_bytes(image_bytes):
+    """Отпечаток закодированного изображения или None"""
+    image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if image is None:
+        return None
+    return image_fingerprint(image)
+
+
+def hash_bands(value):
+    """Разбить хэш на полосы для индексированного поиска"""
+    return [(value >> (BAND_BITS * i)) & BAND_MASK for i in range(HASH_BANDS)]
+
+
+def hamming_distance(first, second):
+    """Число различающихся битов"""
+    return (first ^ second).bit_count()
+
+
+def is_verified(candidate, fingerprint):
+    """Совпадение pHash подтверждается размерами и dHash: страницы с похожей версткой различаются ими"""
+    if not candidate.verify_hash:
+        return False  # запись без проверочного хэша не сравнить надежно
+    if (candidate.width, candidate.height) != (fingerprint['width'], fingerprint['height']):
+        return False
+    distance = hamming_distance(fingerprint['dhash'], int(candidate.verify_hash, 16))
+    return distance <= settings.OCR_CACHE_MAX_VERIFY_DISTANCE
+
+
+def find_cached_text(fingerprint):
+    """Найти распознанный текст для того же изображения или None"""
+    if not settings.OCR_CACHE_ENABLED or fingerprint is None:
+        return None
+
+    image_hash = fingerprint['phash']
+    bands = hash_bands(image_hash)
+    band_filters = {f'hash_band_{index}': band for index, band in enumerate(bands)}
+    # Сначала тот же хэш (все полосы совпадают, поиск по индексам): повторная отправка того же фото
+    # не должна теряться среди похожих страниц за пределами MAX_CANDIDATES
+    for candidate in OcrResult.objects.filter(**band_filters).order_by('-last_used_at')[:MAX_CANDIDATES]:
+        if is_verified(candidate, fingerprint):
+            return _use(candidate, 0)
+
+    max_distance = settings.OCR_CACHE_MAX_DISTANCE
+    if not max_distance:
+        metrics.incr('ocr_cache.misses')
+        return None
+    # Если хэши отличаются не более чем на 3 бита, хотя бы одна из 4 полос совпадает точно,
+    # поэтому поиск по индексам полос полный для порогов до HASH_BANDS - 1
+    query = Q()
+    for field, band in band_filters.items():
+        query |= Q(**{field: band})
+    near = OcrResult.objects.filter(query).exclude(image_hash=f'{image_hash:016x}').order_by('-last_used_at')
+
+    best = None
+    best_distance = None
+    for candidate in near[:MAX_CANDIDATES]:
+        distance = hamming_distance(image_hash, int(candidate.image_hash, 16))
+        if distance > max_distance or (best is not None and distance >= best_distance):
+            continue
+        if is_verified(candidate, fingerprint):
+            best, best_distance = candidate, distance
+
+    if best is None:
+        metrics.incr('ocr_cache.misses')
+        return None
+    return _use(best, best_distance)
+
+
+def _use(candidate, distance):
+    """Отметить попадание и вернуть текст записи"""
+    OcrResult.objects.filter(pk=candidate.pk).update(hits=F('hits') + 1, last_used_at=timezone.now())
+    metrics.incr('ocr_cache.hits')
+    logger.info(f"Текст найден в OCR-кэше (расстояние {distance}): {candidate.image_hash}")
+    return candidate.text
+
+
+def store_text(fingerprint, text):
+    """Сохранить распознанный текст для изображения"""
+    if not settings.OCR_CACHE_ENABLED or fingerprint is None or not text:
+        return
+
+    image_hash = fingerprint['phash']
+    bands = hash_bands(image_hash)
+    result = OcrResult.objects.create(
+        image_hash=f'{image_hash:016x}',
+        hash_band_0=bands[0],
+        hash_band_1=bands[1],
+        hash_band_2=bands[2],
+        hash_band_3=bands[3],
+        verify_hash=f"{fingerprint['dhash']:016x}",
+        width=fingerprint['width'],
+        height=fingerprint['height'],
+        text=text,
+    )
+    # Чистка не на каждой записи: удаление по индексу дешевое, но незачем делать его постоянно
+    if result.pk % settings.OCR_CACHE_PRUNE_EVERY == 0:
+        prune_ocr_cache()
+
+
+def prune_ocr_cache():
+    """Удалить записи, не использованные за OCR_CACHE_TTL, и самые старые сверх OCR_CACHE_MAX_ENTRIES"""
+    expired = timezone.now() - timedelta(seconds=settings.OCR_CACHE_TTL)
+    removed, _ = OcrResult.objects.filter(last_used_at__lt=expired).delete()
+    # Граница по last_used_at самой старой из оставляемых записей
+    boundary = (
+        OcrResult.objects.order_by('-last_used_at', '-pk')
+        .values_list('last_used_at', 'pk')[settings.OCR_CACHE_MAX_ENTRIES:settings.OCR_CACHE_MAX_ENTRIES + 1]
+    )
+    if boundary:
+        last_used_at, pk = boundary[0]
+        over_limit, _ = OcrResult.objects.filter(
+            Q(last_used_at__lt=last_used_at) | Q(last_used_at=last_used_at, pk__lte=pk)
+        ).delete()
+        removed += over_limit
+    if removed:
+        metrics.incr('ocr_cache.pruned', removed)
+        logger.info(f"Из OCR-кэша удалено записей: {removed}")
+    return removed
+
+
+def ocr_cache_stats():
+    """Счетчики попаданий и промахов OCR-кэша"""
+    counters = metrics.get_counters(['ocr_cache.hits', 'ocr_cache.misses', 'ocr_cache.pruned'])
+    hits = counters['ocr_cache.hits']
+    misses = counters['ocr_cache.misses']
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': metrics.hit_rate(hits, misses),
+        'pruned': counters['ocr_cache.pruned'],
+        'entries': OcrResult.objects.count(),
+    }
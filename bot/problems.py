@@ -0,0 +1,76 @@
+import logging
+import math
+import re
+from django.conf import settings
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Начало пронумерованной задачи в строке: «1)», «2.», «№ 3», «Задача 4:», «Упражнение 5.»
+# Для «1.» нужен пробел после точки, чтобы не принять за номер десятичную дробь «1.5 + 2»
+ITEM_RE = re.compile(
+    r'^[ \t]*(?:(?:№|задача|задание|упражнение|пример|exercise|problem)[ \t]*(\d{1,3})[ \t]*[.):]?'
+    r'|(\d{1,3})(?:\)|\.(?=\s)))',
+    re.IGNORECASE | re.MULTILINE,
+)
+
+# Пункты системы или совокупности уравнений — одна задача, по частям их не решить
+SYSTEM_RE = re.compile(r'систем|совокупност|\{', re.IGNORECASE)
+
+# Повелительный глагол задания: пункт без него и без общего условия может оказаться частью одной задачи
+INSTRUCTION_RE = re.compile(
+    r'\b(?:реш|найд|вычисл|упрост|докаж|постро|сократ|разлож|представ|сравн|определ|исследу|запиш'
+    r'|выполн|преобраз|вырази|провер|привед|раскро|вынес|solve|find|comput|calculat|simplif|prove'
+    r'|evaluat|determin)',
+    re.IGNORECASE,
+)
+
+
+def split_problems(text):
+    """Разбить текст на пронумерованные задачи: список {'label', 'item', 'text'} или пустой список"""
+    if not settings.PROBLEM_FANOUT_ENABLED or not text:
+        return []
+
+    # Задачами считаем только номера, идущие подряд: «3)» внутри условия задачи 1 не разрывает ее
+    starts = []
+    for match in ITEM_RE.finditer(text):
+        number = int(match.group(1) or match.group(2))
+        if not starts or number == starts[-1][0] + 1:
+            starts.append((number, match.start()))
+    if len(starts) < 2:
+        return []
+
+    # Общее условие перед списком («Решите уравнения:») нужно каждой задаче
+    preamble = text[:starts[0][1]].strip()
+    if SYSTEM_RE.search(preamble):
+        return []
+
+    bounds = [position for _, position in starts] + [len(text)]
+    items = [(str(number), text[start:end].strip()) for (number, _), start, end in zip(starts, bounds, bounds[1:])]
+    # Каждая задача получает задание из общего условия или из своего пункта
+    if not INSTRUCTION_RE.search(preamble) and not all(INSTRUCTION_RE.search(item) for _, item in items):
+        return []
+
+    # Соседние задачи решаются вместе, если их больше PROBLEM_FANOUT_MAX
+    size = math.ceil(len(items) / settings.PROBLEM_FANOUT_MAX)
+    groups = [items[index:index + size] for index in range(0, len(items), size)]
+
+    problems = []
+    for group in groups:
+        label = group[0][0] if len(group) == 1 else f'{group[0][0]}–{group[-1][0]}'
+        item = '\n'.join(item for _, item in group)
+        problems.append({
+            'label': label,
+            'item': item,
+            'text': f'{preamble}\n{item}' if preamble else item,
+        })
+    return problems
+
+
+def fanout_stats():
+    """Сколько задач решено параллельно по частям"""
+    counters = metrics.get_counters(['fanout.tasks', 'fanout.problems'])
+    return {
+        'tasks': counters['fanout.tasks'],
+        'problems': counters['fanout.problems'],
+    }
@@ -0,0 +1,175 @@
+import logging
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import caches
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+STATE_KEY = 'ratelimit:openai:state'
+LOCK_KEY = 'ratelimit:openai:lock'
+LOCK_TTL = 5
+LOCK_POLL = 0.005
+
+
+class RateLimitExceeded(Exception):
+    """Лимит не освободился за допустимое время ожидания"""
+
+    def __init__(self, wait, message=None):
+        super().__init__(message or f"Лимит запросов к OpenAI: ожидание {wait:.1f} с превышает допустимое")
+        self.wait = wait
+
+
+class LockTimeout(RateLimitExceeded):
+    """Блокировка общего состояния лимитера не освободилась за LOCK_TTL"""
+
+    def __init__(self, key):
+        super().__init__(LOCK_TTL, f"Блокировка {key} не освободилась за {LOCK_TTL} с")
+
+
+def _cache():
+    return caches[settings.LLM_RATE_LIMIT_CACHE]
+
+
+@contextmanager
+def cache_lock(key):
+    """Короткая взаимная блокировка общего состояния между процессами через кэш лимитера (общий кэш — Redis)"""
+    cache = _cache()
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + LOCK_TTL
+    while not cache.add(key, token, timeout=LOCK_TTL):
+        if time.monotonic() > deadline:
+            # Ключ умершего держателя истекает за LOCK_TTL: если он все еще занят, кэш перегружен
+            # или недоступен, и работа без блокировки только превысила бы общий лимит
+            metrics.incr('ratelimit.lock_timeouts')
+            raise LockTimeout(key)
+        time.sleep(LOCK_POLL)
+    try:
+        yield cache
+    finally:
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+def _load_state(cache, now):
+    state = cache.get(STATE_KEY)
+    if state is None:
+        state = {
+            'requests': float(settings.LLM_RATE_LIMIT_RPM),
+            'tokens': float(settings.LLM_RATE_LIMIT_TPM),
+            'updated_at': now,
+            'limit': float(settings.LLM_CONCURRENCY_INITIAL),
+            'leases': {},
+        }
+
+    # Пополняем оба ведра пропорционально прошедшему времени
+    elapsed = max(0.0, now - state['updated_at'])
+    state['requests'] = min(settings.LLM_RATE_LIMIT_RPM, state['requests'] + elapsed * settings.LLM_RATE_LIMIT_RPM / 60)
+    state['tokens'] = min(settings.LLM_RATE_LIMIT_TPM, state['tokens'] + elapsed * settings.LLM_RATE_LIMIT_TPM / 60)
+    state['updated_at'] = now
+    # Аренды упавших процессов истекают и не занимают слоты конкурентности навсегда
+    state['leases'] = {lease: expires for lease, expires in state['leases'].items() if expires > now}
+    return state
+
+
+def _try_acquire(tokens):
+    """Взять слот и токены; вернуть (идентификатор аренды, 0) или (None, сколько ждать)"""
+    now = time.time()
+    with cache_lock(LOCK_KEY) as cache:
+        state = _load_state(cache, now)
+
+        waits = []
+        if state['requests'] < 1:
+            waits.append((1 - state['requests']) * 60 / settings.LLM_RATE_LIMIT_RPM)
+        # Запрос больше емкости ведра ждет его заполнения целиком, а не вечно
+        needed = min(tokens, settings.LLM_RATE_LIMIT_TPM)
+        if state['tokens'] < needed:
+            waits.append((needed - state['tokens']) * 60 / settings.LLM_RATE_LIMIT_TPM)
+        if len(state['leases']) >= int(state['limit']):
+            waits.append(0.1)
+
+        if waits:
+            cache.set(STATE_KEY, state, timeout=None)
+            return None, max(waits)
+
+        lease = uuid.uuid4().hex
+        state['requests'] -= 1
+        state['tokens'] -= tokens
+        state['leases'][lease] = now + settings.LLM_TIMEOUT * 2
+        cache.set(STATE_KEY, state, timeout=None)
+        return lease, 0.0
+
+
+def acquire(tokens):
+    """Дождаться разрешения на запрос к OpenAI с учетом RPM, TPM и конкурентности"""
+    if not settings.LLM_RATE_LIMIT_ENABLED:
+        return None
+
+    started = time.monotonic()
+    deadline = started + settings.LLM_RATE_LIMIT_MAX_WAIT
+    while True:
+        lease, wait = _try_acquire(tokens)
+        if lease is not None:
+            metrics.observe('llm.limiter_wait', time.monotonic() - started)
+            return {'lease': lease, 'tokens': tokens, 'started': time.monotonic()}
+
+        if time.monotonic() + wait > deadline:
+            metrics.incr('llm.limiter_rejected')
+            raise RateLimitExceeded(wait)
+        # Небольшой джиттер, чтобы воркеры не просыпались одновременно
+        time.sleep(min(wait, 1.0) * random.uniform(1.0, 1.2))
+
+
+def release(permit, used_tokens=None, rate_limited=False, failed=False):
+    """Вернуть слот и скорректировать конкурентность по принципу AIMD"""
+    if permit is None:
+        return
+
+    latency = time.monotonic() - permit['started']
+    now = time.time()
+    try:
+        with cache_lock(LOCK_KEY) as cache:
+            state = _load_state(cache, now)
+            state['leases'].pop(permit['lease'], None)
+
+            # Возвращаем в ведро разницу между оценкой и фактическим расходом токенов
+            if used_tokens is not None:
+                state['tokens'] = min(settings.LLM_RATE_LIMIT_TPM, state['tokens'] + permit['tokens'] - used_tokens)
+
+            limit = state['limit']
+            if rate_limited:
+                # 429: мультипликативное снижение
+                limit *= settings.LLM_CONCURRENCY_DECREASE
+            elif not failed and latency > settings.LLM_LATENCY_TARGET:
+                # Рост задержки — признак перегрузки, снижаем мягче
+                limit *= settings.LLM_CONCURRENCY_LATENCY_DECREASE
+            elif not failed:
+                # Успех: аддитивный рост примерно на 1 слот за каждые limit запросов
+                limit += 1 / limit
+            state['limit'] = max(settings.LLM_CONCURRENCY_MIN, min(settings.LLM_CONCURRENCY_MAX, limit))
+            cache.set(STATE_KEY, state, timeout=None)
+    except LockTimeout as exc:
+        # Аренда истечет сама через LLM_TIMEOUT * 2, а ошибка освобождения не должна ронять готовый ответ
+        logger.warning(f"Слот лимитера не освобожден: {exc}")
+        return
+
+    if rate_limited:
+        metrics.incr('llm.rate_limited')
+        logger.warning(f"OpenAI вернул 429, лимит конкурентности снижен до {state['limit']:.1f}")
+
+
+def limiter_stats():
+    """Текущее состояние лимитера и метрики ожидания"""
+    state = _cache().get(STATE_KEY) or {}
+    counters = metrics.get_counters(['llm.rate_limited', 'llm.limiter_rejected', 'ratelimit.lock_timeouts'])
+    return {
+        'concurrency_limit': round(state.get('limit', settings.LLM_CONCURRENCY_INITIAL), 2),
+        'in_flight': len(state.get('leases', {})),
+        'rate_limited': counters['llm.rate_limited'],
+        'rejected': counters['llm.limiter_rejected'],
+        'lock_timeouts': counters['ratelimit.lock_timeouts'],
+        'wait': metrics.histogram('llm.limiter_wait'),
+    }
@@ -0,0 +1,324 @@
+import functools
+import html
+import io
+import logging
+import multiprocessing
+import re
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from django.conf import settings
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+from . import metrics
+from .streaming import split_steps
+
+logger = logging.getLogger(__name__)
+
+TAG_RE = re.compile(r'<[^>]+>')
+LABEL_RE = re.compile(r'^\s*<strong>(.*?)</strong>\s*', re.DOTALL)
+
+# Формулы: LaTeX из ответов модели (то же, что WebApp показывает через KaTeX) -> Unicode
+MATH_DELIMITERS_RE = re.compile(r'\$\$|\$|\\\(|\\\)|\\\[|\\\]')
+FRAC_RE = re.compile(r'\\[dt]?frac\{([^{}]*)\}\{([^{}]*)\}')
+SQRT_RE = re.compile(r'\\sqrt\{([^{}]*)\}')
+SUPERSCRIPT_RE = re.compile(r'\^\{([^{}]*)\}|\^([0-9a-zA-Z+\-=()])')
+SUBSCRIPT_RE = re.compile(r'_\{([^{}]*)\}|_([0-9+\-=()])')
+SIMPLE_OPERAND_RE = re.compile(r'^[\w.²³√]+$')
+LATEX_SYMBOLS = {
+    r'\cdot': '·', r'\times': '×', r'\div': '÷', r'\pm': '±', r'\mp': '∓',
+    r'\leq': '≤', r'\le': '≤', r'\geq': '≥', r'\ge': '≥', r'\neq': '≠', r'\ne': '≠', r'\approx': '≈',
+    r'\infty': '∞', r'\pi': 'π', r'\alpha': 'α', r'\beta': 'β', r'\gamma': 'γ', r'\Delta': 'Δ', r'\delta': 'δ',
+    r'\lambda': 'λ', r'\mu': 'μ', r'\varphi': 'φ', r'\phi': 'φ', r'\omega': 'ω', r'\rho': 'ρ', r'\sigma': 'σ',
+    r'\theta': 'θ', r'\angle': '∠', r'\degree': '°', r'\circ': '°', r'\Rightarrow': '⇒', r'\to': '→',
+    r'\left': '', r'\right': '', r'\,': ' ', r'\;': ' ', r'\quad': '  ', r'\{': '{', r'\}': '}',
+}
+LATEX_SYMBOL_RE = re.compile('|'.join(re.escape(name) + (r'(?![a-zA-Z])' if name[-1].isalpha() else '')
+                                      for name in sorted(LATEX_SYMBOLS, key=len, reverse=True)))
+LATEX_TEXT_RE = re.compile(r'\\(?:text|mathrm|mathbf|operatorname)\{([^{}]*)\}')
+SUPERSCRIPTS = str.maketrans('0123456789+-=()n', '⁰¹²³⁴⁵⁶⁷⁸⁹⁺⁻⁼⁽⁾ⁿ')
+SUBSCRIPTS = str.maketrans('0123456789+-=()', '₀₁₂₃₄₅₆₇₈₉₊₋₌₍₎')
+
+IMAGE_FORMATS = {'png': 'image/png', 'webp': 'image/webp'}
+BYTES_BUCKETS_KB = [5, 10, 25, 50, 100, 200, 500, 1000, 2000]
+
+# Пул процессов рендеринга, создается при первом изображении
+_pool = None
+_pool_lock = threading.Lock()
+
+
+class RenderBusy(Exception):
+    """Пул рендеринга не успел нарисовать изображение за SOLUTION_RENDER_TIMEOUT: запрос стоит повторить позже"""
+
+
+def _script(text, table):
+    """Текст в верхнем/нижнем индексе, если для всех символов есть Unicode-вариант"""
+    converted = text.translate(table)
+    if all(source != target or source == ' ' for source, target in zip(text, converted)):
+        return converted
+    return None
+
+
+def _operand(text):
+    return text if SIMPLE_OPERAND_RE.match(text) else f'({text})'
+
+
+def format_formulas(text):
+    """LaTeX-фрагменты и ^/_ в обычной записи решений -> Unicode: ², ₁, √, дроби через /"""
+    text = MATH_DELIMITERS_RE.sub('', text)
+    text = LATEX_TEXT_RE.sub(r'\1', text)
+    # Вложенные \frac и \sqrt раскрываются изнутри наружу
+    for _ in range(5):
+        replaced = FRAC_RE.sub(lambda match: f'{_operand(match.group(1))}/{_operand(match.group(2))}', text)
+        replaced = SQRT_RE.sub(lambda match: f'√{_operand(match.group(1))}', replaced)
+        if replaced == text:
+            break
+        text = replaced
+    text = LATEX_SYMBOL_RE.sub(lambda match: LATEX_SYMBOLS[match.group(0)], text)
+
+    def superscript(match):
+        value = match.group(1) if match.group(1) is not None else match.group(2)
+        return _script(value, SUPERSCRIPTS) or f'^({value})'
+
+    def subscript(match):
+        value = match.group(1) if match.group(1) is not None else match.group(2)
+        return _script(value, SUBSCRIPTS) or f'_{value}'
+
+    text = SUPERSCRIPT_RE.sub(superscript, text)
+    text = SUBSCRIPT_RE.sub(subscript, text)
+    text = text.replace('sqrt', '√').replace('{', '').replace('}', '')
+    return re.sub(r'[ \t]+', ' ', text).strip()
+
+
+def parse_solution(solution):
+    """HTML решения -> список (метка шага, текст) для отрисовки"""
+    steps = split_steps(solution)
+    if not steps:
+        # Ответ без списка: каждая непустая строка — отдельный абзац
+        plain = TAG_RE.sub('', re.sub(r'<br\s*/?>', '\n', solution or ''))
+        return [('', format_formulas(html.unescape(line))) for line in plain.splitlines() if line.strip()]
+
+    blocks = []
+    for step in steps:
+        body = re.sub(r'^<li[^>]*>|</li>$', '', step.strip())
+        label_match = LABEL_RE.match(body)
+        label = ''
+        if label_match:
+            label = html.unescape(TAG_RE.sub('', label_match.group(1))).strip()
+            body = body[label_match.end():]
+        blocks.append((label, format_formulas(html.unescape(TAG_RE.sub('', body)))))
+    return blocks
+
+
+@functools.lru_cache(maxsize=8)
+def get_font(style, size):
+    """Шрифт загружается один раз на процесс; первый найденный из SOLUTION_IMAGE_FONTS"""
+    for name in settings.SOLUTION_IMAGE_FONTS[style]:
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    # Встроенный шрифт Pillow масштабируется, но без кириллицы
+    logger.warning(f"Ни один шрифт из SOLUTION_IMAGE_FONTS['{style}'] не найден, используется встроенный")
+    return ImageFont.load_default(size)
+
+
+def wrap_text(text, font, width):
+    """Перенос по словам в пределах ширины; слишком длинное слово режется по символам"""
+    # Каждое слово измеряется один раз: ширина строки — сумма слов и пробелов
+    space = font.getlength(' ')
+    lines = []
+    current, current_width = [], 0.0
+    for word in text.split(' '):
+        word_width = font.getlength(word)
+        if current and current_width + space + word_width <= width:
+            current.append(word)
+            current_width += space + word_width
+            continue
+        if current:
+            lines.append(' '.join(current))
+        # Длинная формула без пробелов переносится по символам (двоичный поиск места разреза)
+        while word_width > width and len(word) > 1:
+            low, high = 1, len(word) - 1
+            while low < high:
+                middle = (low + high + 1) // 2
+                if font.getlength(word[:middle]) <= width:
+                    low = middle
+                else:
+                    high = middle - 1
+            lines.append(word[:low])
+            word = word[low:]
+            word_width = font.getlength(word)
+        current, current_width = [word], word_width
+    if current:
+        lines.append(' '.join(current))
+    return lines or ['']
+
+
+def layout(blocks, regular, bold, width, padding):
+    """Строки для отрисовки: (x, текст, метка шага или None) с висячим отступом после метки"""
+    text_width = width - 2 * padding
+    rows = []
+    for label, text in blocks:
+        indent = 0
+        if label:
+            indent = bold.getlength(label + ' ')
+        # Метка шага жирная, текст шага переносится с отступом под ней
+        available = max(text_width - indent, text_width // 2)
+        lines = wrap_text(text, regular, available)
+        for index, line in enumerate(lines):
+            rows.append((padding + indent, line, label if index == 0 and label else None))
+        rows.append(None)  # интервал между шагами
+    return rows
+
+
+def _is_gray(color):
+    red, green, blue = ImageColor.getrgb(color)[:3]
+    return red == green == blue
+
+
+def draw_solution(solution, variant='full'):
+    """Холст с решением: шрифты из кэша процесса, высота по тексту, перенос строк и формулы"""
+    options = settings.SOLUTION_IMAGE_VARIANTS[variant]
+    width, size, padding = options['width'], options['font_size'], options['padding']
+    regular, bold = get_font('regular', size), get_font('bold', size)
+    line_height = round(size * settings.SOLUTION_IMAGE_LINE_SPACING)
+    step_gap = line_height // 2
+
+    rows = layout(parse_solution(solution), regular, bold, width, padding)
+    height = padding * 2 + sum(line_height if row else step_gap for row in rows)
+    # Очень длинные решения обрезаются, чтобы один ответ не съел память воркера
+    max_height = settings.SOLUTION_IMAGE_MAX_HEIGHT
+    truncated = height > max_height
+    height = min(height, max_height)
+
+    # Серые цвета текста — рисуем в оттенках серого: втрое меньше пикселей для кодирования
+    colors = (settings.SOLUTION_IMAGE_TEXT_COLOR, settings.SOLUTION_IMAGE_LABEL_COLOR)
+    mode = 'L' if all(_is_gray(color) for color in colors) else 'RGB'
+    image = Image.new(mode, (width, max(height, padding * 2 + line_height)), 'white')
+    draw = ImageDraw.Draw(image)
+    y = padding
+    for row in rows:
+        if row is None:
+            y += step_gap
+            continue
+        if y + line_height * (2 if truncated else 1) > height - padding:
+            draw.text((padding, y), '…', fill=settings.SOLUTION_IMAGE_TEXT_COLOR, font=regular)
+            break
+        x, line, label = row
+        if label:
+            draw.text((padding, y), label, fill=settings.SOLUTION_IMAGE_LABEL_COLOR, font=bold)
+        draw.text((x, y), line, fill=settings.SOLUTION_IMAGE_TEXT_COLOR, font=regular)
+        y += line_height
+    return image
+
+
+def _encode(image, colors, image_format):
+    """Изображение в палитре из colors цветов: текст на белом — это в основном оттенки сглаживания"""
+    # FASTOCTREE в разы быстрее MEDIANCUT, но работает только с RGB
+    method = Image.Quantize.FASTOCTREE if image.mode == 'RGB' else Image.Quantize.MEDIANCUT
+    image = image.quantize(colors=colors, method=method, dither=Image.Dither.NONE)
+    output = io.BytesIO()
+    if image_format == 'webp':
+        image.save(output, format='WEBP', lossless=True, method=settings.SOLUTION_IMAGE_WEBP_METHOD)
+    else:
+        image.save(output, format='PNG', compress_level=settings.SOLUTION_IMAGE_PNG_COMPRESS_LEVEL)
+    return output.getvalue()
+
+
+def render_solution(solution, variant='full', image_format='png'):
+    """Изображение решения в PNG или WebP; палитра сокращается, пока файл не уложится в max_bytes варианта"""
+    image = draw_solution(solution, variant)
+    max_bytes = settings.SOLUTION_IMAGE_VARIANTS[variant]['max_bytes']
+    smallest = None
+    for colors in settings.SOLUTION_IMAGE_PALETTE_STEPS:
+        encoded = _encode(image, colors, image_format)
+        if len(encoded) <= max_bytes:
+            return encoded
+        if smallest is None or len(encoded) < len(smallest):
+            smallest = encoded
+    # Даже самая короткая палитра не уложилась (очень длинное решение): отдаем наименьший вариант
+    metrics.incr('render.over_budget')
+    return smallest
+
+
+def _init_worker():
+    """Процесс пула: Django и шрифты загружаются один раз, а не на каждое изображение"""
+    import django
+    django.setup()
+    for options in settings.SOLUTION_IMAGE_VARIANTS.values():
+        get_font('regular', options['font_size'])
+        get_font('bold', options['font_size'])
+
+
+def _get_pool():
+    """Пул процессов рендеринга или None, если процессы создать нельзя"""
+    global _pool
+    if settings.SOLUTION_RENDER_WORKERS <= 0:
+        return None
+    # Процессы prefork-пула Celery демонические и не могут порождать дочерние
+    if multiprocessing.current_process().daemon:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.SOLUTION_RENDER_WORKERS,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+            )
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def render_solution_image(solution, variant='full', image_format='png'):
+    """Изображение решения: в пуле процессов, а где он недоступен — в текущем процессе"""
+    started = time.monotonic()
+    image = None
+    pool = _get_pool()
+    if pool is not None:
+        future = pool.submit(render_solution, solution, variant, image_format)
+        try:
+            image = future.result(timeout=settings.SOLUTION_RENDER_TIMEOUT)
+            metrics.incr('render.pool')
+        except FutureTimeoutError:
+            # Пул занят или изображение рисуется слишком долго: рисовать его же здесь значило бы
+            # занять еще и веб-поток на то же время
+            future.cancel()
+            metrics.incr('render.busy')
+            raise RenderBusy(f"Изображение не нарисовано за {settings.SOLUTION_RENDER_TIMEOUT} с")
+        except BrokenProcessPool as e:
+            # Процесс пула упал (например, по памяти): пересоздадим пул при следующем вызове
+            logger.warning(f"Пул рендеринга сломан, рисуем в текущем процессе: {e}")
+            _reset_pool()
+        except Exception as e:
+            # Ошибка в процессе пула (шрифты, передача результата): ошибка самого решения повторится и здесь
+            logger.warning(f"Ошибка в пуле рендеринга, рисуем в текущем процессе: {e}")
+    if image is None:
+        metrics.incr('render.inline')
+        image = render_solution(solution, variant, image_format)
+    metrics.observe('render.latency', time.monotonic() - started)
+    metrics.observe_value(f'render.{image_format}_bytes', len(image) / 1024, BYTES_BUCKETS_KB, 'kb')
+    return image
+
+
+def render_stats():
+    """Где рисовались изображения решений, сколько это заняло и сколько весят файлы"""
+    counters = metrics.get_counters(['render.pool', 'render.inline', 'render.busy', 'render.over_budget'])
+    return {
+        'pool': counters['render.pool'],
+        'inline': counters['render.inline'],
+        'busy': counters['render.busy'],
+        'over_budget': counters['render.over_budget'],
+        'latency': metrics.histogram('render.latency'),
+        'bytes': {
+            image_format: metrics.histogram(f'render.{image_format}_bytes', buckets=BYTES_BUCKETS_KB, unit='kb')
+            for image_format in IMAGE_FORMATS
+        },
+    }
@@ -0,0 +1,80 @@
+import logging
+import re
+from django.conf import settings
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+OPERATOR_RE = re.compile(r'[-+*/×÷:=^²³√<>≤≥]')
+GRADE_RE = re.compile(r'(\d{1,2})\s*(?:-?й\s*)?класс', re.IGNORECASE)
+# Темы, где нужен длинный вывод или аккуратная физическая модель: корни слов, чтобы ловить падежи
+HEAVY_SUBJECTS_RE = re.compile(
+    r'физик|скорост|ускорен|сил[аы]|масс[аы]|энерги|давлен|ток[аи]?\b|напряжен|сопротивлен'
+    r'|хими|моль|реакци|раствор'
+    r'|интеграл|производн|предел|логарифм|\blog|\bln|\bsin|\bcos|\btg|\bctg'
+    r'|вероятност|докаж|доказ|теорем|систем[аеуы]|неравенств|параметр|прогресси',
+    re.IGNORECASE,
+)
+
+
+def difficulty_score(text):
+    """Грубая оценка сложности задачи: длина, число операций, тема и класс"""
+    text = text or ''
+    score = len(text) // settings.LLM_ROUTING_CHARS_PER_POINT
+    score += len(OPERATOR_RE.findall(text)) // settings.LLM_ROUTING_OPERATORS_PER_POINT
+    score += 2 * len({match.group(0).lower() for match in HEAVY_SUBJECTS_RE.finditer(text)})
+
+    grade = GRADE_RE.search(text)
+    if grade:
+        grade = int(grade.group(1))
+        # Старшие классы — длиннее решения, начальная школа — короткие
+        score += 2 if grade >= 9 else 1 if grade >= 7 else -1 if grade <= 4 else 0
+    return score
+
+
+def choose_route(text):
+    """Маршрут для задачи: {'name', 'model', 'max_tokens'}; max_tokens растет с длиной условия"""
+    routes = settings.LLM_ROUTES
+    if settings.LLM_ROUTING_ENABLED:
+        score = difficulty_score(text)
+        # Первый маршрут, чей порог не ниже оценки; последний — для всего остального
+        name = next(
+            (name for name, route in routes.items() if route.get('max_score') is None or score <= route['max_score']),
+            list(routes)[-1],
+        )
+    else:
+        score, name = None, settings.LLM_DEFAULT_ROUTE
+    route = routes[name]
+
+    expected = route['min_tokens'] + len(text or '') * settings.LLM_ROUTING_TOKENS_PER_CHAR
+    max_tokens = max(route['min_tokens'], min(route['max_tokens'], expected))
+    logger.info(f"Маршрут {name} ({route['model']}, max_tokens {max_tokens}), оценка сложности {score}")
+    return {'name': name, 'model': route['model'], 'max_tokens': max_tokens}
+
+
+def record_route(route, seconds, truncated=False):
+    """Учесть запрос маршрута: число, задержка и ответы, обрезанные по max_tokens"""
+    metrics.incr(f"llm.route.{route['name']}.requests")
+    metrics.observe(f"llm.route.{route['name']}.latency", seconds)
+    if truncated:
+        metrics.incr(f"llm.route.{route['name']}.truncated")
+
+
+def routing_stats():
+    """Число запросов, обрезанные ответы и распределение задержки по маршрутам"""
+    names = list(settings.LLM_ROUTES)
+    counters = metrics.get_counters(
+        [f'llm.route.{name}.requests' for name in names] + [f'llm.route.{name}.truncated' for name in names]
+    )
+    return {
+        'enabled': settings.LLM_ROUTING_ENABLED,
+        'routes': {
+            name: {
+                'model': settings.LLM_ROUTES[name]['model'],
+                'requests': counters[f'llm.route.{name}.requests'],
+                'truncated': counters[f'llm.route.{name}.truncated'],
+                'latency': metrics.histogram(f'llm.route.{name}.latency'),
+            }
+            for name in names
+        },
+    }
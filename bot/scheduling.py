@@ -0,0 +1,80 @@
+import logging
+import time
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from . import metrics
+from .models import Task
+
+logger = logging.getLogger(__name__)
+
+# Статусы задач, которые еще занимают место в очереди
+ACTIVE_STATUSES = ['pending', 'preprocessing', 'recognizing', 'solving', 'parked']
+# Статусы задач, которые сейчас в очереди или у воркера
+RUNNING_STATUSES = ['pending', 'preprocessing', 'recognizing', 'solving']
+
+
+class DeadlineExceeded(Exception):
+    """Задача не уложилась в срок своей полосы и не может быть решена без внешних сервисов"""
+
+
+def choose_lane(has_subscription):
+    """Полоса приоритета: подписчики обслуживаются раньше пробных пользователей"""
+    return 'subscriber' if has_subscription else 'trial'
+
+
+def fair_priority(task, lane):
+    """Приоритет Celery внутри полосы с учетом очереди задач пользователя"""
+    config = settings.TASK_PRIORITY_LANES[lane]
+    backlog = Task.objects.filter(user_id=task.user_id, status__in=ACTIVE_STATUSES).count()
+    # Каждые weight незавершенных задач пользователя сдвигают его новые задачи на шаг вниз,
+    # поэтому 30 фото одного пользователя не вытесняют задачи остальных
+    offset = max(0, backlog - 1) // config['weight']
+    return min(config['base_priority'] + offset, config['lowest_priority'])
+
+
+def enqueue_task(task, has_subscription=None):
+    """Поставить задачу в очередь с приоритетом полосы и честным распределением по пользователям"""
+    from .tasks import process_task_image
+    
+    if has_subscription is None:
+        has_subscription = task.user.has_active_subscription
+    
+    lane = choose_lane(has_subscription)
+    priority = fair_priority(task, lane)
+    Task.objects.filter(id=task.id).update(lane=lane, priority=priority, queued_at=timezone.now())
+    
+    process_task_image.apply_async((str(task.id),), priority=priority)
+    logger.info(f"Задача {task.id} поставлена в очередь: полоса {lane}, приоритет {priority}")
+
+
+def task_deadline(lane, queued_at):
+    """Момент (timestamp), после которого задача полосы не ждет внешние сервисы"""
+    return queued_at + settings.TASK_DEADLINES[lane]
+
+
+def deadline_passed(state):
+    """Истек ли срок задачи из состояния цепочки"""
+    return time.time() > state.get('deadline', float('inf'))
+
+
+def record_queue_wait(state):
+    """Записать время ожидания в очереди до начала первого этапа"""
+    queued_at = state.pop('queued_at', None)
+    if queued_at is None:
+        return
+    metrics.observe(f"queue_wait.{state.get('lane', 'trial')}", max(0.0, time.time() - queued_at))
+
+
+def queue_wait_stats():
+    """Перцентили ожидания в очереди по полосам"""
+    return {lane: metrics.histogram(f'queue_wait.{lane}') for lane in settings.TASK_PRIORITY_LANES}
+
+
+def resumable_tasks(queryset):
+    """Задачи, которые можно вручную поставить в очередь заново: упавшие, отложенные и зависшие"""
+    stale_before = timezone.now() - timedelta(seconds=settings.TASK_STALE_AFTER)
+    # Задача в работе с недавней постановкой в очередь еще обрабатывается: повтор запустил бы ее дважды
+    stale = Q(status__in=RUNNING_STATUSES) & (Q(queued_at__lt=stale_before) | Q(queued_at__isnull=True))
+    return queryset.filter(Q(status__in=['failed', 'parked']) | stale)
@@ -1,4 +1,6 @@
+from django.urls import reverse
 from rest_framework import serializers
+from .image_cache import image_key
 from .models import User, Subscription, Task
 
 class UserSerializer(serializers.ModelSerializer):
@@ -28,14 +30,17 @@ class SubscriptionSerializer(serializers.ModelSerializer):
 
 class TaskSerializer(serializers.ModelSerializer):
     user_info = serializers.SerializerMethodField()
+    solution_image_url = serializers.SerializerMethodField()
+    solution_image_mobile_url = serializers.SerializerMethodField()
     
     class Meta:
         model = Task
         fields = [
             'id', 'user', 'user_info', 'description', 'image',
-            'created_at', 'status', 'solution', 'solution_image', 'completed_at'
+            'created_at', 'status', 'solution', 'solution_image', 'solution_image_url', 'solution_image_mobile_url',
+            'completed_at', 'error_message'
         ]
-        read_only_fields = ['id', 'created_at', 'completed_at']
+        read_only_fields = ['id', 'created_at', 'completed_at', 'error_message']
     
     def get_user_info(self, obj):
         return {
@@ -43,6 +48,23 @@ class TaskSerializer(serializers.ModelSerializer):
             'first_name': obj.user.first_name,
             'username': obj.user.username
         }
+    
+    def get_solution_image_url(self, obj):
+        """Ссылка на изображение решения: рисуется при первом запросе, версия в ссылке — для кэша браузера"""
+        return self.build_solution_image_url(obj, 'full')
+    
+    def get_solution_image_mobile_url(self, obj):
+        """Ссылка на уменьшенное изображение решения для телефонов"""
+        return self.build_solution_image_url(obj, 'mobile')
+    
+    def build_solution_image_url(self, obj, variant):
+        if obj.status != 'completed' or not obj.solution:
+            return None
+        url = f"{reverse('task-solution-image', args=[obj.id])}?v={image_key(obj.solution)}"
+        if variant != 'full':
+            url += f'&size={variant}'
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
 
 class TaskCreateSerializer(serializers.ModelSerializer):
     telegram_id = serializers.IntegerField(write_only=True)
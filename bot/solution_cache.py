@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import re
+import unicodedata
+from django.conf import settings
+from django.core.cache import caches
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+SOLUTION_CACHE = 'solutions'
+
+# Верхние индексы переводим в явную степень до NFKC, иначе x² превратится в x2
+SUPERSCRIPTS = {
+    '⁰': '0', '¹': '1', '²': '2', '³': '3', '⁴': '4',
+    '⁵': '5', '⁶': '6', '⁷': '7', '⁸': '8', '⁹': '9',
+    '⁺': '+', '⁻': '-', '⁽': '(', '⁾': ')', 'ⁿ': 'n',
+}
+
+# Математические символы, которые пользователи и OCR пишут по-разному
+MATH_SYMBOLS = {
+    '×': '*', '·': '*', '∙': '*', '⋅': '*', '∗': '*',
+    '÷': '/', '∕': '/', '⁄': '/',
+    '−': '-', '–': '-', '—': '-', '‐': '-', '‑': '-',
+    '≤': '<=', '⩽': '<=', '≥': '>=', '⩾': '>=', '≠': '!=',
+    '√': 'sqrt', '∛': 'cbrt', 'π': 'pi', '∞': 'inf',
+    '«': '"', '»': '"', '“': '"', '”': '"', '„': '"',
+    '‘': "'", '’': "'", 'ё': 'е',
+}
+
+SUPERSCRIPT_RE = re.compile('[' + ''.join(SUPERSCRIPTS) + ']+')
+# Число с разделителями тысяч: 1 000 000 -> 1000000. Обычный пробел по правилам набора ставят
+# только в числах от 10 000, поэтому «корни 1 100» — это два числа, а не 1100
+THOUSANDS_RE = re.compile(r'(?<![\d.,])\d{1,3}(?:[ \u00a0\u2009\u202f]\d{3})+(?!\d)')
+THIN_SPACES = '\u00a0\u2009\u202f'
+# Десятичная запятая: 3,5 -> 3.5 (но не перечисления вида 1,2,3 и не пары в скобках вроде (2,3))
+DECIMAL_COMMA_RE = re.compile(r'(?<![\d,])(\d+),(\d+)(?![,\d])')
+BRACKETS = {'(': ')', '[': ']', '{': '}'}
+# Незначащие нули в дробной части: 2.50 -> 2.5, 3.0 -> 3
+TRAILING_ZEROS_RE = re.compile(r'(?<![\d.])(\d+)\.(\d*?)0+(?![\d.])')
+# Пробелы вокруг операторов и скобок не влияют на смысл
+OPERATOR_SPACES_RE = re.compile(r'\s*([-+*/^=<>!()\[\]{},;:])\s*')
+WHITESPACE_RE = re.compile(r'\s+')
+# Слова из двух и более букв; отдельные буквы — переменные, в формулах V и v различаются
+WORD_RE = re.compile(r'[^\W\d_]{2,}')
+
+
+def _replace_superscripts(match):
+    return '^' + ''.join(SUPERSCRIPTS[char] for char in match.group(0))
+
+
+def _casefold_word(match):
+    word = match.group(0)
+    # Обозначения вроде ABC или xY — имена точек и произведения переменных, их регистр значим
+    if word[1:].islower() or (word.isupper() and not word.isascii()):
+        return word.casefold()
+    return word
+
+
+def _join_thousands(match):
+    number = match.group(0)
+    digits = re.sub(r'\D', '', number)
+    # Неразрывный или узкий пробел — явный разделитель тысяч, обычный — только в числах от 5 цифр
+    if len(digits) >= 5 or (len(digits) >= 4 and all(char in THIN_SPACES for char in re.sub(r'\d', '', number))):
+        return digits
+    return number
+
+
+def _replace_decimal_commas(text):
+    """Десятичные запятые только вне скобок: внутри скобок запятая разделяет элементы"""
+    parts = []
+    depth = 0
+    start = 0
+    for index, char in enumerate(text):
+        if char in BRACKETS:
+            if depth == 0:
+                parts.append(DECIMAL_COMMA_RE.sub(r'\1.\2', text[start:index]))
+                start = index
+            depth += 1
+        elif char in BRACKETS.values() and depth:
+            depth -= 1
+            if depth == 0:
+                parts.append(text[start:index + 1])
+                start = index + 1
+    tail = text[start:]
+    parts.append(tail if depth else DECIMAL_COMMA_RE.sub(r'\1.\2', tail))
+    return ''.join(parts)
+
+
+def normalize_problem_text(text):
+    """Нормализованная форма текста задачи для ключа кэша"""
+    text = SUPERSCRIPT_RE.sub(_replace_superscripts, text or '')
+    # До NFKC: он превращает неразрывный пробел в обычный
+    text = THOUSANDS_RE.sub(_join_thousands, text)
+    text = WORD_RE.sub(_casefold_word, unicodedata.normalize('NFKC', text))
+    text = ''.join(MATH_SYMBOLS.get(char, char) for char in text)
+    text = _replace_decimal_commas(text)
+    text = TRAILING_ZEROS_RE.sub(
+        lambda m: f'{m.group(1)}.{m.group(2)}' if m.group(2) else m.group(1), text
+    )
+    text = WHITESPACE_RE.sub(' ', text)
+    text = OPERATOR_SPACES_RE.sub(r'\1', text)
+    return text.strip(' .')
+
+
+def solution_cache_key(text):
+    """Ключ кэша: хэш нормализованного текста и версии промпта"""
+    normalized = normalize_problem_text(text)
+    digest = hashlib.sha256(normalized.encode('utf-8')).hexdigest()
+    return f'solution:{settings.SOLUTION_CACHE_VERSION}:{digest}'
+
+
+def get_cached_solution(text):
+    """Получить решение из кэша или None"""
+    if not settings.SOLUTION_CACHE_ENABLED or not (text or '').strip():
+        return None
+
+    cache = caches[SOLUTION_CACHE]
+    key = solution_cache_key(text)
+    try:
+        solution = cache.get(key)
+        if solution is not None:
+            # Продлеваем TTL при чтении, чтобы редко используемые записи вытеснялись первыми
+            cache.touch(key)
+    except Exception as e:
+        logger.warning(f"Кэш решений недоступен: {e}")
+        return None
+
+    if solution is None:
+        metrics.incr('solution_cache.misses')
+        return None
+
+    metrics.incr('solution_cache.hits')
+    logger.info(f"Решение найдено в кэше: {text[:50]}...")
+    return solution
+
+
+def store_solution(text, solution):
+    """Сохранить решение в кэш"""
+    if not settings.SOLUTION_CACHE_ENABLED or not solution:
+        return
+
+    try:
+        caches[SOLUTION_CACHE].set(solution_cache_key(text), solution)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить решение в кэш: {e}")
+
+
+def solution_cache_stats():
+    """Счетчики попаданий и промахов кэша решений"""
+    counters = metrics.get_counters(['solution_cache.hits', 'solution_cache.misses'])
+    hits = counters['solution_cache.hits']
+    misses = counters['solution_cache.misses']
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': metrics.hit_rate(hits, misses),
+    }
@@ -0,0 +1,193 @@
+import json
+import logging
+import re
+import threading
+import time
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+STREAM_PREFIX = 'task_stream:'
+# История событий нужна клиентам, подключившимся после начала решения
+STREAM_HISTORY_TTL = 60 * 60
+TERMINAL_STATUSES = ('completed', 'failed', 'retake')
+LOCAL_MAX_TASKS = 1000
+
+STEP_RE = re.compile(r'<li>.*?</li>', re.S)
+
+_redis_client = None
+_redis_lock = threading.Lock()
+
+# Локальная замена Redis: события и счетчики seq в памяти процесса (разработка, eager-режим Celery)
+_local_events = {}
+_local_seq = {}
+_local_condition = threading.Condition()
+
+
+def _get_redis():
+    """Клиент Redis для pub/sub или None, если используется локальная замена"""
+    global _redis_client
+    if not settings.CACHE_REDIS_URL:
+        return None
+    if _redis_client is None:
+        with _redis_lock:
+            if _redis_client is None:
+                import redis
+                _redis_client = redis.Redis.from_url(settings.CACHE_REDIS_URL)
+    return _redis_client
+
+
+def _keys(task_id):
+    base = f'{STREAM_PREFIX}{task_id}'
+    return f'{base}:channel', f'{base}:history', f'{base}:seq'
+
+
+def split_steps(solution):
+    """Разбить HTML решения на шаги <li>"""
+    return STEP_RE.findall(solution or '')
+
+
+def publish_event(task_id, event, data):
+    """Опубликовать событие задачи для SSE-подписчиков"""
+    if not settings.SOLUTION_STREAMING_ENABLED:
+        return
+
+    try:
+        client = _get_redis()
+        if client is None:
+            with _local_condition:
+                if str(task_id) not in _local_events and len(_local_events) >= LOCAL_MAX_TASKS:
+                    oldest = next(iter(_local_events))
+                    _local_events.pop(oldest)
+                    _local_seq.pop(oldest, None)
+                seq = _local_seq[str(task_id)] = _local_seq.get(str(task_id), 0) + 1
+                _local_events.setdefault(str(task_id), []).append({'seq': seq, 'event': event, 'data': data})
+                _local_condition.notify_all()
+            return
+
+        channel, history, seq_key = _keys(task_id)
+        seq = client.incr(seq_key)
+        payload = json.dumps({'seq': seq, 'event': event, 'data': data}, ensure_ascii=False)
+        pipe = client.pipeline()
+        pipe.rpush(history, payload)
+        pipe.expire(history, STREAM_HISTORY_TTL)
+        pipe.expire(seq_key, STREAM_HISTORY_TTL)
+        pipe.publish(channel, payload)
+        pipe.execute()
+    except Exception as e:
+        # Потоковая доставка — оптимизация, задача завершится и без нее
+        logger.warning(f"Не удалось опубликовать событие {event} для задачи {task_id}: {e}")
+
+
+def publish_step(task_id, index, html):
+    """Опубликовать готовый шаг решения"""
+    publish_event(task_id, 'step', {'index': index, 'html': html})
+
+
+def publish_status(task_id, status):
+    """Опубликовать смену статуса задачи"""
+    publish_event(task_id, 'status', {'status': status})
+
+
+def reset_steps(task_id):
+    """Перед повтором этапа убрать шаги из истории и попросить клиентов очистить уже показанные"""
+    if not settings.SOLUTION_STREAMING_ENABLED:
+        return
+
+    try:
+        client = _get_redis()
+        if client is None:
+            with _local_condition:
+                events = _local_events.get(str(task_id))
+                if events:
+                    events[:] = [event for event in events if event['event'] != 'step']
+        else:
+            _, history, _ = _keys(task_id)
+            kept = [raw for raw in client.lrange(history, 0, -1) if json.loads(raw)['event'] != 'step']
+            pipe = client.pipeline()
+            pipe.delete(history)
+            if kept:
+                pipe.rpush(history, *kept)
+                pipe.expire(history, STREAM_HISTORY_TTL)
+            pipe.execute()
+    except Exception as e:
+        logger.warning(f"Не удалось очистить историю шагов задачи {task_id}: {e}")
+    # seq не сбрасывается: подключенные клиенты продолжат с Last-Event-ID
+    publish_event(task_id, 'reset', {})
+
+
+def step_publisher(task_id):
+    """Функция-обработчик шагов для generate_solution или None"""
+    if not settings.SOLUTION_STREAMING_ENABLED:
+        return None
+
+    counter = {'index': 0}
+
+    def on_step(html):
+        counter['index'] += 1
+        publish_step(task_id, counter['index'], html)
+
+    return on_step
+
+
+def _is_terminal(event):
+    return event['event'] == 'status' and event['data'].get('status') in TERMINAL_STATUSES
+
+
+def listen(task_id, timeout, heartbeat, last_seq=0):
+    """Генератор событий задачи после last_seq; None означает паузу для heartbeat"""
+    client = _get_redis()
+    if client is None:
+        yield from _listen_local(task_id, timeout, heartbeat, last_seq)
+        return
+
+    channel, history, _ = _keys(task_id)
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+    # Сначала подписываемся, потом читаем историю, чтобы не потерять события между ними
+    pubsub.subscribe(channel)
+    try:
+        for raw in client.lrange(history, 0, -1):
+            event = json.loads(raw)
+            if event['seq'] <= last_seq:
+                continue
+            last_seq = event['seq']
+            yield event
+            if _is_terminal(event):
+                return
+
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            message = pubsub.get_message(timeout=heartbeat)
+            if message is None:
+                yield None
+                continue
+            event = json.loads(message['data'])
+            if event['seq'] <= last_seq:
+                continue
+            last_seq = event['seq']
+            yield event
+            if _is_terminal(event):
+                return
+    finally:
+        pubsub.close()
+
+
+def _listen_local(task_id, timeout, heartbeat, last_seq):
+    task_id = str(task_id)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with _local_condition:
+            if _local_seq.get(task_id, 0) <= last_seq:
+                _local_condition.wait(timeout=heartbeat)
+            # История могла сократиться при повторе этапа, поэтому новые события отбираются по seq
+            new_events = [event for event in _local_events.get(task_id, []) if event['seq'] > last_seq]
+            if new_events:
+                last_seq = new_events[-1]['seq']
+
+        if not new_events:
+            yield None
+            continue
+        for event in new_events:
+            yield event
+            if _is_terminal(event):
+                return
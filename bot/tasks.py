@@ -1,272 +1,506 @@
 import cv2
-import numpy as np
-from PIL import Image, ImageOps
-import io
+import time
+import json
 import base64
 import logging
-from celery import shared_task
+import mimetypes
+import openai
+from datetime import timedelta
+from celery import shared_task, chain, chord, group
+from celery.exceptions import Ignore
+from django.conf import settings
+from django.core.cache import caches
 from django.utils import timezone
+from django.utils.html import escape
 from django.core.files.base import ContentFile
+from . import metrics
 from .models import Task
-from config import OPENAI_API_KEY
-import openai
+from .imaging import ImageQualityError, check_quality, decode_image, extract_problem_region, preprocess, encode_for_vision
+from .solution_cache import get_cached_solution, store_solution
+from .ocr_cache import image_fingerprint, image_fingerprint_bytes, find_cached_text, store_text
+from .streaming import publish_event, publish_status, reset_steps, step_publisher, split_steps
+from .llm import chat_completion
+from .ocr import recognize
+from .ratelimit import RateLimitExceeded
+from .scheduling import DeadlineExceeded, deadline_passed, record_queue_wait, task_deadline
+from .breaker import CircuitOpen, is_available
+from .problems import split_problems
+from .local_solver import solve_locally
+from .routing import choose_route, record_route
+from .hedging import stream_completion
+from .telegram_dispatch import PRIORITY_LOW, deliver, enqueue_message
 
 logger = logging.getLogger(__name__)
 
+SOLUTION_PROMPT = """Ты - эксперт по решению математических задач. 
+                    Создавай краткие пошаговые решения в формате HTML с нумерованным списком.
+                    Используй обычный текст для формул (без $), но с правильными символами:
+                    - 2² вместо 2^2
+                    - 4/2 вместо дробей
+                    - × для умножения
+                    - √ для корня
+                    Формат ответа:
+                    <ol>
+                    <li><strong>Шаг 1:</strong> конкретное действие</li>
+                    <li><strong>Шаг 2:</strong> конкретное действие</li>
+                    <li><strong>Ответ:</strong> итоговый ответ</li>
+                    </ol>
+                    Делай решения максимально краткими. Каждый шаг - это одно конкретное действие или вычисление, без лишних объяснений."""
+
+# Совмещенный режим: текст задачи и решение в одном ответе Vision
+COMBINED_PROMPT = SOLUTION_PROMPT + """
+                    Задача дана на изображении. Извлеки ее текст, сохранив все формулы и символы точно, и реши ее.
+                    Ответь JSON-объектом с двумя полями:
+                    "text" - текст задачи с изображения, без комментариев,
+                    "solution" - решение в формате HTML, описанном выше."""
+
+@shared_task
+def process_task_image(task_id):
+    """Обработка изображения задачи: запуск цепочки этапов OCR + решение"""
+    return start_pipeline(task_id)
+
+@shared_task
+def process_text_task(task_id):
+    """Обработка текстовой задачи: запуск цепочки этапов решения"""
+    return start_pipeline(task_id)
+
+@shared_task
+def process_task_text(task_id):
+    """Обработка текстовой задачи: только решение"""
+    return start_pipeline(task_id)
+
+def start_pipeline(task_id):
+    """Запуск (или возобновление) обработки задачи с первого незавершенного этапа"""
+    task = Task.objects.get(id=task_id)
+    stages = pipeline_stages(task)
+    
+    # CPU-этапы идут в очередь cpu (prefork), сетевые — в io (потоки),
+    # поэтому долгий запрос к LLM не занимает процесс, нужный для OpenCV.
+    # Все этапы наследуют приоритет, выбранный при постановке задачи в очередь
+    queued_at = task.queued_at or timezone.now()
+    state = {
+        'task_id': str(task_id),
+        'lane': task.lane,
+        'queued_at': queued_at.timestamp(),
+        # После срока сетевые этапы отвечают только из кэша или локально, иначе задача откладывается
+        'deadline': task_deadline(task.lane, queued_at.timestamp()),
+    }
+    signatures = [stages[0].s(state)] + [stage.s() for stage in stages[1:]]
+    chain(*[signature.set(priority=task.priority) for signature in signatures]).apply_async()
+    
+    logger.info(f"Task {task_id} started from {stages[0].name}")
+    return True
+
+def pipeline_stages(task):
+    """Этапы, результаты которых еще не сохранены в задаче"""
+    stages = []
+    # Если задача без изображения, это текстовая задача
+    if task.image and not task.ocr_text:
+        if not task.processed_image:
+            stages.append(preprocess_stage)
+        stages.append(ocr_stage)
+    if not task.raw_solution:
+        stages.append(solve_stage)
+    stages.append(complete_stage)
+    stages.append(notify_stage)
+    return stages
+
+def set_stage_status(state, status):
+    """Перевести задачу в статус текущего этапа"""
+    task_id = state['task_id']
+    record_queue_wait(state)
+    Task.objects.filter(id=task_id).update(status=status)
+    publish_status(task_id, status)
+
+def request_retake(task_id, exc):
+    """Остановить обработку нечитаемого фото и сразу попросить пользователя переснять его"""
+    logger.info(f"Task {task_id} needs a retake: {exc.reason}")
+    Task.objects.filter(id=task_id).update(status='retake', error_message=str(exc))
+    publish_status(task_id, 'retake')
+    send_retake_notification(Task.objects.get(id=task_id))
+
+def park_task(state, exc):
+    """Отложить задачу, пока OpenAI недоступен или истек ее срок: воркер сразу берет следующую задачу"""
+    task_id = state['task_id']
+    logger.warning(f"Task {task_id} parked: {exc}")
+    Task.objects.filter(id=task_id).update(status='parked', error_message=str(exc))
+    publish_status(task_id, 'parked')
+    metrics.incr('tasks.parked')
+    resume_parked_task.apply_async((task_id,), countdown=settings.PARKED_RESUME_INTERVAL)
+
+@shared_task
+def resume_parked_task(task_id):
+    """Продолжить отложенную задачу с первого незавершенного этапа, когда OpenAI снова доступен"""
+    task = Task.objects.filter(id=task_id, status='parked').first()
+    if task is None:
+        return False
+    
+    if timezone.now() - task.created_at > timedelta(seconds=settings.PARKED_MAX_AGE):
+        Task.objects.filter(id=task_id).update(
+            status='failed', error_message='Сервис перегружен, отправьте задачу еще раз позже'
+        )
+        publish_status(task_id, 'failed')
+        return False
+    
+    if not (is_available('vision') and is_available('completion')):
+        resume_parked_task.apply_async((task_id,), countdown=settings.PARKED_RESUME_INTERVAL)
+        return False
+    
+    # Отложенные задачи уже вышли за срок: новые задачи полосы идут впереди них
+    priority = settings.TASK_PRIORITY_LANES[task.lane]['lowest_priority']
+    Task.objects.filter(id=task_id).update(status='pending', priority=priority, queued_at=timezone.now())
+    reset_steps(task_id)
+    metrics.incr('tasks.resumed')
+    return start_pipeline(task_id)
+
+def fail_stage(stage, exc, task_id, reset_stream=True):
+    """Запланировать повтор этапа; после последней попытки пометить задачу как упавшую"""
+    logger.error(f"Error in {stage.name} for task {task_id}: {exc}")
+    
+    if stage.request.retries >= stage.max_retries:
+        Task.objects.filter(id=task_id).update(status='failed', error_message=str(exc))
+        publish_status(task_id, 'failed')
+        return exc
+    
+    # Статус этапа не меняем: повторяется только упавший этап, готовые результаты сохранены
+    Task.objects.filter(id=task_id).update(error_message=str(exc))
+    # Повтор заново публикует шаги решения: уже показанные не должны задвоиться
+    if reset_stream:
+        reset_steps(task_id)
+    if isinstance(exc, (RateLimitExceeded, openai.RateLimitError)):
+        # Лимит освободится за секунды, минутный ретрай только добавит задержку
+        countdown = settings.LLM_RATE_LIMIT_MAX_WAIT * (stage.request.retries + 1)
+    elif isinstance(exc, CircuitOpen):
+        # Повтор к моменту пробного запроса предохранителя
+        countdown = max(1, exc.retry_in)
+    else:
+        countdown = 60 * (2 ** stage.request.retries)
+    return stage.retry(exc=exc, countdown=countdown)
+
 @shared_task(bind=True, max_retries=3)
-def process_task_image(self, task_id):
-    """Обработка изображения задачи: OCR + решение"""
+def preprocess_stage(self, state):
+    """Этап 1: предобработка изображения (CPU)"""
+    task_id = state['task_id']
     try:
+        set_stage_status(state, 'preprocessing')
         task = Task.objects.get(id=task_id)
-        task.status = 'processing'
-        task.save()
-        
-        # Проверяем, есть ли изображение
-        if not task.image:
-            # Если нет изображения, это текстовая задача
-            return process_text_task(task_id)
-        
-        # 1. Предобработка изображения
-        processed_image = preprocess_image(task.image.path)
-        
-        # 2. OCR с помощью OpenAI Vision
-        extracted_text = extract_text_from_image(processed_image)
-        
-        # 3. Обновляем описание задачи
-        task.description = extracted_text
-        task.save()
-        
-        # 4. Генерируем решение
-        solution = generate_solution(extracted_text)
-        
-        # 5. Создаем изображение решения
-        solution_image = create_solution_image(solution)
-        
-        # 6. Сохраняем результат
-        task.solution = solution
-        if solution_image:
-            task.solution_image.save(
-                f'solution_{task_id}.png',
-                ContentFile(solution_image),
-                save=False
-            )
-        task.status = 'completed'
-        task.completed_at = timezone.now()
-        task.save()
-        
-        # Отправляем уведомление о завершении задачи
-        try:
-            send_task_completed_notification(task)
-            send_channel_notification(task)
-        except Exception as e:
-            logger.error(f"Ошибка при отправке уведомления: {e}")
-        
-        logger.info(f"Task {task_id} completed successfully")
-        return True
-        
+        metrics.reset_peak_rss()
+        with task.image.open('rb') as image_file:
+            processed, cropped = preprocess_image(image_file.read())
+        
+        # Изображение для OCR передается следующему этапу через кэш: через брокер идет только ключ
+        image_bytes, mime = encode_for_vision(processed)
+        key = processed_image_key(task_id)
+        caches['images'].set(key, image_bytes)
+        state['image'] = {
+            'key': key,
+            'mime': mime,
+            'fingerprint': image_fingerprint(processed),
+        }
+        
+        if settings.PREPROCESS_PERSIST_INTERMEDIATES:
+            # Сохраненный результат позволяет возобновить задачу без повторной предобработки
+            extension = mimetypes.guess_extension(mime)
+            task.processed_image.save(f'{task_id}_processed{extension}', ContentFile(image_bytes), save=False)
+            task.save(update_fields=['processed_image'])
+        
+        # Пик памяти на задачу помогает подобрать concurrency CPU-воркера
+        peak_rss = metrics.peak_rss_mb()
+        metrics.observe_value('preprocess.peak_rss', peak_rss, metrics.MEMORY_BUCKETS_MB, 'mb')
+        logger.info(f"Task {task_id} preprocessed{' (cropped)' if cropped else ''}, peak RSS {peak_rss:.0f} MB")
+        return state
+    except ImageQualityError as exc:
+        request_retake(task_id, exc)
+        # Остальные этапы цепочки не запускаются
+        raise Ignore()
     except Exception as exc:
-        logger.error(f"Error processing task {task_id}: {exc}")
-        task.status = 'failed'
-        task.error_message = str(exc)
-        task.save()
-        
-        # Повторная попытка
-        raise self.retry(exc=exc, countdown=60 * (2 ** self.request.retries))
+        raise fail_stage(self, exc, task_id)
 
 @shared_task(bind=True, max_retries=3)
-def process_text_task(self, task_id):
-    """Обработка текстовой задачи"""
+def ocr_stage(self, state):
+    """Этап 2: OCR с помощью OpenAI Vision или из кэша для похожих фото; в совмещенном режиме сразу и решение (сеть)"""
+    task_id = state['task_id']
     try:
+        set_stage_status(state, 'recognizing')
         task = Task.objects.get(id=task_id)
-        task.status = 'processing'
-        task.save()
-        
-        # Генерируем решение для текстовой задачи
-        solution = generate_solution(task.description)
-        
-        # Создаем изображение решения
-        solution_image = create_solution_image(solution)
-        
-        # Сохраняем результат
-        task.solution = solution
-        if solution_image:
-            task.solution_image.save(
-                f'solution_{task_id}.png',
-                ContentFile(solution_image),
-                save=False
-            )
-        task.status = 'completed'
-        task.completed_at = timezone.now()
-        task.save()
-        
-        # Отправляем уведомление о завершении задачи
-        try:
-            send_task_completed_notification(task)
-            send_channel_notification(task)
-        except Exception as e:
-            logger.error(f"Ошибка при отправке уведомления: {e}")
-        
-        logger.info(f"Text task {task_id} completed successfully")
-        return True
-        
+        image = state.get('image')
+        image_bytes = caches['images'].get(image['key']) if image is not None else None
+        if image_bytes is not None:
+            mime, fingerprint = image['mime'], image['fingerprint']
+        elif task.processed_image:
+            # Возобновление после сохраненной предобработки
+            with task.processed_image.open('rb') as image_file:
+                image_bytes = image_file.read()
+            mime = mimetypes.guess_type(task.processed_image.name)[0]
+            fingerprint = image_fingerprint_bytes(image_bytes)
+        else:
+            # Изображение вытеснено из кэша или этап возобновлен без него: предобработка повторяется здесь
+            with task.image.open('rb') as image_file:
+                processed, _ = preprocess_image(image_file.read())
+            image_bytes, mime = encode_for_vision(processed)
+            fingerprint = image_fingerprint(processed)
+        solution = None
+        offline = deadline_passed(state)
+        if settings.IMAGE_SOLVE_MODE == 'combined' and not offline:
+            extracted_text, solution = get_image_text_and_solution(image_bytes, mime, fingerprint)
+        else:
+            extracted_text = get_image_text(image_bytes, mime, fingerprint, offline=offline)
+        if extracted_text is None:
+            raise DeadlineExceeded("Срок задачи истек до распознавания")
+        
+        # Обновляем описание задачи
+        task.ocr_text = extracted_text
+        task.description = extracted_text
+        update_fields = ['ocr_text', 'description']
+        if solution is not None:
+            # Этап решения увидит готовое решение и пропустит запрос к LLM
+            task.raw_solution = solution
+            task.solution = solution
+            update_fields += ['raw_solution', 'solution']
+        task.save(update_fields=update_fields)
+        publish_event(task_id, 'description', {'text': extracted_text})
+        if solution is not None:
+            on_step = step_publisher(task_id)
+            if on_step:
+                for step in split_steps(solution):
+                    on_step(step)
+        
+        # Дальше изображение не нужно
+        if image is not None:
+            caches['images'].delete(image['key'])
+            state.pop('image')
+        return state
+    except (CircuitOpen, DeadlineExceeded) as exc:
+        park_task(state, exc)
+        raise Ignore()
     except Exception as exc:
-        logger.error(f"Error processing text task {task_id}: {exc}")
-        task.status = 'failed'
-        task.error_message = str(exc)
-        task.save()
-        
-        # Повторная попытка
-        raise self.retry(exc=exc, countdown=60 * (2 ** self.request.retries))
+        raise fail_stage(self, exc, task_id)
 
 @shared_task(bind=True, max_retries=3)
-def process_task_text(self, task_id):
-    """Обработка текстовой задачи: только решение"""
+def solve_stage(self, state):
+    """Этап 3: генерация решения, шаги отправляются в WebApp по мере готовности (сеть)"""
+    task_id = state['task_id']
     try:
         task = Task.objects.get(id=task_id)
-        task.status = 'processing'
-        task.save()
-        
-        # Генерируем решение для текстовой задачи
-        solution = generate_solution(task.description)
-        
-        # Создаем изображение решения
-        solution_image = create_solution_image(solution)
-        
-        # Сохраняем результат
-        task.solution = solution
-        if solution_image:
-            task.solution_image.save(
-                f'solution_{task_id}.png',
-                ContentFile(solution_image),
-                save=False
-            )
-        task.status = 'completed'
-        task.completed_at = timezone.now()
-        task.save()
-        
-        # Отправляем уведомление о завершении задачи
-        try:
-            send_task_completed_notification(task)
-            send_channel_notification(task)
-        except Exception as e:
-            logger.error(f"Ошибка при отправке уведомления: {e}")
-        
-        logger.info(f"Text task {task_id} completed successfully")
-        return True
-        
+        if task.raw_solution:
+            # Решение уже получено вместе с текстом одним запросом Vision
+            return state
+        set_stage_status(state, 'solving')
+        offline = deadline_passed(state)
+        # После срока задача решается только из кэша или локально, без разбиения на части
+        problems = [] if offline else split_problems(task.description)
+        if len(problems) < 2:
+            solution = get_solution(task.description, on_step=step_publisher(task_id), offline=offline)
+            if solution is None:
+                raise DeadlineExceeded("Срок задачи истек, решения нет в кэше")
+            
+            task.raw_solution = solution
+            task.solution = solution
+            task.save(update_fields=['raw_solution', 'solution'])
+            return state
+    except (CircuitOpen, DeadlineExceeded) as exc:
+        # Кэш и локальный решатель уже проверены в get_solution
+        park_task(state, exc)
+        raise Ignore()
     except Exception as exc:
-        logger.error(f"Error processing text task {task_id}: {exc}")
-        task.status = 'failed'
-        task.error_message = str(exc)
-        task.save()
-        
-        # Повторная попытка
-        raise self.retry(exc=exc, countdown=60 * (2 ** self.request.retries))
+        raise fail_stage(self, exc, task_id)
+    
+    # Несколько задач на фото решаются параллельно: время этапа равно времени самой долгой задачи,
+    # а не сумме, и ни один ответ не обрезается общим max_tokens. Остаток цепочки продолжится после хорда
+    logger.info(f"Task {task_id}: {len(problems)} problems solved in parallel")
+    metrics.incr('fanout.tasks')
+    metrics.incr('fanout.problems', len(problems))
+    header = group(
+        solve_problem_stage.s(state, problem).set(priority=task.priority)
+        for problem in problems
+    )
+    return self.replace(chord(header, assemble_solutions_stage.s(state).set(priority=task.priority)))
 
-def preprocess_image(image_path):
-    """Предобработка изображения для улучшения OCR"""
+@shared_task(bind=True, max_retries=3)
+def solve_problem_stage(self, state, problem):
+    """Этап 3 для одной из нескольких задач на фото: решение и HTML-блок для общего ответа (сеть)"""
+    task_id = state['task_id']
     try:
-        # Загружаем изображение
-        image = cv2.imread(image_path)
-        if image is None:
-            raise ValueError("Не удалось загрузить изображение")
-        
-        # Конвертируем в оттенки серого
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Улучшаем контраст
-        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-        enhanced = clahe.apply(gray)
-        
-        # Убираем шум
-        denoised = cv2.fastNlMeansDenoising(enhanced)
-        
-        # Сохраняем обработанное изображение
-        processed_path = image_path.replace('.', '_processed.')
-        cv2.imwrite(processed_path, denoised)
-        
-        return processed_path
+        # Срок проверяется у каждой задачи: повтор после ошибки может начаться уже после него
+        offline = deadline_passed(state)
+        solution = get_solution(problem['text'], offline=offline)
+        if solution is None:
+            raise DeadlineExceeded(f"Срок задачи истек, решения задачи {problem['label']} нет в кэше")
+    except (CircuitOpen, DeadlineExceeded) as exc:
+        # Отложенная задача начнется заново, решенные задачи возьмутся из кэша решений
+        park_task(state, exc)
+        raise Ignore()
+    except Exception as exc:
+        # Шаги задачи публикуются только после решения: у упавшей их еще нет, а шаги соседних стирать нельзя
+        raise fail_stage(self, exc, task_id, reset_stream=False)
+    
+    header = f"<li><strong>Задача {problem['label']}:</strong> {escape(problem['item'])}</li>"
+    steps = [header] + (split_steps(solution) or [f'<li>{solution}</li>'])
+    # Решенная задача сразу появляется в WebApp, не дожидаясь остальных
+    on_step = step_publisher(task_id)
+    if on_step:
+        for step in steps:
+            on_step(step)
+    return '\n'.join(steps)
+
+@shared_task
+def assemble_solutions_stage(blocks, state):
+    """Колбэк хорда: решения всех задач в порядке номеров собираются в решение задачи"""
+    solution = '<ol>\n' + '\n'.join(blocks) + '\n</ol>'
+    Task.objects.filter(id=state['task_id']).update(raw_solution=solution, solution=solution)
+    return state
+
+@shared_task(bind=True, max_retries=3)
+def complete_stage(self, state):
+    """Этап 4: завершение задачи; изображение решения рисуется при первом запросе (image_cache)"""
+    task_id = state['task_id']
+    try:
+        record_queue_wait(state)
+        Task.objects.filter(id=task_id).update(status='completed', completed_at=timezone.now(), error_message=None)
+        publish_status(task_id, 'completed')
         
+        logger.info(f"Task {task_id} completed successfully")
+        return state
+    except Exception as exc:
+        raise fail_stage(self, exc, task_id)
+
+@shared_task
+def notify_stage(state):
+    """Этап 5: уведомления пользователю и в канал (сеть)"""
+    task = Task.objects.get(id=state['task_id'])
+    try:
+        send_task_completed_notification(task)
+        send_channel_notification(task)
     except Exception as e:
+        logger.error(f"Ошибка при отправке уведомления: {e}")
+    return state
+
+def processed_image_key(task_id):
+    """Ключ обработанного изображения задачи в кэше images"""
+    return f'processed_image:{task_id}'
+
+def preprocess_image(image_bytes):
+    """Предобработка изображения для улучшения OCR: байты файла -> (массив в оттенках серого, вырезана ли задача)"""
+    image = decode_image(image_bytes)
+    if settings.IMAGE_QUALITY_GATE_ENABLED:
+        # Несколько миллисекунд вместо секунд Vision и GPT-4 на заведомо нечитаемое фото
+        check_quality(image)
+    
+    cropped = False
+    if settings.PREPROCESS_LAYOUT_ENABLED:
+        # Выпрямляем лист и обрезаем поля вокруг текста
+        image, cropped = extract_problem_region(image)
+    
+    try:
+        return preprocess(image), cropped
+    except cv2.error as e:
         logger.error(f"Error preprocessing image: {e}")
-        return image_path  # Возвращаем оригинальное изображение
+        return image, cropped  # Возвращаем изображение без улучшений
+
+def get_image_text(image_bytes, mime, fingerprint, offline=False):
+    """Текст изображения: сначала кэш по отпечатку изображения, затем OCR-движок из настроек (offline — только локально, иначе None)"""
+    cached_text = find_cached_text(fingerprint)
+    if cached_text is not None:
+        return cached_text
+    if offline and settings.OCR_BACKEND != 'tesseract':
+        return None
+    
+    extracted_text = recognize(image_bytes, mime)
+    store_text(fingerprint, extracted_text)
+    return extracted_text
 
-def extract_text_from_image(image_path):
-    """Извлечение текста из изображения с помощью OpenAI Vision"""
+def get_image_text_and_solution(image_bytes, mime, fingerprint):
+    """Текст и решение фото одним запросом Vision: (текст, решение или None, если решать отдельно)"""
+    cached_text = find_cached_text(fingerprint)
+    if cached_text is not None:
+        # Текст уже известен: решение найдется в кэше решений или на этапе решения
+        return cached_text, None
+    
     try:
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
-        
-        with open(image_path, "rb") as image_file:
-                    response = client.chat.completions.create(
-            model="gpt-4o",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "Ты - эксперт по извлечению текста из изображений. Извлеки весь текст из изображения, особенно математические задачи, формулы и уравнения. Сохрани точность математических выражений. Отвечай только текстом задачи, без дополнительных комментариев."
-                    },
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": "Извлеки текст из этого изображения. Если это математическая задача, сохрани все формулы и символы точно."
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64.b64encode(image_file.read()).decode()}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=1000,
-                timeout=30
-            )
-        
-        extracted_text = response.choices[0].message.content.strip()
-        logger.info(f"Extracted text: {extracted_text}")
-        return extracted_text
-        
-    except Exception as e:
-        logger.error(f"Error extracting text: {e}")
-        raise
+        extracted_text, solution = generate_solution_from_image(image_bytes, mime)
+    except ValueError as e:
+        # Модель не вернула ожидаемый JSON: распознаем обычным путем, решим на следующем этапе
+        metrics.incr('combined.fallbacks')
+        logger.warning(f"Совмещенный ответ не разобран, распознаем отдельно: {e}")
+        return get_image_text(image_bytes, mime, fingerprint), None
+    
+    store_text(fingerprint, extracted_text)
+    store_solution(extracted_text, solution)
+    return extracted_text, solution
 
-def generate_solution(task_text):
+def get_solution(task_text, on_step=None, offline=False):
+    """Решение задачи: сначала кэш, затем локальный решатель, затем OpenAI (offline — без OpenAI, иначе None)"""
+    solution = get_cached_solution(task_text)
+    if solution is None:
+        # Арифметика и простые уравнения решаются за миллисекунды без LLM
+        solution = solve_locally(task_text)
+        if solution is not None:
+            store_solution(task_text, solution)
+    if solution is not None:
+        if on_step:
+            for step in split_steps(solution):
+                on_step(step)
+        return solution
+    if offline:
+        return None
+    
+    solution = generate_solution(task_text, on_step=on_step)
+    store_solution(task_text, solution)
+    return solution
+
+def generate_solution(task_text, on_step=None):
     """Генерация решения задачи с помощью OpenAI"""
     try:
-        client = openai.OpenAI(api_key=OPENAI_API_KEY)
-        
-        response = client.chat.completions.create(
-            model="gpt-4",
+        # Модель и max_tokens по сложности задачи: «2+2» не ждет gpt-4 и не резервирует 1500 токенов
+        route = choose_route(task_text)
+        request = dict(
+            model=route['model'],
             messages=[
                 {
                     "role": "system",
-                    "content": """Ты - эксперт по решению математических задач. 
-                    Создавай краткие пошаговые решения в формате HTML с нумерованным списком.
-                    Используй обычный текст для формул (без $), но с правильными символами:
-                    - 2² вместо 2^2
-                    - 4/2 вместо дробей
-                    - × для умножения
-                    - √ для корня
-                    Формат ответа:
-                    <ol>
-                    <li><strong>Шаг 1:</strong> конкретное действие</li>
-                    <li><strong>Шаг 2:</strong> конкретное действие</li>
-                    <li><strong>Ответ:</strong> итоговый ответ</li>
-                    </ol>
-                    Делай решения максимально краткими. Каждый шаг - это одно конкретное действие или вычисление, без лишних объяснений."""
+                    "content": SOLUTION_PROMPT
                 },
                 {
                     "role": "user",
                     "content": f"Реши эту задачу: {task_text}"
                 }
             ],
-            max_tokens=1500,
+            max_tokens=route['max_tokens'],
             timeout=30
         )
         
-        solution = response.choices[0].message.content.strip()
+        started = time.monotonic()
+        if on_step is None and not settings.LLM_HEDGING_ENABLED:
+            response = chat_completion(**request)
+            solution = response.choices[0].message.content.strip()
+            finish_reason = response.choices[0].finish_reason
+        else:
+            # Потоковый режим: отдаем каждый завершенный <li> сразу, не дожидаясь всего ответа.
+            # Хеджирование тоже работает на потоке: медленный запрос виден по первому токену
+            stream = stream_completion(**request)
+            parts = []
+            emitted = 0
+            finish_reason = None
+            for chunk in stream:
+                if chunk.choices and chunk.choices[0].finish_reason:
+                    finish_reason = chunk.choices[0].finish_reason
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                parts.append(chunk.choices[0].delta.content)
+                # Шаг может закончиться только на чанке с закрывающим '>'
+                if '>' not in parts[-1]:
+                    continue
+                if on_step is None:
+                    continue
+                steps = split_steps(''.join(parts))
+                for step in steps[emitted:]:
+                    on_step(step)
+                emitted = len(steps)
+            solution = ''.join(parts).strip()
+        metrics.observe('llm.solve_latency', time.monotonic() - started)
+        # Обрезанные ответы показывают, что max_tokens маршрута мал
+        record_route(route, time.monotonic() - started, truncated=finish_reason == 'length')
+        
         logger.info(f"Generated solution for: {task_text[:50]}...")
         return solution
         
@@ -274,134 +508,139 @@ def generate_solution(task_text):
         logger.error(f"Error generating solution: {e}")
         raise
 
-def create_solution_image(solution_text):
-    """Создание изображения с решением"""
+def generate_solution_from_image(image_bytes, mime):
+    """Извлечение текста и решение задачи одним запросом к OpenAI Vision: (текст, решение)"""
+    metrics.incr('combined.requests')
+    metrics.incr('vision.requests')
+    metrics.incr('vision.upload_bytes', len(image_bytes))
+    
+    started = time.monotonic()
+    response = chat_completion(
+        breaker_name='vision',
+        model=settings.IMAGE_SOLVE_MODEL,
+        messages=[
+            {
+                "role": "system",
+                "content": COMBINED_PROMPT
+            },
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": "Распознай и реши задачу с этого изображения."
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:{mime};base64,{base64.b64encode(image_bytes).decode()}"
+                        }
+                    }
+                ]
+            }
+        ],
+        response_format={"type": "json_object"},
+        max_tokens=settings.IMAGE_SOLVE_MAX_TOKENS,
+        timeout=settings.IMAGE_SOLVE_TIMEOUT
+    )
+    metrics.observe('combined.latency', time.monotonic() - started)
+    
     try:
-        # Создаем простое изображение с текстом решения
-        from PIL import Image, ImageDraw, ImageFont
-        
-        # Убираем HTML теги для отображения
-        clean_text = solution_text.replace('<ol>', '').replace('</ol>', '').replace('<li>', '').replace('</li>', '\n').replace('<strong>', '').replace('</strong>', '')
-        
-        # Создаем изображение
-        img = Image.new('RGB', (800, 600), color='white')
-        draw = ImageDraw.Draw(img)
-        
-        # Используем стандартный шрифт
-        try:
-            font = ImageFont.truetype("arial.ttf", 16)
-        except:
-            font = ImageFont.load_default()
-        
-        # Разбиваем текст на строки
-        lines = clean_text.split('\n')
-        y_position = 20
+        payload = json.loads(response.choices[0].message.content)
+        extracted_text = payload['text'].strip()
+        solution = payload['solution'].strip()
+    except (TypeError, KeyError, AttributeError, ValueError) as e:
+        raise ValueError(f"ответ без полей text и solution: {e}")
+    if not extracted_text or not solution:
+        raise ValueError("пустой текст или решение")
+    
+    logger.info(f"Extracted and solved in one request: {extracted_text[:50]}...")
+    return extracted_text, solution
+
+@shared_task(bind=True)
+def send_telegram_message(self, message):
+    """Отправка сообщения из очереди telegram: лимиты Bot API, приоритеты и повторы после 429"""
+    countdown = deliver(message)
+    while countdown is not None and self.request.is_eager:
+        # Без брокера (CELERY_TASK_ALWAYS_EAGER) отложить сообщение нельзя — ждем на месте
+        time.sleep(countdown)
+        countdown = deliver(message)
+    if countdown is not None:
+        # Повтор — новое сообщение в очереди с задержкой: поток воркера не спит в ожидании
+        send_telegram_message.apply_async((message,), countdown=countdown, priority=message['priority'])
+
+def send_task_completed_notification(task):
+    """Отправка уведомления о завершении задачи"""
+    try:
+        from telegram import InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
+        from config import WEBAPP_URL_DEV
         
-        for line in lines:
-            if line.strip():
-                draw.text((20, y_position), line.strip(), fill='black', font=font)
-                y_position += 25
+        text = f"""✅ Задача решена!
+
+📱 Посмотрите решение в мини-приложении"""
+
+        # Ссылка на WebApp с конкретной задачей
+        webapp_url = f"{WEBAPP_URL_DEV}?task_id={task.id}"
         
-        # Сохраняем в байты
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        img_byte_arr.seek(0)
+        keyboard = [
+            [InlineKeyboardButton("👀 Посмотреть решение", web_app=WebAppInfo(url=webapp_url))],
+            [InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu")]
+        ]
         
-        return img_byte_arr.getvalue()
+        # Используем telegram_id как chat_id, если chat_id не установлен
+        chat_id = task.user.chat_id if task.user.chat_id else task.user.telegram_id
+        enqueue_message(chat_id, text, InlineKeyboardMarkup(keyboard))
+        logger.info(f"Уведомление о завершении задачи {task.id} поставлено в очередь для чата {chat_id}")
         
     except Exception as e:
-        logger.error(f"Error creating solution image: {e}")
-        return None
+        logger.error(f"Ошибка при отправке уведомления о завершении задачи: {e}")
 
-def send_task_completed_notification(task):
-    """Отправка уведомления о завершении задачи"""
-    logger.info(f"Начинаем отправку уведомления для задачи {task.id}")
+def send_retake_notification(task):
+    """Отправка просьбы переснять нечитаемое фото"""
     try:
-        import threading
-        from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo
-        from config import BOT_TOKEN, WEBAPP_URL_DEV
+        from telegram import InlineKeyboardButton, InlineKeyboardMarkup
         
-        def send_message_sync():
-            try:
-                logger.info(f"Создаем бота для отправки уведомления")
-                bot = Bot(token=BOT_TOKEN)
-                
-                text = f"""✅ Задача решена!
+        text = f"""📷 Не получилось прочитать фото
 
-📱 Посмотрите решение в мини-приложении"""
+{task.error_message}
 
-                # Ссылка на WebApp с конкретной задачей
-                webapp_url = f"{WEBAPP_URL_DEV}?task_id={task.id}"
-                logger.info(f"Создаем WebApp URL: {webapp_url}")
-                logger.info(f"WEBAPP_URL_DEV из config: {WEBAPP_URL_DEV}")
-                
-                keyboard = [
-                    [InlineKeyboardButton("👀 Посмотреть решение", web_app=WebAppInfo(url=webapp_url))],
-                    [InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu")]
-                ]
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                # Используем telegram_id как chat_id, если chat_id не установлен
-                chat_id = task.user.chat_id if task.user.chat_id else task.user.telegram_id
-                logger.info(f"Отправляем уведомление в чат {chat_id} для пользователя {task.user.telegram_id}")
-                
-                # Отправляем сообщение синхронно с использованием requests
-                import requests
-                
-                url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-                data = {
-                    'chat_id': chat_id,
-                    'text': text,
-                    'reply_markup': reply_markup.to_dict()
-                }
-                
-                response = requests.post(url, json=data)
-                if response.status_code == 200:
-                    logger.info(f"Уведомление о завершении задачи отправлено пользователю {task.user.telegram_id} в чат {chat_id}")
-                else:
-                    logger.error(f"Ошибка отправки уведомления: {response.status_code} - {response.text}")
-                
-            except Exception as e:
-                logger.error(f"Ошибка в send_message_sync: {e}")
+Отправьте новое фото задачи."""
         
-        # Запускаем в отдельном потоке
-        thread = threading.Thread(target=send_message_sync)
-        thread.start()
+        keyboard = [[InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu")]]
+        
+        chat_id = task.user.chat_id if task.user.chat_id else task.user.telegram_id
+        enqueue_message(chat_id, text, InlineKeyboardMarkup(keyboard))
+        logger.info(f"Просьба переснять фото поставлена в очередь для пользователя {task.user.telegram_id}")
         
     except Exception as e:
-        logger.error(f"Ошибка при отправке уведомления о завершении задачи: {e}")
+        logger.error(f"Ошибка при отправке просьбы переснять фото: {e}")
 
 def send_channel_notification(task):
     """Отправка уведомления в канал о решенной задаче"""
     try:
-        import threading
-        import requests
-        from config import BOT_TOKEN, CHANNEL_ID, WEBAPP_URL_DEV
+        from config import CHANNEL_ID, WEBAPP_URL_DEV
+        
+        # Убираем HTML теги из решения для канала
+        clean_solution = task.solution.replace('<ol>', '').replace('</ol>', '').replace('<li>', '').replace('</li>', '\n').replace('<strong>', '').replace('</strong>', '')
+        
+        # Ограничиваем длину решения для канала
+        if len(clean_solution) > 500:
+            clean_solution = clean_solution[:500] + "..."
         
-        def send_channel_message():
-            try:
-                # Убираем HTML теги из решения для канала
-                clean_solution = task.solution.replace('<ol>', '').replace('</ol>', '').replace('<li>', '').replace('</li>', '\n').replace('<strong>', '').replace('</strong>', '')
-                
-                # Ограничиваем длину решения для канала
-                if len(clean_solution) > 500:
-                    clean_solution = clean_solution[:500] + "..."
-                
-                # Экранируем специальные символы для Markdown
-                import re
-                def escape_markdown(text):
-                    # Экранируем символы, которые могут сломать Markdown
-                    chars_to_escape = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-                    for char in chars_to_escape:
-                        text = text.replace(char, f'\\{char}')
-                    return text
-                
-                safe_description = escape_markdown(task.description[:100])
-                safe_solution = escape_markdown(clean_solution)
-                safe_username = escape_markdown(task.user.username or 'Аноним')
-                
-                text = f"""🎯 **Новая решенная задача\\!**
+        # Экранируем специальные символы для Markdown
+        import re
+        def escape_markdown(text):
+            # Экранируем символы, которые могут сломать Markdown
+            chars_to_escape = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
+            for char in chars_to_escape:
+                text = text.replace(char, f'\\{char}')
+            return text
+        
+        safe_description = escape_markdown(task.description[:100])
+        safe_solution = escape_markdown(clean_solution)
+        safe_username = escape_markdown(task.user.username or 'Аноним')
+        
+        text = f"""🎯 **Новая решенная задача\\!**
 
 📝 **Задача:** {safe_description}{'...' if len(task.description) > 100 else ''}
 
@@ -412,25 +651,9 @@ def send_channel_notification(task):
 👤 **Пользователь:** @{safe_username}
 📱 **Посмотреть полное решение:** {WEBAPP_URL_DEV}\\?task\\_id={task.id}"""
 
-                url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-                data = {
-                    'chat_id': CHANNEL_ID,
-                    'text': text,
-                    'parse_mode': 'Markdown'
-                }
-                
-                response = requests.post(url, json=data)
-                if response.status_code == 200:
-                    logger.info(f"Уведомление в канал отправлено для задачи {task.id}")
-                else:
-                    logger.error(f"Ошибка отправки в канал: {response.status_code} - {response.text}")
-                
-            except Exception as e:
-                logger.error(f"Ошибка в send_channel_message: {e}")
-        
-        # Запускаем в отдельном потоке
-        thread = threading.Thread(target=send_channel_message)
-        thread.start()
+        # Публикации в канал не срочные: идут после сообщений пользователям
+        enqueue_message(CHANNEL_ID, text, priority=PRIORITY_LOW, parse_mode='Markdown')
+        logger.info(f"Уведомление в канал поставлено в очередь для задачи {task.id}")
         
     except Exception as e:
         logger.error(f"Ошибка при отправке уведомления в канал: {e}")
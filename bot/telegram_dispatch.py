@@ -0,0 +1,207 @@
+import logging
+import math
+import os
+import threading
+import time
+import httpx
+from django.conf import settings
+from config import BOT_TOKEN
+from . import metrics
+from .breaker import CircuitOpen, allow, record_failure, record_success, release_probe
+from .ratelimit import LockTimeout, cache_lock
+
+logger = logging.getLogger(__name__)
+
+# Приоритеты Celery (0 — наивысший): оплата важнее уведомлений о задачах, публикации в канал — в конце
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 3
+PRIORITY_LOW = 9
+
+# Один HTTP-клиент на процесс воркера telegram: keep-alive соединения с Bot API общие для всех потоков
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+# Расписание отправок по GCRA в общем кэше лимитера: все потоки и все воркеры telegram делят один
+# лимит бота. Значение ключа — время (Unix), раньше которого следующее сообщение уйдет только
+# в пределах допустимого всплеска
+SCHEDULE_PREFIX = 'telegram:schedule:'
+GLOBAL_KEY = SCHEDULE_PREFIX + 'global'
+SCHEDULE_LOCK_KEY = SCHEDULE_PREFIX + 'lock'
+
+
+def enqueue_message(chat_id, text, reply_markup=None, priority=PRIORITY_NORMAL, **params):
+    """Поставить сообщение в очередь telegram вместо отправки из запроса или этапа"""
+    from .tasks import send_telegram_message
+
+    payload = {'chat_id': chat_id, 'text': text, **params}
+    if reply_markup is not None:
+        # Разметка python-telegram-bot сериализуется сразу: в очередь идет только JSON
+        payload['reply_markup'] = reply_markup.to_dict() if hasattr(reply_markup, 'to_dict') else reply_markup
+    message = {
+        'method': 'sendMessage',
+        'payload': payload,
+        'priority': priority,
+        'created': time.time(),
+        'attempt': 0,
+    }
+    send_telegram_message.apply_async((message,), priority=priority)
+    metrics.incr('telegram.enqueued')
+
+
+def get_client():
+    """Общий HTTP-клиент Bot API текущего процесса"""
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                limits = httpx.Limits(
+                    max_connections=settings.TELEGRAM_POOL_MAX_CONNECTIONS,
+                    max_keepalive_connections=settings.TELEGRAM_POOL_MAX_CONNECTIONS,
+                )
+                _client = httpx.Client(limits=limits, timeout=settings.TELEGRAM_TIMEOUT)
+                _client_pid = os.getpid()
+    return _client
+
+
+def _chat_interval(chat_id):
+    """Интервал между сообщениями в чат: личные — раз в секунду, группы и каналы — 20 в минуту"""
+    private = isinstance(chat_id, int) and chat_id > 0
+    return settings.TELEGRAM_CHAT_INTERVAL if private else settings.TELEGRAM_GROUP_INTERVAL
+
+
+def _chat_key(chat_id):
+    return f'{SCHEDULE_PREFIX}{chat_id}'
+
+
+def _ttl(at, now):
+    """Срок хранения отметки: после нее ключ не нужен, отсутствие ключа означает «можно сейчас»"""
+    return max(1, math.ceil(at - now) + 1)
+
+
+def reserve(chat_id):
+    """Забронировать отправку в чат с учетом общего и чатового лимитов: (ожидание, забронировано)"""
+    global_interval = 1 / settings.TELEGRAM_GLOBAL_RATE
+    tolerance = global_interval * (settings.TELEGRAM_GLOBAL_BURST - 1)
+    chat_key = _chat_key(chat_id)
+    with cache_lock(SCHEDULE_LOCK_KEY) as cache:
+        now = time.time()
+        schedule = cache.get_many([GLOBAL_KEY, chat_key])
+        global_at = schedule.get(GLOBAL_KEY, now)
+        send_at = max(now, global_at - tolerance, schedule.get(chat_key, now))
+        wait = send_at - now
+        # Долгое ожидание не бронируется: сообщение вернется в очередь, а поток возьмет следующее
+        if wait > settings.TELEGRAM_MAX_INLINE_WAIT:
+            return wait, False
+        global_at = max(global_at, send_at) + global_interval
+        chat_at = send_at + _chat_interval(chat_id)
+        cache.set(GLOBAL_KEY, global_at, timeout=_ttl(global_at, now))
+        cache.set(chat_key, chat_at, timeout=_ttl(chat_at, now))
+    return wait, True
+
+
+def penalize(chat_id, retry_after):
+    """Telegram ответил 429: до retry_after в этот чат ничего не отправляем"""
+    chat_key = _chat_key(chat_id)
+    with cache_lock(SCHEDULE_LOCK_KEY) as cache:
+        now = time.time()
+        chat_at = max(cache.get(chat_key, 0), now + retry_after)
+        cache.set(chat_key, chat_at, timeout=_ttl(chat_at, now))
+
+
+def _retry(message, countdown, reason):
+    """Повтор после сбоя или 429, пока не исчерпаны TELEGRAM_MAX_ATTEMPTS; None — сообщение отброшено"""
+    message['attempt'] += 1
+    if message['attempt'] >= settings.TELEGRAM_MAX_ATTEMPTS:
+        metrics.incr('telegram.failed')
+        logger.error(f"Сообщение в чат {message['payload'].get('chat_id')} не отправлено: {reason}")
+        return None
+    metrics.incr('telegram.retried')
+    logger.warning(f"Повтор отправки в чат {message['payload'].get('chat_id')} через {countdown:.0f} с: {reason}")
+    return countdown
+
+
+def deliver(message):
+    """Отправить сообщение из очереди; вернуть, через сколько секунд повторить, или None"""
+    chat_id = message['payload'].get('chat_id')
+    if time.time() - message['created'] > settings.TELEGRAM_MESSAGE_TTL:
+        # «Задача получена» через полчаса только запутает пользователя
+        metrics.incr('telegram.expired')
+        logger.warning(f"Сообщение в чат {chat_id} устарело и не отправлено")
+        return None
+
+    # Предохранитель раньше расписания: пока Telegram лежит, отложенное сообщение не занимает слот лимита бота
+    try:
+        probe = allow('telegram')
+    except CircuitOpen as exc:
+        # Попытка не тратится: сообщение подождет, пока Telegram снова ответит
+        metrics.incr('telegram.deferred')
+        return exc.retry_in
+    try:
+        return _send(message, chat_id)
+    finally:
+        # Проба, закончившаяся 429, отложенная или прерванная исключением, не держит предохранитель полуоткрытым
+        release_probe('telegram', probe)
+
+
+def _send(message, chat_id):
+    """Забронировать слот в расписании и отправить сообщение; вернуть, через сколько секунд повторить, или None"""
+    try:
+        wait, reserved = reserve(chat_id)
+    except LockTimeout as exc:
+        # Без общего расписания отправка могла бы превысить лимит бота: сообщение подождет
+        metrics.incr('telegram.deferred')
+        logger.warning(f"Отправка в чат {chat_id} отложена: {exc}")
+        return exc.wait
+    if not reserved:
+        metrics.incr('telegram.deferred')
+        return wait
+    if wait > 0:
+        time.sleep(wait)
+
+    started = time.monotonic()
+    url = f"{settings.TELEGRAM_API_URL}/bot{BOT_TOKEN}/{message['method']}"
+    try:
+        response = get_client().post(url, json=message['payload'])
+    except httpx.HTTPError as e:
+        record_failure('telegram')
+        return _retry(message, settings.TELEGRAM_RETRY_BACKOFF * 2 ** message['attempt'], e)
+    metrics.observe('telegram.latency', time.monotonic() - started)
+
+    if response.status_code == 429:
+        # Telegram жив, просто просит подождать: предохранитель не трогаем
+        try:
+            retry_after = response.json()['parameters']['retry_after']
+        except (ValueError, KeyError, TypeError):
+            retry_after = settings.TELEGRAM_RETRY_BACKOFF
+        try:
+            penalize(chat_id, retry_after)
+        except LockTimeout as exc:
+            # Само сообщение все равно повторится не раньше retry_after
+            logger.warning(f"Пауза для чата {chat_id} не сохранена: {exc}")
+        metrics.incr('telegram.rate_limited')
+        return _retry(message, retry_after, f'429, retry_after {retry_after}')
+    if response.status_code >= 500:
+        record_failure('telegram')
+        return _retry(message, settings.TELEGRAM_RETRY_BACKOFF * 2 ** message['attempt'], response.status_code)
+
+    record_success('telegram')
+    if response.status_code != 200:
+        # 400/403 (пользователь заблокировал бота, неверная разметка) повтором не исправить
+        metrics.incr('telegram.failed')
+        logger.error(f"Ошибка отправки в чат {chat_id}: {response.status_code} - {response.text}")
+        return None
+    metrics.incr('telegram.sent')
+    metrics.observe('telegram.delivery', time.time() - message['created'])
+    return None
+
+
+def telegram_stats():
+    """Счетчики очереди исходящих сообщений и задержки отправки"""
+    events = ('enqueued', 'sent', 'failed', 'retried', 'rate_limited', 'deferred', 'expired')
+    counters = metrics.get_counters([f'telegram.{event}' for event in events])
+    stats = {event: counters[f'telegram.{event}'] for event in events}
+    stats['latency'] = metrics.histogram('telegram.latency')
+    # От постановки в очередь до ответа Telegram, включая ожидание лимитов
+    stats['delivery'] = metrics.histogram('telegram.delivery')
+    return stats
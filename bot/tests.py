@@ -1,3 +1,1195 @@
-from django.test import TestCase
+import io
+import os
+import tempfile
+import time
+import uuid
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import cv2
+import httpx
+import numpy as np
+import openai
+from PIL import Image
+from django.conf import settings
+from django.core.cache import caches
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.urls import reverse
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from .breaker import CircuitOpen, allow, record_failure, record_success, release_probe, state
+from . import hedging, llm, tasks
+from .image_cache import _path, evict, get_solution_image, image_key, store_image
+from .imaging import (
+    ImageQualityError, check_quality, decode_factor, decode_image, encode_for_vision, extract_problem_region,
+    preprocess, union_blocks, vision_scale,
+)
+from .local_solver import NotSupported, solve_locally, split_problem
+from .management.commands._standin import run_standin_server
+from .models import OcrResult, Task, User
+from .ocr import OcrEngineError, extract_text_hybrid, parse_tesseract_tsv, recognize
+from .problems import split_problems
+from .rendering import RenderBusy, format_formulas, parse_solution, render_solution, render_solution_image, wrap_text
+from .routing import choose_route, difficulty_score
+from .ratelimit import LOCK_KEY, STATE_KEY, LockTimeout, RateLimitExceeded, acquire, release
+from .ocr_cache import (
+    find_cached_text, hamming_distance, hash_bands, image_fingerprint, prune_ocr_cache, store_text,
+)
+from .scheduling import choose_lane, deadline_passed, fair_priority, resumable_tasks, task_deadline
+from .solution_cache import normalize_problem_text, solution_cache_key
+from .tasks import (
+    complete_stage, notify_stage, ocr_stage, pipeline_stages, preprocess_stage, solve_problem_stage, solve_stage,
+)
+from .telegram_dispatch import GLOBAL_KEY, SCHEDULE_LOCK_KEY, deliver, penalize, reserve
+from .streaming import listen, publish_status, publish_step, reset_steps
+
+
+class SolutionCacheKeyTests(SimpleTestCase):
+    """Нормализация текста задачи для ключа кэша решений"""
+
+    def assertSameKey(self, first, second):
+        self.assertEqual(solution_cache_key(first), solution_cache_key(second))
+
+    def assertDifferentKey(self, first, second):
+        self.assertNotEqual(solution_cache_key(first), solution_cache_key(second))
+
+    def test_equivalent_spellings_share_key(self):
+        self.assertSameKey('Реши: 2 × 3 + 4²', 'реши:2*3+4^2')
+        self.assertSameKey('x = 2,5', 'x=2.5')
+        self.assertSameKey('3,50 + 1', '3.5+1')
+        self.assertSameKey('Ёлка', 'елка')
+
+    def test_thousands_separators_joined_in_long_numbers(self):
+        self.assertSameKey('10 000 + 5', '10000+5')
+        self.assertSameKey('1 000 000', '1000000')
+        self.assertSameKey('1\u00a0100 рублей', '1100 рублей')
+        self.assertEqual(normalize_problem_text('10 000,5'), '10000.5')
+
+    def test_separate_numbers_not_merged(self):
+        self.assertDifferentKey('корни 1 100', 'корни 1100')
+        self.assertDifferentKey('числа 5 250 и 7', 'числа 5250 и 7')
+
+    def test_commas_inside_brackets_kept(self):
+        self.assertDifferentKey('точка (2,3)', 'точка (2.3)')
+        self.assertDifferentKey('множество {1,5; 2}', 'множество {1.5; 2}')
+        self.assertEqual(normalize_problem_text('f(2,5) и 2,5'), 'f(2,5)и 2.5')
+
+    def test_lists_not_treated_as_decimals(self):
+        self.assertDifferentKey('числа 1,2,3', 'числа 1.2,3')
+
+    def test_variable_case_kept(self):
+        self.assertDifferentKey('V = 2v, найдите v', 'v = 2V, найдите v')
+        self.assertDifferentKey('точки AB и CD', 'точки ab и cd')
+        self.assertSameKey('РЕШИТЕ: Sin x = 1', 'решите: sin x = 1')
+
+
+def make_page(lines, width=400, height=300):
+    """Синтетическая страница: черные полосы-строки на белом фоне"""
+    image = np.full((height, width), 255, np.uint8)
+    for top, length in lines:
+        cv2.rectangle(image, (20, top), (20 + length, top + 12), 0, -1)
+    return image
+
+
+def make_exercises(numbers, shift=0):
+    """Лист упражнений одной верстки: строки вида «1) 2x + 5 = 11» с заданными числами"""
+    image = np.full((1200, 900), 235, np.uint8)
+    for index, number in enumerate(numbers):
+        line = f'{index + 1}) {number}x + {number + 3} = {2 * number + 7}'
+        cv2.putText(image, line, (60 + shift, 90 + index * 90 + shift), cv2.FONT_HERSHEY_SIMPLEX, 1.6, 20, 3)
+    return image
+
+
+@override_settings(OCR_CACHE_ENABLED=True, OCR_CACHE_MAX_DISTANCE=3, OCR_CACHE_MAX_VERIFY_DISTANCE=4)
+class OcrCacheTests(TestCase):
+    """Поиск распознанного текста по отпечатку изображения"""
+
+    def test_hash_bands_split_hash_into_16_bit_parts(self):
+        self.assertEqual(hash_bands(0x0004_0003_0002_0001), [1, 2, 3, 4])
+        self.assertEqual(hamming_distance(0b1011, 0b0001), 2)
+
+    def test_same_image_hits(self):
+        page = make_page([(40, 300), (80, 200)])
+        store_text(image_fingerprint(page), 'x + 1 = 2')
+        self.assertEqual(find_cached_text(image_fingerprint(page.copy())), 'x + 1 = 2')
+        self.assertEqual(OcrResult.objects.get().hits, 1)
+
+    def test_different_size_misses(self):
+        page = make_page([(40, 300), (80, 200)])
+        store_text(image_fingerprint(page), 'x + 1 = 2')
+        resized = cv2.resize(page, (420, 315), interpolation=cv2.INTER_AREA)
+        self.assertIsNone(find_cached_text(image_fingerprint(resized)))
+
+    def test_verify_hash_mismatch_misses(self):
+        fingerprint = image_fingerprint(make_page([(40, 300), (80, 200)]))
+        store_text(fingerprint, 'x + 1 = 2')
+        self.assertIsNone(find_cached_text({**fingerprint, 'dhash': fingerprint['dhash'] ^ 0b11111}))
+
+    def test_reencoded_or_shifted_photo_hits(self):
+        store_text(image_fingerprint(make_exercises(range(12))), 'задачи 1-12')
+        _, buffer = cv2.imencode('.jpg', make_exercises(range(12)), [cv2.IMWRITE_JPEG_QUALITY, 40])
+        self.assertEqual(find_cached_text(image_fingerprint(cv2.imdecode(buffer, cv2.IMREAD_GRAYSCALE))), 'задачи 1-12')
+        self.assertEqual(find_cached_text(image_fingerprint(make_exercises(range(12), shift=4))), 'задачи 1-12')
+
+    def test_other_page_with_same_layout_misses(self):
+        store_text(image_fingerprint(make_exercises(range(12))), 'задачи 1-12')
+        self.assertIsNone(find_cached_text(image_fingerprint(make_exercises(range(20, 32)))))
+
+    def test_exact_hash_found_among_many_near_candidates(self):
+        fingerprint = image_fingerprint(make_page([(40, 300), (80, 200)]))
+        store_text(fingerprint, 'x + 1 = 2')
+        # Записи с тем же младшим участком хэша, использованные позже: выше в порядке по last_used_at
+        for index in range(1, 6):
+            store_text({**fingerprint, 'phash': fingerprint['phash'] ^ (index << 48), 'width': 1}, f'другая {index}')
+        with mock.patch('bot.ocr_cache.MAX_CANDIDATES', 2):
+            self.assertEqual(find_cached_text(fingerprint), 'x + 1 = 2')
+
+    def test_rows_without_verify_hash_never_match(self):
+        fingerprint = image_fingerprint(make_page([(40, 300)]))
+        store_text(fingerprint, 'x + 1 = 2')
+        OcrResult.objects.update(verify_hash='')
+        self.assertIsNone(find_cached_text(fingerprint))
+
+    @override_settings(OCR_CACHE_TTL=3600, OCR_CACHE_MAX_ENTRIES=2, OCR_CACHE_PRUNE_EVERY=1000)
+    def test_prune_removes_expired_and_oldest(self):
+        now = timezone.now()
+        for index, age in enumerate([2, 30, 40, 90 * 60]):
+            store_text(image_fingerprint(make_page([(40 + index * 30, 300)])), f'задача {index}')
+            OcrResult.objects.filter(text=f'задача {index}').update(last_used_at=now - timedelta(seconds=age))
+        self.assertEqual(prune_ocr_cache(), 2)
+        self.assertEqual(sorted(OcrResult.objects.values_list('text', flat=True)), ['задача 0', 'задача 1'])
+
+
+@override_settings(SOLUTION_STREAMING_ENABLED=True, CACHE_REDIS_URL='')
+class StreamingTests(SimpleTestCase):
+    """История событий SSE: продолжение после переподключения и сброс шагов при повторе этапа"""
+
+    def collect(self, task_id, last_seq=0):
+        return [event for event in listen(task_id, 0.2, 0.05, last_seq) if event is not None]
+
+    def test_reconnect_receives_only_new_events(self):
+        task_id = uuid.uuid4()
+        publish_step(task_id, 1, '<li>a</li>')
+        publish_step(task_id, 2, '<li>b</li>')
+        publish_status(task_id, 'completed')
+        self.assertEqual([event['seq'] for event in self.collect(task_id, last_seq=1)], [2, 3])
+
+    def test_retry_drops_published_steps(self):
+        task_id = uuid.uuid4()
+        publish_status(task_id, 'solving')
+        publish_step(task_id, 1, '<li>a</li>')
+        reset_steps(task_id)
+        publish_step(task_id, 1, '<li>a</li>')
+        publish_status(task_id, 'completed')
+        events = self.collect(task_id)
+        self.assertEqual([event['event'] for event in events], ['status', 'reset', 'step', 'status'])
+        self.assertEqual([event['seq'] for event in events], [1, 3, 4, 5])
+
+
+def encode(image, extension):
+    ok, buffer = cv2.imencode(extension, image)
+    return buffer.tobytes()
+
+
+@override_settings(PREPROCESS_MAX_PIXELS=40_000, PREPROCESS_MAX_FULL_DECODE_PIXELS=1_000_000,
+                   PREPROCESS_MAX_SOURCE_PIXELS=4_000_000, VISION_MAX_LONG_SIDE=2048)
+class DecodeImageTests(SimpleTestCase):
+    """Декодирование в бюджет пикселей"""
+
+    def test_png_over_budget_is_reduced(self):
+        image = decode_image(encode(make_page([(40, 300)], width=400, height=300), '.png'))
+        self.assertEqual(image.shape, (150, 200))
+        self.assertTrue(image.flags.writeable)
+
+    def test_jpeg_over_budget_is_reduced_while_decoding(self):
+        self.assertEqual(decode_factor(400, 300, 'JPEG'), 2)
+        self.assertEqual(decode_image(encode(make_page([(40, 300)]), '.jpg')).shape, (150, 200))
+
+    def test_too_large_asks_for_retake(self):
+        with self.assertRaises(ImageQualityError) as context:
+            decode_factor(1200, 1000, 'PNG')
+        self.assertEqual(context.exception.reason, 'too_large')
+        with self.assertRaises(ImageQualityError):
+            decode_factor(2100, 2000, 'JPEG')
+        # Даже 1/8 не помещается в бюджет
+        with self.assertRaises(ImageQualityError):
+            decode_factor(1900, 1900, 'JPEG')
+
+    def test_decompression_bomb_asks_for_retake(self):
+        # Заголовок больше предела Pillow: не общая ошибка с повтором задачи, а просьба переснять
+        with mock.patch.object(Image, 'MAX_IMAGE_PIXELS', 10_000), self.assertRaises(ImageQualityError) as context:
+            decode_image(encode(make_page([(40, 300)]), '.jpg'))
+        self.assertEqual(context.exception.reason, 'too_large')
+
+
+def make_worksheet():
+    """Страница целиком: две задачи мелким текстом в разных углах"""
+    image = np.full((2400, 1800), 255, np.uint8)
+    for left, top, lines in [(150, 300, ['1) 2x + 3 = 7', 'find x']), (900, 1900, ['2) x^2 - 5x + 6 = 0', 'solve it'])]:
+        for index, line in enumerate(lines):
+            cv2.putText(image, line, (left, top + index * 60), cv2.FONT_HERSHEY_SIMPLEX, 1.2, 0, 2)
+    return image
+
+
+class ProblemRegionTests(SimpleTestCase):
+    """Обрезка страницы перед OCR"""
+
+    def test_union_blocks(self):
+        self.assertEqual(union_blocks([(10, 20, 30, 40), (100, 5, 10, 10)]), (10, 5, 100, 55))
+
+    def test_all_problems_kept_by_default(self):
+        region, changed = extract_problem_region(make_worksheet())
+        self.assertTrue(changed)
+        # Обе задачи: от первой строки сверху до последней внизу
+        self.assertGreater(region.shape[0], 1600)
+        self.assertGreater(region.shape[1], 1000)
+
+    @override_settings(PREPROCESS_CROP_MODE='center')
+    def test_single_block_is_opt_in(self):
+        region, _ = extract_problem_region(make_worksheet())
+        self.assertLess(region.shape[0], 400)
+
+
+@override_settings(PROBLEM_FANOUT_ENABLED=True, PROBLEM_FANOUT_MAX=4)
+class SplitProblemsTests(SimpleTestCase):
+    """Разбиение текста на независимые задачи"""
+
+    def test_numbered_problems_with_common_instruction(self):
+        problems = split_problems('Решите уравнения:\n1) 2x + 3 = 7\n2) x^2 - 5x + 6 = 0')
+        self.assertEqual([problem['label'] for problem in problems], ['1', '2'])
+        self.assertEqual(problems[1]['text'], 'Решите уравнения:\n2) x^2 - 5x + 6 = 0')
+
+    def test_items_with_own_instructions(self):
+        problems = split_problems('1) Найдите 15% от 80.\n2) Упростите 3a + 2a.')
+        self.assertEqual(len(problems), 2)
+
+    def test_groups_when_more_than_max(self):
+        text = 'Вычислите:\n' + '\n'.join(f'{number}) {number} + {number}' for number in range(1, 9))
+        self.assertEqual([problem['label'] for problem in split_problems(text)], ['1–2', '3–4', '5–6', '7–8'])
+
+    def test_system_of_equations_not_split(self):
+        self.assertEqual(split_problems('Решите систему уравнений:\n1) x + y = 3\n2) x - y = 1'), [])
+        self.assertEqual(split_problems('Решите совокупность:\n1) x > 2\n2) x < -1'), [])
+        self.assertEqual(split_problems('Решите { \n1) x + y = 3\n2) x - y = 1'), [])
+
+    def test_items_without_instruction_not_split(self):
+        self.assertEqual(split_problems('1) x + y = 3\n2) x - y = 1'), [])
+        self.assertEqual(split_problems('1) Найдите x, если\n2) x + 1 = 3'), [])
+
+    def test_decimal_not_treated_as_number(self):
+        self.assertEqual(split_problems('Вычислите: 1.5 + 2.5'), [])
+
+
+@override_settings(LOCAL_SOLVER_ENABLED=True)
+class LocalSolverTests(SimpleTestCase):
+    """Локальное решение простых задач без LLM"""
+
+    def answer(self, text):
+        solution = solve_locally(text)
+        self.assertIsNotNone(solution, text)
+        return solution.rsplit('<strong>Ответ:</strong> ', 1)[1].split('</li>')[0]
+
+    def test_colon_is_division(self):
+        self.assertEqual(self.answer('48 : 6 + 2'), '10')
+        self.assertEqual(self.answer('100 : 4 - 5'), '20')
+        self.assertEqual(self.answer('(2 + 3) : (4 - 1)'), '5/3 ≈ 1.6667')
+        self.assertEqual(split_problem('Вычислите: 5 : 2'), ({'вычислите'}, '5/2'))
+
+    def test_colon_after_label_or_variable_ends_condition(self):
+        self.assertEqual(split_problem('Задача 5: 2x + 3 = 7'), (set(), '2x+3=7'))
+        self.assertEqual(split_problem('Найдите x: 2x + 3 = 7')[1], '2x+3=7')
+
+    def test_separate_numbers_not_concatenated(self):
+        for text in ['3, 4', 'x + 1, -2', '2 x + 1', '1; 2']:
+            with self.assertRaises(NotSupported, msg=text):
+                split_problem(text)
+        self.assertIsNone(solve_locally('3, 4'))
+
+    def test_equations(self):
+        self.assertEqual(self.answer('Реши уравнение 3х - 4 = 11'), 'x = 5')
+        self.assertEqual(self.answer('2) x^2 - 5x + 6 = 0'), 'x₁ = 2, x₂ = 3')
+
+    def test_instruction_word_before_bracket(self):
+        self.assertEqual(split_problem('упростите (a+b)^2'), ({'упростите'}, '(a+b)^2'))
+        self.assertEqual(split_problem('раскройте скобки (x+1)(x+2)'), ({'раскройте', 'скобки'}, '(x+1)(x+2)'))
+        self.assertEqual(self.answer('упростите (a+b)^2'), 'a² + 2a×b + b²')
+        self.assertEqual(self.answer('раскройте скобки (x+1)(x+2)'), 'x² + 3x + 2')
+        self.assertEqual(self.answer('Упростите (x^2 - 1)/(x - 1)'), 'x + 1')
+        # sqrt перед скобкой — часть выражения, а не слово условия
+        self.assertEqual(split_problem('найдите sqrt(16)')[1], 'sqrt(16)')
+
+    def test_unsupported_goes_to_llm(self):
+        self.assertIsNone(solve_locally('Найдите сумму корней x^2 - 5x + 6 = 0'))
+        self.assertIsNone(solve_locally('2^999999'))
+
+
+@override_settings(
+    LLM_RATE_LIMIT_ENABLED=True, LLM_RATE_LIMIT_CACHE='default', LLM_RATE_LIMIT_RPM=60, LLM_RATE_LIMIT_TPM=1000,
+    LLM_RATE_LIMIT_MAX_WAIT=0, LLM_CONCURRENCY_INITIAL=4, LLM_CONCURRENCY_MIN=2, LLM_CONCURRENCY_MAX=8,
+    LLM_CONCURRENCY_DECREASE=0.5, LLM_CONCURRENCY_LATENCY_DECREASE=0.9, LLM_LATENCY_TARGET=30,
+)
+class RateLimiterTests(SimpleTestCase):
+    """Ведра RPM/TPM и AIMD-лимит конкурентности запросов к OpenAI"""
+
+    def setUp(self):
+        caches['default'].delete(STATE_KEY)
+
+    def state(self):
+        return caches['default'].get(STATE_KEY)
+
+    def test_token_bucket_rejects_when_empty(self):
+        permit = acquire(900)
+        self.assertAlmostEqual(self.state()['tokens'], 100, delta=1)
+        with self.assertRaises(RateLimitExceeded):
+            acquire(500)
+        # Неизрасходованная часть оценки возвращается в ведро
+        release(permit, used_tokens=400)
+        self.assertIsNotNone(acquire(500))
+
+    def test_concurrency_slots(self):
+        permits = [acquire(10) for _ in range(4)]
+        with self.assertRaises(RateLimitExceeded):
+            acquire(10)
+        release(permits[0])
+        self.assertIsNotNone(acquire(10))
+
+    def test_multiplicative_decrease_on_429(self):
+        with self.assertLogs('bot.ratelimit', 'WARNING'):
+            release(acquire(10), rate_limited=True)
+            self.assertEqual(self.state()['limit'], 2)
+            release(acquire(10), rate_limited=True)
+            self.assertEqual(self.state()['limit'], 2)  # не ниже LLM_CONCURRENCY_MIN
+
+    def test_additive_increase_on_success(self):
+        release(acquire(10))
+        self.assertAlmostEqual(self.state()['limit'], 4.25)
+
+    @override_settings(LLM_LATENCY_TARGET=-1)
+    def test_slow_response_decreases_gently(self):
+        release(acquire(10))
+        self.assertAlmostEqual(self.state()['limit'], 3.6)
+
+    def test_failure_keeps_limit(self):
+        release(acquire(10), failed=True)
+        self.assertEqual(self.state()['limit'], 4)
+
+    @mock.patch('bot.ratelimit.LOCK_TTL', 0.05)
+    def test_held_lock_raises_instead_of_running_unlocked(self):
+        permit = acquire(10)
+        caches['default'].set(LOCK_KEY, 'other worker', timeout=60)
+        with self.assertRaises(LockTimeout):
+            acquire(10)
+        # Слот не освобожден, но release не роняет вызов: аренда истечет сама
+        with self.assertLogs('bot.ratelimit', 'WARNING'):
+            release(permit)
+        caches['default'].delete(LOCK_KEY)
+        self.assertEqual(len(self.state()['leases']), 1)
+
+
+@override_settings(LLM_ROUTING_ENABLED=True, LLM_ROUTING_CHARS_PER_POINT=150, LLM_ROUTING_OPERATORS_PER_POINT=6,
+                   LLM_ROUTING_TOKENS_PER_CHAR=3)
+class RoutingTests(SimpleTestCase):
+    """Оценка сложности задачи и выбор модели"""
+
+    def test_difficulty_score(self):
+        self.assertEqual(difficulty_score('2 + 2'), 0)
+        # Тема дает 2 балла, каждые 6 операторов — 1
+        self.assertEqual(difficulty_score('Найдите производную y = x^2 + 3x - 1 + 2x - 5 + x'), 3)
+        self.assertEqual(difficulty_score('Задача для 3 класса: 7 + 5'), -1)
+        self.assertEqual(difficulty_score('11 класс: скорость и ускорение'), 6)
+
+    def test_route_by_score(self):
+        self.assertEqual(choose_route('2 + 2')['name'], 'light')
+        self.assertEqual(choose_route('Докажите теорему')['name'], 'standard')
+        self.assertEqual(choose_route('Решите систему неравенств с параметром a')['name'], 'heavy')
+
+    def test_max_tokens_grows_with_text_within_route_bounds(self):
+        self.assertEqual(choose_route('2 + 2')['max_tokens'], 415)
+        # Длинное, но простое условие остается на легкой модели с ее потолком max_tokens
+        route = choose_route('Сколько будет ' * 10 + '2 + 2')
+        self.assertEqual((route['name'], route['max_tokens']), ('light', 800))
+
+    @override_settings(LLM_ROUTING_ENABLED=False, LLM_DEFAULT_ROUTE='heavy')
+    def test_disabled_routing_uses_default(self):
+        self.assertEqual(choose_route('2 + 2')['name'], 'heavy')
+
+
+@override_settings(BREAKER_ENABLED=True, LLM_RATE_LIMIT_CACHE='default', BREAKER_FAILURE_THRESHOLD=3,
+                   BREAKER_RESET_TIMEOUT=30, BREAKER_PROBE_TIMEOUT=90)
+class BreakerTests(SimpleTestCase):
+    """Переходы предохранителя: замкнут -> разомкнут -> проба -> замкнут или снова разомкнут"""
+
+    def setUp(self):
+        caches['default'].clear()
+        self.name = 'completion'
+
+    def open_breaker(self):
+        with self.assertLogs('bot.breaker', 'WARNING'):
+            for _ in range(3):
+                record_failure(self.name)
+
+    def expire_pause(self):
+        caches['default'].set(f'breaker:{self.name}:opened', time.time() - 31, timeout=None)
+
+    def test_opens_after_threshold(self):
+        record_failure(self.name)
+        record_failure(self.name)
+        allow(self.name)
+        self.assertEqual(state(self.name)['state'], 'closed')
+        self.open_breaker()
+        self.assertEqual(state(self.name)['state'], 'open')
+        with self.assertRaises(CircuitOpen):
+            allow(self.name)
+
+    def test_success_resets_failures(self):
+        record_failure(self.name)
+        record_failure(self.name)
+        record_success(self.name)
+        record_failure(self.name)
+        self.assertEqual(state(self.name), {'state': 'closed', 'failures': 1, 'retry_in': 0})
+
+    def test_single_probe_closes_on_success(self):
+        self.open_breaker()
+        self.expire_pause()
+        self.assertEqual(state(self.name)['state'], 'half_open')
+        allow(self.name)
+        # Пока проба в полете, остальные запросы ждут
+        with self.assertRaises(CircuitOpen):
+            allow(self.name)
+        record_success(self.name)
+        self.assertEqual(state(self.name)['state'], 'closed')
+        allow(self.name)
+
+    def test_failed_probe_reopens(self):
+        self.open_breaker()
+        self.expire_pause()
+        allow(self.name)
+        with self.assertLogs('bot.breaker', 'WARNING'):
+            record_failure(self.name)
+        self.assertEqual(state(self.name)['state'], 'open')
+        with self.assertRaises(CircuitOpen):
+            allow(self.name)
+
+    def test_probe_released_on_any_outcome(self):
+        self.open_breaker()
+        self.expire_pause()
+        probe = allow(self.name)
+        # Чужой токен (проба после следующей паузы) ключ не снимает
+        release_probe(self.name, 'other probe')
+        with self.assertRaises(CircuitOpen):
+            allow(self.name)
+        release_probe(self.name, probe)
+        self.assertEqual(state(self.name)['state'], 'half_open')
+        self.assertIsNotNone(allow(self.name))
+
+    @override_settings(LLM_RATE_LIMIT_ENABLED=False, LLM_RATE_LIMIT_RETRIES=0)
+    def test_probe_ending_in_429_does_not_block(self):
+        self.open_breaker()
+        self.expire_pause()
+        response = httpx.Response(429, request=httpx.Request('POST', 'https://api.openai.com/v1/chat/completions'))
+        client = mock.Mock()
+        client.chat.completions.create.side_effect = openai.RateLimitError('429', response=response, body=None)
+        with mock.patch('bot.llm.get_client', return_value=client), self.assertRaises(openai.RateLimitError):
+            llm.chat_completion(model='gpt-4o', messages=[])
+        # Сервис ответил: следующий запрос сразу становится новой пробой, а не ждет BREAKER_PROBE_TIMEOUT
+        self.assertIsNotNone(allow(self.name))
+
+
+class MonospaceFont:
+    """Шрифт, у которого ширина строки равна числу символов"""
+
+    def getlength(self, text):
+        return len(text)
+
+
+class RenderingTextTests(SimpleTestCase):
+    """Разбор решения и перенос строк для изображения"""
+
+    def test_wrap_by_words(self):
+        self.assertEqual(wrap_text('aaa bbb ccc dd', MonospaceFont(), 7), ['aaa bbb', 'ccc dd'])
+        self.assertEqual(wrap_text('', MonospaceFont(), 7), [''])
+
+    def test_long_word_split_by_characters(self):
+        lines = wrap_text('x ' + 'a' * 17, MonospaceFont(), 7)
+        self.assertEqual(lines, ['x', 'aaaaaaa', 'aaaaaaa', 'aaa'])
+
+    def test_parse_solution_steps(self):
+        solution = '<ol>\n<li><strong>Шаг 1:</strong> x^2 = 4</li>\n<li><strong>Ответ:</strong> x = &plusmn;2</li>\n</ol>'
+        self.assertEqual(parse_solution(solution), [('Шаг 1:', 'x² = 4'), ('Ответ:', 'x = ±2')])
+
+    def test_parse_plain_answer(self):
+        self.assertEqual(parse_solution('Первая строка<br>\n\nВторая'), [('', 'Первая строка'), ('', 'Вторая')])
+
+    def test_format_formulas(self):
+        self.assertEqual(format_formulas(r'$\frac{a+1}{2} + \sqrt{x}$'), '(a+1)/2 + √x')
+        self.assertEqual(format_formulas('x_1 + y^{10}'), 'x₁ + y¹⁰')
+        self.assertEqual(format_formulas('2^{k+m}'), '2^(k+m)')
+
+
+class CompactRenderingTests(SimpleTestCase):
+    """Кодирование изображения решения в бюджет варианта"""
+
+    solution = '<ol>' + ''.join(
+        f'<li><strong>Шаг {step}:</strong> x^2 - 5x + 6 = 0, D = 25 - 24 = 1</li>' for step in range(1, 30)
+    ) + '</ol>'
+
+    def decode(self, encoded):
+        return cv2.imdecode(np.frombuffer(encoded, np.uint8), cv2.IMREAD_UNCHANGED)
+
+    def test_formats(self):
+        self.assertTrue(render_solution(self.solution, image_format='png').startswith(b'\x89PNG'))
+        webp = render_solution(self.solution, image_format='webp')
+        self.assertEqual((webp[:4], webp[8:12]), (b'RIFF', b'WEBP'))
+
+    def test_variants_fit_budget(self):
+        for variant, options in settings.SOLUTION_IMAGE_VARIANTS.items():
+            for image_format in ('png', 'webp'):
+                encoded = render_solution(self.solution, variant, image_format)
+                self.assertLessEqual(len(encoded), options['max_bytes'])
+        mobile = self.decode(render_solution(self.solution, 'mobile'))
+        self.assertEqual(mobile.shape[1], settings.SOLUTION_IMAGE_VARIANTS['mobile']['width'])
+
+    def test_over_budget_returns_smallest(self):
+        variants = {'full': {**settings.SOLUTION_IMAGE_VARIANTS['full'], 'max_bytes': 100}}
+        with override_settings(SOLUTION_IMAGE_VARIANTS=variants), mock.patch('bot.rendering.metrics.incr') as incr:
+            encoded = render_solution(self.solution)
+        incr.assert_called_once_with('render.over_budget')
+        self.assertGreater(len(encoded), 100)
+        self.assertIsNotNone(self.decode(encoded))
+
+
+class SolutionImageCacheTests(SimpleTestCase):
+    """Дисковый кэш изображений решений: попадания и вытеснение давно не запрошенных"""
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings_override = override_settings(SOLUTION_IMAGE_CACHE_DIR=self.directory, SOLUTION_IMAGE_CACHE_MAX_BYTES=250)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def put(self, name, size, age):
+        path = os.path.join(self.directory, name)
+        store_image(path, b'x' * size)
+        os.utime(path, (time.time() - age, time.time() - age))
+        return path
+
+    def test_evicts_least_recently_used_until_under_limit(self):
+        oldest = self.put('a-full.png', 100, age=300)
+        older = self.put('b-full.png', 100, age=200)
+        newest = self.put('c-full.webp', 100, age=100)
+        self.put('d-full.png.1.2.tmp', 1000, age=400)  # недописанный файл соседнего запроса
+        self.assertEqual(evict(), 1)
+        self.assertFalse(os.path.exists(oldest))
+        self.assertTrue(os.path.exists(older) and os.path.exists(newest))
+
+    def test_hit_refreshes_last_use(self):
+        solution = '<ol><li>2 + 2 = 4</li></ol>'
+        path = _path(image_key(solution), 'full', 'png')
+        self.put(os.path.basename(path), 100, age=300)
+        self.put('b-full.png', 100, age=200)
+        self.assertEqual(get_solution_image(solution), b'x' * 100)
+        self.put('c-full.png', 100, age=100)
+        evict()
+        # Запрошенное изображение стало самым свежим, вытесняется следующее по давности
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'b-full.png')))
+
+    def test_key_depends_on_solution_and_version(self):
+        self.assertNotEqual(image_key('a'), image_key('b'))
+        with override_settings(SOLUTION_IMAGE_VERSION='other'):
+            changed = image_key('a')
+        self.assertNotEqual(image_key('a'), changed)
+
+    @override_settings(SOLUTION_IMAGE_EVICT_EVERY=3)
+    @mock.patch('bot.image_cache._writes', 0)
+    def test_evicts_every_n_misses(self):
+        with mock.patch('bot.image_cache.render_solution_image', return_value=b'x'), \
+                mock.patch('bot.image_cache.evict') as evict_mock:
+            for number in range(7):
+                get_solution_image(f'{number} + 1')
+        # Каталог обходится на 3-м и 6-м промахе, а не на каждом
+        self.assertEqual(evict_mock.call_count, 2)
+
+
+class RenderPoolTests(SimpleTestCase):
+    """Отрисовка через пул процессов: ошибки пула и нехватка времени"""
+
+    solution = '<ol><li>2 + 2 = 4</li></ol>'
+
+    def pool(self, error):
+        pool = mock.Mock()
+        pool.submit.return_value.result.side_effect = error
+        patcher = mock.patch('bot.rendering._get_pool', return_value=pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return pool
+
+    def test_worker_error_renders_inline(self):
+        self.pool(ValueError('font'))
+        with self.assertLogs('bot.rendering', 'WARNING'):
+            image = render_solution_image(self.solution)
+        self.assertEqual(image, render_solution(self.solution))
+
+    def test_timeout_raises_busy(self):
+        pool = self.pool(TimeoutError())
+        with mock.patch('bot.rendering.render_solution') as inline, self.assertRaises(RenderBusy):
+            render_solution_image(self.solution)
+        inline.assert_not_called()
+        pool.submit.return_value.cancel.assert_called_once()
+
+
+class SolutionImageViewTests(TestCase):
+    """Отдача изображения решения, когда пул рендеринга не успевает"""
+
+    @override_settings(SOLUTION_RENDER_RETRY_AFTER=7)
+    def test_busy_render_returns_503_with_retry_after(self):
+        user = User.objects.create(telegram_id=1, first_name='a', chat_id=1)
+        task = Task.objects.create(user=user, description='2+2', status='completed', solution='4')
+        with mock.patch('bot.views.get_solution_image', side_effect=RenderBusy('занят')), \
+                self.assertLogs('bot.views', 'WARNING'):
+            response = self.client.get(reverse('task-solution-image', args=[task.id]))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '7')
+
+
+@override_settings(LLM_RATE_LIMIT_CACHE='default', TELEGRAM_GLOBAL_RATE=10, TELEGRAM_GLOBAL_BURST=3,
+                   TELEGRAM_CHAT_INTERVAL=1.0, TELEGRAM_GROUP_INTERVAL=3.0, TELEGRAM_MAX_INLINE_WAIT=0.5)
+class TelegramScheduleTests(SimpleTestCase):
+    """GCRA-расписание отправок: общий лимит бота, интервал чата и штраф после 429"""
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_global_burst_then_spacing(self):
+        waits = [reserve(chat_id)[0] for chat_id in range(1, 5)]
+        # Три сообщения разным чатам уходят сразу, четвертое ждет интервала 1/10 с
+        self.assertEqual(waits[:3], [0, 0, 0])
+        self.assertAlmostEqual(waits[3], 0.1, delta=0.02)
+
+    def test_same_chat_waits_interval(self):
+        self.assertEqual(reserve(42), (0, True))
+        wait, reserved = reserve(42)
+        self.assertFalse(reserved)
+        self.assertAlmostEqual(wait, 1.0, delta=0.02)
+
+    def test_groups_wait_longer(self):
+        reserve(-100)
+        self.assertAlmostEqual(reserve(-100)[0], 3.0, delta=0.02)
+
+    def test_deferred_message_not_booked(self):
+        reserve(42)
+        at = caches['default'].get(GLOBAL_KEY)
+        self.assertFalse(reserve(42)[1])
+        self.assertEqual(caches['default'].get(GLOBAL_KEY), at)
+
+    def test_penalize_blocks_chat_for_retry_after(self):
+        penalize(7, 30)
+        wait, reserved = reserve(7)
+        self.assertFalse(reserved)
+        self.assertAlmostEqual(wait, 30, delta=0.1)
+        self.assertTrue(reserve(8)[1])
+
+    def message(self, chat_id=7):
+        return {'method': 'sendMessage', 'payload': {'chat_id': chat_id}, 'created': time.time(), 'attempt': 0}
+
+    def test_open_breaker_checked_before_schedule(self):
+        caches['default'].set('breaker:telegram:opened', time.time(), timeout=None)
+        with mock.patch('bot.telegram_dispatch.get_client') as client:
+            self.assertGreater(deliver(self.message()), 0)
+        client.assert_not_called()
+        # Отложенное сообщение не заняло слот общего лимита бота
+        self.assertIsNone(caches['default'].get(GLOBAL_KEY))
+
+    def test_probe_ending_in_429_released(self):
+        caches['default'].set('breaker:telegram:opened', time.time() - 31, timeout=None)
+        response = httpx.Response(429, json={'parameters': {'retry_after': 5}})
+        with mock.patch('bot.telegram_dispatch.get_client') as client, self.assertLogs('bot.telegram_dispatch', 'WARNING'):
+            client.return_value.post.return_value = response
+            self.assertEqual(deliver(self.message()), 5)
+        self.assertEqual(state('telegram')['state'], 'half_open')
+        self.assertIsNotNone(allow('telegram'))
+
+    @mock.patch('bot.ratelimit.LOCK_TTL', 0.05)
+    def test_message_deferred_while_schedule_locked(self):
+        caches['default'].set(SCHEDULE_LOCK_KEY, 'other worker', timeout=60)
+        message = self.message()
+        with mock.patch('bot.telegram_dispatch.get_client') as client, self.assertLogs('bot.telegram_dispatch', 'WARNING'):
+            self.assertEqual(deliver(message), 0.05)
+        client.assert_not_called()
+        self.assertEqual(message['attempt'], 0)
+
+
+@override_settings(TASK_PRIORITY_LANES={
+    'subscriber': {'base_priority': 0, 'lowest_priority': 4, 'weight': 3},
+    'trial': {'base_priority': 5, 'lowest_priority': 9, 'weight': 1},
+})
+class FairPriorityTests(TestCase):
+    """Полосы приоритета и честное распределение очереди между пользователями"""
+
+    def setUp(self):
+        self.user = User.objects.create(telegram_id=1, first_name='a', chat_id=1)
+
+    def add_tasks(self, count, status='pending'):
+        return [Task.objects.create(user=self.user, description='2+2', status=status) for _ in range(count)]
+
+    def test_lane(self):
+        self.assertEqual(choose_lane(True), 'subscriber')
+        self.assertEqual(choose_lane(False), 'trial')
+
+    def test_backlog_lowers_priority_by_weight(self):
+        tasks = self.add_tasks(4)
+        self.assertEqual(fair_priority(tasks[0], 'subscriber'), 1)
+        self.assertEqual(fair_priority(tasks[0], 'trial'), 8)
+
+    def test_priority_stays_within_lane(self):
+        tasks = self.add_tasks(30)
+        self.assertEqual(fair_priority(tasks[0], 'subscriber'), 4)
+        self.assertEqual(fair_priority(tasks[0], 'trial'), 9)
+
+    def test_finished_tasks_not_counted(self):
+        self.add_tasks(5, status='completed')
+        task, = self.add_tasks(1)
+        self.assertEqual(fair_priority(task, 'trial'), 5)
+
+
+
+@override_settings(TASK_STALE_AFTER=900)
+class ResumableTasksTests(TestCase):
+    """Ручное возобновление из админки не трогает завершенные и еще выполняемые задачи"""
+
+    def test_only_failed_parked_and_stale_tasks(self):
+        user = User.objects.create(telegram_id=1, first_name='a', chat_id=1)
+        now = timezone.now()
+        tasks = {
+            name: Task.objects.create(user=user, description='2+2', status=status, queued_at=queued_at)
+            for name, status, queued_at in [
+                ('completed', 'completed', now - timedelta(hours=1)),
+                ('failed', 'failed', now),
+                ('parked', 'parked', now),
+                ('running', 'solving', now - timedelta(minutes=1)),
+                ('stale', 'solving', now - timedelta(minutes=20)),
+                ('lost', 'pending', None),
+            ]
+        }
+        resumable = resumable_tasks(Task.objects.all()).values_list('id', flat=True)
+        self.assertEqual(set(resumable), {tasks[name].id for name in ['failed', 'parked', 'stale', 'lost']})
+
+
+
+def completion(content):
+    """Ответ chat_completion с одним сообщением"""
+    return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+
+
+@override_settings(IMAGE_SOLVE_MODEL='vision-model', IMAGE_SOLVE_MAX_TOKENS=900, IMAGE_SOLVE_TIMEOUT=15,
+                   SOLUTION_CACHE_ENABLED=False)
+class CombinedSolveTests(SimpleTestCase):
+    """Совмещенный режим: текст и решение одним запросом Vision и возврат к раздельному пути"""
+
+    def test_request_uses_settings(self):
+        reply = completion('{"text": " 2 + 2 ", "solution": "<ol><li>4</li></ol>"}')
+        with mock.patch('bot.tasks.chat_completion', return_value=reply) as request:
+            self.assertEqual(tasks.generate_solution_from_image(b'jpeg', 'image/jpeg'), ('2 + 2', '<ol><li>4</li></ol>'))
+        self.assertEqual(
+            {name: request.call_args.kwargs[name] for name in ('model', 'max_tokens', 'timeout')},
+            {'model': 'vision-model', 'max_tokens': 900, 'timeout': 15},
+        )
+
+    def test_bad_or_incomplete_json_is_value_error(self):
+        for content in ['не JSON', '["2 + 2"]', '{"text": "2 + 2"}', '{"text": "2 + 2", "solution": null}',
+                        '{"text": " ", "solution": "4"}']:
+            with mock.patch('bot.tasks.chat_completion', return_value=completion(content)), \
+                    self.assertRaises(ValueError, msg=content):
+                tasks.generate_solution_from_image(b'jpeg', 'image/jpeg')
+
+    def test_falls_back_to_separate_ocr(self):
+        with mock.patch('bot.tasks.chat_completion', return_value=completion('{"text": "2 + 2"}')), \
+                mock.patch('bot.tasks.get_image_text', return_value='2 + 2') as get_text, \
+                mock.patch('bot.tasks.metrics.incr') as incr, self.assertLogs('bot.tasks', 'WARNING'):
+            self.assertEqual(tasks.get_image_text_and_solution(b'jpeg', 'image/jpeg', None), ('2 + 2', None))
+        get_text.assert_called_once_with(b'jpeg', 'image/jpeg', None)
+        incr.assert_any_call('combined.fallbacks')
+
+@override_settings(PROBLEM_FANOUT_ENABLED=True, SOLUTION_STREAMING_ENABLED=True)
+class FanoutTests(TestCase):
+    """Несколько задач на фото: хорд решений, сборка по номерам и отказ одной из задач"""
+
+    def setUp(self):
+        user = User.objects.create(telegram_id=1, first_name='a', chat_id=1)
+        self.task = Task.objects.create(user=user, description='Вычислите:\n1) 2 + 2\n2) 3 + 3\n3) 4 + 4')
+        self.state = {'task_id': str(self.task.id), 'deadline': time.time() + 60}
+
+    def solve(self, failing=None):
+        def get_solution(text, on_step=None, offline=False):
+            item = text.splitlines()[-1]
+            if item == failing:
+                raise RuntimeError('OpenAI недоступен')
+            return f'<li>Ответ к {item}</li>'
+
+        with mock.patch('bot.tasks.get_solution', side_effect=get_solution) as solve:
+            solve_stage.apply(args=(self.state,))
+        self.task.refresh_from_db()
+        return solve
+
+    def steps(self):
+        events = [event for event in listen(self.task.id, 0.1, 0.05) if event is not None]
+        return [event['data']['html'] for event in events if event['event'] == 'step']
+
+    def test_solutions_assembled_in_problem_order(self):
+        self.solve()
+        self.assertEqual(self.task.raw_solution, '\n'.join([
+            '<ol>',
+            '<li><strong>Задача 1:</strong> 1) 2 + 2</li>', '<li>Ответ к 1) 2 + 2</li>',
+            '<li><strong>Задача 2:</strong> 2) 3 + 3</li>', '<li>Ответ к 2) 3 + 3</li>',
+            '<li><strong>Задача 3:</strong> 3) 4 + 4</li>', '<li>Ответ к 3) 4 + 4</li>',
+            '</ol>',
+        ]))
+
+    def test_failed_problem_keeps_other_steps(self):
+        solve = self.solve(failing='2) 3 + 3')
+        # Первая попытка и три повтора упавшей задачи
+        self.assertEqual(sum(call.args[0].endswith('2) 3 + 3') for call in solve.call_args_list), 4)
+        self.assertEqual(self.task.status, 'failed')
+        self.assertEqual(self.task.raw_solution, '')
+        # Повторы одной задачи не стирают уже показанные решения соседних
+        self.assertIn('<li>Ответ к 1) 2 + 2</li>', self.steps())
+
+    def test_problem_after_deadline_solved_offline_or_parked(self):
+        self.state['deadline'] = time.time() - 1
+        # Повтор задачи начался после срока: арифметику решает локальный решатель, остальное откладывается
+        block = solve_problem_stage.apply(args=(self.state, {'label': '1', 'item': '1) 2 + 2', 'text': '1) 2 + 2'})).get()
+        self.assertTrue(block.startswith('<li><strong>Задача 1:</strong> 1) 2 + 2</li>\n<li>'))
+        with mock.patch('bot.tasks.get_solution', return_value=None) as solve, \
+                mock.patch('bot.tasks.resume_parked_task') as resume:
+            solve_problem_stage.apply(args=(self.state, {'label': '2', 'item': '2) 3 + 3', 'text': '2) 3 + 3'}))
+        self.assertEqual(solve.call_args.kwargs, {'offline': True})
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.status, 'parked')
+        resume.apply_async.assert_called_once()
+
+class PipelineStagesTests(SimpleTestCase):
+    """Возобновление обработки с первого этапа, результат которого не сохранен"""
+
+    def stages(self, **fields):
+        return pipeline_stages(Task(**fields))
+
+    def test_new_image_task_runs_all_stages(self):
+        self.assertEqual(
+            self.stages(image='tasks/a.jpg'),
+            [preprocess_stage, ocr_stage, solve_stage, complete_stage, notify_stage],
+        )
+
+    def test_saved_preprocessing_skipped(self):
+        self.assertEqual(
+            self.stages(image='tasks/a.jpg', processed_image='tasks/a_processed.jpg'),
+            [ocr_stage, solve_stage, complete_stage, notify_stage],
+        )
+
+    def test_recognized_text_skips_image_stages(self):
+        self.assertEqual(self.stages(image='tasks/a.jpg', ocr_text='2+2'), [solve_stage, complete_stage, notify_stage])
+
+    def test_saved_solution_only_completes(self):
+        self.assertEqual(self.stages(description='2+2', raw_solution='<ol></ol>'), [complete_stage, notify_stage])
+
+
+
+@override_settings(PREPROCESS_PERSIST_INTERMEDIATES=False, IMAGE_SOLVE_MODE='separate')
+class ImageStagesTests(TestCase):
+    """Передача обработанного изображения от предобработки к OCR через кэш images"""
+
+    def setUp(self):
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_override = override_settings(MEDIA_ROOT=media.name)
+        media_override.enable()
+        self.addCleanup(media_override.disable)
+        self.tasks_dir = os.path.join(media.name, 'tasks')
+        user = User.objects.create(telegram_id=1, first_name='a', chat_id=1)
+        self.task = Task.objects.create(user=user, source='image')
+        self.task.image.save('page.jpg', ContentFile(encode(make_exercises([2, 5, 7]), '.jpg')))
+        self.state = {'task_id': str(self.task.id)}
+
+    def test_nothing_written_to_media(self):
+        state = preprocess_stage(self.state)
+        self.assertEqual(os.listdir(self.tasks_dir), ['page.jpg'])
+        self.task.refresh_from_db()
+        self.assertFalse(self.task.processed_image)
+        self.assertIsNotNone(caches['images'].get(state['image']['key']))
+
+    @override_settings(IMAGE_QUALITY_GATE_ENABLED=False)
+    def test_crop_not_written_to_media(self):
+        self.task.image.save('worksheet.jpg', ContentFile(encode(make_worksheet(), '.jpg')))
+        with self.assertLogs('bot.tasks', 'INFO') as logs:
+            preprocess_stage(self.state)
+        self.assertIn('(cropped)', '\n'.join(logs.output))
+        self.assertEqual(sorted(os.listdir(self.tasks_dir)), ['page.jpg', 'worksheet.jpg'])
+        self.task.refresh_from_db()
+        self.assertFalse(self.task.processed_image)
+
+    def test_ocr_preprocesses_again_after_eviction(self):
+        state = preprocess_stage(self.state)
+        cached = caches['images'].get(state['image']['key'])
+        caches['images'].delete(state['image']['key'])
+        with mock.patch('bot.tasks.preprocess_image', wraps=tasks.preprocess_image) as preprocess, \
+                mock.patch('bot.tasks.get_image_text', return_value='2x + 5 = 11') as get_text:
+            ocr_stage(state)
+        preprocess.assert_called_once()
+        # В OCR уходит то же изображение, что положила в кэш предобработка
+        self.assertEqual(get_text.call_args.args[:2], (cached, 'image/jpeg'))
+        self.task.refresh_from_db()
+        self.assertEqual(self.task.ocr_text, '2x + 5 = 11')
+
+@override_settings(VISION_IMAGE_FORMAT='jpeg', VISION_IMAGE_QUALITY=80, VISION_MIN_QUALITY=40,
+                   VISION_TARGET_TEXT_HEIGHT=24, VISION_MIN_LONG_SIDE=768, VISION_MAX_LONG_SIDE=2048)
+class VisionEncodingTests(SimpleTestCase):
+    """Уменьшение и сжатие изображения перед загрузкой в Vision"""
+
+    def test_small_text_limited_by_max_long_side(self):
+        self.assertAlmostEqual(vision_scale(make_worksheet()), 2048 / 2400)
+
+    def test_large_text_scaled_down_but_not_below_min_side(self):
+        image = np.full((1200, 1600), 255, np.uint8)
+        for index in range(3):
+            cv2.putText(image, '2x + 3 = 7', (100, 300 + index * 300), cv2.FONT_HERSHEY_SIMPLEX, 5, 0, 12)
+        self.assertAlmostEqual(vision_scale(image), 768 / 1600)
+
+    def test_never_upscaled(self):
+        self.assertEqual(vision_scale(make_page([(40, 300)], width=600, height=400)), 1.0)
+
+    @override_settings(VISION_MAX_BYTES=60_000)
+    def test_quality_lowered_to_fit_byte_budget(self):
+        noise = np.random.default_rng(0).integers(0, 256, (700, 700), dtype=np.uint8)
+        data, mime = encode_for_vision(noise)
+        self.assertEqual(mime, 'image/jpeg')
+        with override_settings(VISION_MAX_BYTES=10_000_000):
+            full_quality, _ = encode_for_vision(noise)
+        self.assertLess(len(data), len(full_quality))
+        self.assertEqual(cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE).shape, (700, 700))
+
+
+
+@override_settings(VISION_TARGET_TEXT_HEIGHT=24, VISION_MIN_LONG_SIDE=768, VISION_MAX_LONG_SIDE=1024)
+class PreprocessProfileTests(SimpleTestCase):
+    """Профили предобработки и бенчмарк bench_preprocess"""
+
+    def test_profile_from_settings(self):
+        page = make_exercises([2, 5, 7])
+        with override_settings(PREPROCESS_PROFILE='none'):
+            self.assertIs(preprocess(page), page)
+        with override_settings(PREPROCESS_PROFILE='fast'):
+            self.assertEqual(preprocess(page).shape, page.shape)
+        with override_settings(PREPROCESS_PROFILE='sharp'), self.assertRaises(ValueError):
+            preprocess(page)
+
+    def test_quality_denoises_at_vision_size(self):
+        # NLM на полном кадре стоил бы секунды: шумоподавляется уже уменьшенное для Vision изображение
+        page = make_exercises([2, 5, 7])
+        self.assertEqual(vision_scale(page), 0.75)
+        self.assertEqual(preprocess(page, 'quality').shape, (900, 675))
+
+    def test_bench_preprocess_reports_each_profile(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cv2.imwrite(os.path.join(directory, 'page.jpg'), make_exercises([2, 5, 7]))
+            output = io.StringIO()
+            call_command('bench_preprocess', directory, '--workers', '1', '--profiles', 'none', 'fast', stdout=output)
+        report = output.getvalue()
+        self.assertIn('Профиль none: ', report)
+        self.assertIn('Профиль fast: ', report)
+        self.assertEqual(report.count('  preprocess: '), 2)
+
+    def test_bench_preprocess_needs_images(self):
+        with tempfile.TemporaryDirectory() as directory, self.assertRaises(CommandError):
+            call_command('bench_preprocess', directory)
+
+@override_settings(IMAGE_MIN_SHARPNESS=15, IMAGE_MIN_BRIGHTNESS=60, IMAGE_MIN_CONTRAST=40, IMAGE_MIN_TEXT_DENSITY=0.003)
+class QualityGateTests(SimpleTestCase):
+    """Отклонение нечитаемых фото до OCR"""
+
+    def setUp(self):
+        # Фото листа крупным планом: двенадцать строк темного текста на светлом фоне
+        self.page = np.full((1200, 900), 235, np.uint8)
+        for index in range(12):
+            cv2.putText(self.page, f'{index + 1}) 2x + {index} = 7', (60, 90 + index * 90),
+                        cv2.FONT_HERSHEY_SIMPLEX, 1.6, 20, 3)
+
+    def assertRejected(self, image, reason):
+        with self.assertRaises(ImageQualityError) as context:
+            check_quality(image)
+        self.assertEqual(context.exception.reason, reason)
+
+    def test_sharp_page_passes(self):
+        self.assertGreater(check_quality(self.page)['sharpness'], 15)
+
+    def test_blank_sheet(self):
+        self.assertRejected(np.full((800, 600), 230, np.uint8), 'no_text')
+
+    def test_dark_photo(self):
+        self.assertRejected(self.page // 6, 'dark')
+
+    def test_washed_out_photo(self):
+        self.assertRejected(200 + self.page // 8, 'low_contrast')
+
+    def test_blurry_photo(self):
+        self.assertRejected(cv2.GaussianBlur(self.page, (0, 0), 6), 'blurry')
+
+
+class FakeStream:
+    """Потоковый ответ chat completions: чанки после задержки, close() отмечает отмену"""
+
+    def __init__(self, text, delay):
+        self.text = text
+        self.delay = delay
+        self.closed = False
+
+    def __iter__(self):
+        time.sleep(self.delay)
+        for word in self.text.split():
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word + ' '), finish_reason=None)])
+
+    def close(self):
+        self.closed = True
+
+
+@override_settings(LLM_HEDGING_ENABLED=True, LLM_HEDGE_MODEL='fast', LLM_HEDGE_MAX_RATIO=0.1, LLM_HEDGE_BURST=2,
+                   LLM_HEDGE_PERCENTILE=0.9, LLM_HEDGE_WINDOW=200, LLM_HEDGE_MIN_SAMPLES=20,
+                   LLM_HEDGE_MIN_DELAY=0.01)
+class HedgingTests(SimpleTestCase):
+    """Порог хеджа по скользящему p90 первого токена, бюджет хеджей и отмена проигравшего"""
+
+    def setUp(self):
+        hedging._first_token.clear()
+        hedging._budget = None
+
+    def stream(self, streams):
+        with mock.patch.object(hedging, 'chat_completion', side_effect=lambda stream, model, **_: streams[model]):
+            chunks = list(hedging.stream_completion(model='slow', messages=[]))
+        return ''.join(chunk.choices[0].delta.content for chunk in chunks)
+
+    def test_no_hedge_until_enough_samples(self):
+        for _ in range(19):
+            hedging.record_first_token('slow', 0.05)
+        self.assertIsNone(hedging.hedge_delay('slow'))
+        streams = {'slow': FakeStream('медленный ответ', 0.2), 'fast': FakeStream('быстрый ответ', 0)}
+        self.assertEqual(self.stream(streams), 'медленный ответ ')
+        self.assertFalse(streams['slow'].closed)
+
+    def test_delay_is_p90(self):
+        for index in range(1, 21):
+            hedging.record_first_token('m', index / 10)
+        self.assertEqual(hedging.hedge_delay('m'), 1.9)
+
+    def test_budget_limits_hedges(self):
+        hedging._earn_budget()
+        self.assertEqual([hedging._spend_budget() for _ in range(3)], [True, True, False])
+        # Доля 0,1: примерно каждый десятый запрос снова дает право на хедж
+        for _ in range(11):
+            hedging._earn_budget()
+        self.assertTrue(hedging._spend_budget())
+
+    def test_hedge_wins_and_primary_is_cancelled(self):
+        for _ in range(20):
+            hedging.record_first_token('slow', 0.05)
+        streams = {'slow': FakeStream('медленный ответ', 1.0), 'fast': FakeStream('быстрый ответ', 0)}
+        self.assertEqual(self.stream(streams), 'быстрый ответ ')
+        self.assertTrue(streams['slow'].closed)
+
+
+class LlmClientTests(SimpleTestCase):
+    """Общий клиент OpenAI процесса: пересоздание после fork и keep-alive соединение"""
+
+    def setUp(self):
+        llm._client = None
+        self.addCleanup(setattr, llm, '_client', None)
+
+    def test_client_shared_within_process(self):
+        self.assertIs(llm.get_client(), llm.get_client())
+
+    def test_client_recreated_after_fork(self):
+        parent = llm.get_client()
+        with mock.patch('bot.llm.os.getpid', return_value=os.getpid() + 1):
+            child = llm.get_client()
+            self.assertIsNot(child, parent)
+            self.assertIs(llm.get_client(), child)
+
+    def test_pooled_client_reuses_connection(self):
+        messages = [{'role': 'user', 'content': '2 + 2'}]
+        with run_standin_server() as server:
+            client = llm.create_client(base_url=server.base_url)
+            for _ in range(3):
+                client.chat.completions.create(model='gpt-4', messages=messages)
+            client.close()
+            self.assertEqual((server.requests, server.connections), (3, 1))
+            for _ in range(3):
+                client = llm.create_client(base_url=server.base_url)
+                client.chat.completions.create(model='gpt-4', messages=messages)
+                client.close()
+            self.assertEqual((server.requests, server.connections), (6, 4))
+
+@override_settings(TASK_DEADLINES={'subscriber': 90, 'trial': 180})
+class DeadlineTests(SimpleTestCase):
+    """Срок задачи полосы, после которого сетевые этапы не ждут OpenAI"""
+
+    def test_deadline_by_lane(self):
+        self.assertEqual(task_deadline('subscriber', 1000.0), 1090.0)
+        self.assertEqual(task_deadline('trial', 1000.0), 1180.0)
+
+    def test_deadline_passed(self):
+        self.assertTrue(deadline_passed({'deadline': time.time() - 1}))
+        self.assertFalse(deadline_passed({'deadline': time.time() + 60}))
+        # Состояние без срока (старые цепочки в очереди) не истекает
+        self.assertFalse(deadline_passed({}))
+
+
+TSV_HEADER = 'level\tpage_num\tblock_num\tpar_num\tline_num\tword_num\tleft\ttop\twidth\theight\tconf\ttext\n'
+
+
+def tsv_row(line, word, conf, text):
+    return f'5\t1\t1\t1\t{line}\t{word}\t0\t0\t10\t10\t{conf}\t{text}\n'
+
+
+@override_settings(OCR_HYBRID_MIN_CONFIDENCE=0.85, OCR_HYBRID_MIN_CHARS=5)
+class OcrBackendTests(SimpleTestCase):
+    """Выбор OCR-движка и переход гибридного режима на Vision"""
+
+    def test_parse_tesseract_tsv(self):
+        block = '4\t1\t1\t1\t1\t0\t0\t0\t10\t10\t-1\t\n'
+        output = TSV_HEADER + block + tsv_row(1, 1, 90, 'x+1') + tsv_row(1, 2, 60, '=') + tsv_row(2, 1, 80, '2')
+        text, confidence = parse_tesseract_tsv(output)
+        self.assertEqual(text, 'x+1 =\n2')
+        # Уверенность взвешена по длине слов: (90*3 + 60 + 80) / 5
+        self.assertAlmostEqual(confidence, 0.82)
+        self.assertEqual(parse_tesseract_tsv(TSV_HEADER), ('', 0.0))
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            recognize(b'', 'image/png', backend='paper')
+
+    def test_hybrid_keeps_confident_local_text(self):
+        with mock.patch('bot.ocr.extract_text_tesseract', return_value=('2 + 2 = ?', 0.9)), \
+                mock.patch('bot.ocr.extract_text_from_image') as vision:
+            self.assertEqual(extract_text_hybrid(b'', 'image/png'), ('2 + 2 = ?', 0.9))
+        vision.assert_not_called()
+
+    def test_hybrid_escalates_to_vision(self):
+        for local in (('2 + 2 = ?', 0.5), ('2+2', 0.99), OcrEngineError('нет tesseract')):
+            with mock.patch('bot.ocr.extract_text_tesseract', side_effect=[local]), \
+                    mock.patch('bot.ocr.extract_text_from_image', return_value=('2 + 2 = ?', 1.0)) as vision, \
+                    self.assertLogs('bot.ocr', 'INFO'):
+                self.assertEqual(extract_text_hybrid(b'', 'image/png'), ('2 + 2 = ?', 1.0))
+            vision.assert_called_once()
+
+    def test_hybrid_degrades_when_vision_open(self):
+        with mock.patch('bot.ocr.extract_text_tesseract', return_value=('2 + 2 = ?', 0.5)), \
+                mock.patch('bot.ocr.extract_text_from_image', side_effect=CircuitOpen('vision', 30)), \
+                self.assertLogs('bot.ocr', 'WARNING'):
+            self.assertEqual(extract_text_hybrid(b'', 'image/png'), ('2 + 2 = ?', 0.5))
+        # Без локального текста отдавать нечего: ошибка уходит в повторы этапа
+        with mock.patch('bot.ocr.extract_text_tesseract', side_effect=OcrEngineError('нет tesseract')), \
+                mock.patch('bot.ocr.extract_text_from_image', side_effect=CircuitOpen('vision', 30)), \
+                self.assertLogs('bot.ocr', 'WARNING'), self.assertRaises(CircuitOpen):
+            extract_text_hybrid(b'', 'image/png')
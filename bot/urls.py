@@ -11,6 +11,12 @@ urlpatterns = [
     # Создание задачи (для WebApp) - перемещаем в начало
     path('tasks/create/', views.TaskCreateView.as_view(), name='create-task'),
     
+    # Потоковая выдача шагов решения (SSE)
+    path('tasks/<uuid:task_id>/stream/', views.TaskStreamView.as_view(), name='task-stream'),
+    
+    # Изображение решения, рисуется при первом запросе
+    path('tasks/<uuid:task_id>/solution.png', views.TaskSolutionImageView.as_view(), name='task-solution-image'),
+    
     # Задачи пользователя по Telegram ID (перемещаем выше роутера)
     path('users/<int:telegram_id>/tasks/', views.UserTasksByTelegramIDAPIView.as_view(), name='user-tasks-by-telegram'),
     
@@ -26,6 +32,12 @@ urlpatterns = [
     # Статистика
     path('stats/', views.StatsAPIView.as_view(), name='stats'),
     
+    # Метрики производительности
+    path('metrics/', views.MetricsAPIView.as_view(), name='metrics'),
+    
+    # Состояние внешних зависимостей
+    path('health/', views.HealthAPIView.as_view(), name='health'),
+    
     # Пользователь по Telegram ID
     path('users/telegram/<int:telegram_id>/', views.UserByTelegramIDAPIView.as_view(), name='user-by-telegram'),
     
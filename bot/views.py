@@ -6,7 +6,10 @@ from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.http import Http404, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.views import View
+from django.conf import settings
 from datetime import timedelta
 import json
 import logging
@@ -16,7 +19,21 @@ from .serializers import (
     UserSerializer, SubscriptionSerializer, TaskSerializer,
     TaskCreateSerializer, UserStatsSerializer
 )
-from .tasks import process_task_image
+from .scheduling import enqueue_task, queue_wait_stats
+from .ratelimit import limiter_stats
+from .imaging import vision_stats, preprocess_stats
+from .problems import fanout_stats
+from .local_solver import local_solver_stats
+from .routing import routing_stats
+from .hedging import hedging_stats
+from .breaker import breaker_stats
+from .rendering import IMAGE_FORMATS, RenderBusy, render_stats
+from .image_cache import get_solution_image, image_cache_stats, image_key
+from .ocr import ocr_stats
+from .telegram_dispatch import PRIORITY_HIGH, enqueue_message, telegram_stats
+from .solution_cache import solution_cache_stats
+from .ocr_cache import ocr_cache_stats
+from .streaming import listen, TERMINAL_STATUSES
 
 logger = logging.getLogger(__name__)
 
@@ -178,8 +195,8 @@ class TaskCreateView(APIView):
                     user.use_trial()
                     logger.info(f"Использовано пробное решение для пользователя {user.telegram_id}. Осталось: {user.trials_left}")
                 
-                # Запускаем асинхронную обработку изображения
-                process_task_image.delay(str(task.id))
+                # Ставим обработку изображения в очередь с приоритетом по подписке
+                enqueue_task(task, has_subscription=has_subscription)
                 
                 logger.info(f"Задача с изображением создана: ID={task.id}, пользователь={user.telegram_id}")
                 
@@ -193,12 +210,12 @@ class TaskCreateView(APIView):
                 })
             
             # Для текстовых задач используем OpenAI для генерации решения
-            from .tasks import generate_solution
+            from .tasks import get_solution
             import asyncio
             
             try:
-                # Генерируем решение с помощью OpenAI
-                solution = generate_solution(data.get('description', ''))
+                # Генерируем решение (из кэша или с помощью OpenAI)
+                solution = get_solution(data.get('description', ''))
                 
                 # Обновляем задачу с решением
                 task.solution = solution
@@ -247,37 +264,20 @@ class TaskCreateView(APIView):
     def send_task_received_message(self, user, task):
         """Отправка сообщения о получении задачи"""
         try:
-            import asyncio
-            from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
-            from config import BOT_TOKEN
-            
-            async def send_message():
-                bot = Bot(token=BOT_TOKEN)
-                
-                text = f"""📝 Задача получена!
+            text = f"""📝 Задача получена!
 
 ⏳ Обрабатываем вашу задачу..."""
 
-                keyboard = [
-                    [InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu")]
-                ]
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                # Используем telegram_id как chat_id, если chat_id не установлен
-                chat_id = user.chat_id if user.chat_id else user.telegram_id
-                
-                # Отправляем сообщение
-                await bot.send_message(
-                    chat_id=chat_id,
-                    text=text,
-                    reply_markup=reply_markup
-                )
-                
-                logger.info(f"Сообщение о получении задачи отправлено пользователю {user.telegram_id} в чат {chat_id}")
+            keyboard = [
+                [InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu")]
+            ]
+            
+            # Используем telegram_id как chat_id, если chat_id не установлен
+            chat_id = user.chat_id if user.chat_id else user.telegram_id
             
-            # Запускаем асинхронную функцию
-            asyncio.run(send_message())
+            # Сообщение уходит из очереди telegram, ответ на запрос его не ждет
+            enqueue_message(chat_id, text, InlineKeyboardMarkup(keyboard))
+            logger.info(f"Сообщение о получении задачи поставлено в очередь для пользователя {user.telegram_id}")
             
         except Exception as e:
             logger.error(f"Ошибка при отправке сообщения о получении задачи: {e}")
@@ -285,43 +285,25 @@ class TaskCreateView(APIView):
     def send_task_completed_message(self, user, task):
         """Отправка сообщения о завершении задачи"""
         try:
-            import asyncio
-            from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
-            from config import BOT_TOKEN, WEBAPP_URL_DEV
+            from config import WEBAPP_URL_DEV
             
-            async def send_message():
-                bot = Bot(token=BOT_TOKEN)
-                
-                text = f"""✅ Задача решена!
+            text = f"""✅ Задача решена!
 
 📱 Посмотрите решение в мини-приложении"""
 
-                # Ссылка на WebApp с конкретной задачей
-                webapp_url = f"{WEBAPP_URL_DEV}?task_id={task.id}"
-                logger.info(f"[views.py] Создаем WebApp URL: {webapp_url}")
-                logger.info(f"[views.py] WEBAPP_URL_DEV из config: {WEBAPP_URL_DEV}")
-                
-                keyboard = [
-                    [InlineKeyboardButton("👀 Посмотреть решение", web_app=WebAppInfo(url=webapp_url))],
-                    [InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu")]
-                ]
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                # Используем telegram_id как chat_id, если chat_id не установлен
-                chat_id = user.chat_id if user.chat_id else user.telegram_id
-                
-                # Отправляем сообщение
-                await bot.send_message(
-                    chat_id=chat_id,
-                    text=text,
-                    reply_markup=reply_markup
-                )
-                
-                logger.info(f"Сообщение о завершении задачи отправлено пользователю {user.telegram_id} в чат {chat_id}")
+            # Ссылка на WebApp с конкретной задачей
+            webapp_url = f"{WEBAPP_URL_DEV}?task_id={task.id}"
             
-            # Запускаем асинхронную функцию
-            asyncio.run(send_message())
+            keyboard = [
+                [InlineKeyboardButton("👀 Посмотреть решение", web_app=WebAppInfo(url=webapp_url))],
+                [InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu")]
+            ]
+            
+            # Используем telegram_id как chat_id, если chat_id не установлен
+            chat_id = user.chat_id if user.chat_id else user.telegram_id
+            
+            enqueue_message(chat_id, text, InlineKeyboardMarkup(keyboard))
+            logger.info(f"Сообщение о завершении задачи поставлено в очередь для пользователя {user.telegram_id}")
             
         except Exception as e:
             logger.error(f"Ошибка при отправке сообщения о завершении задачи: {e}")
@@ -330,6 +312,90 @@ class TaskCreateView(APIView):
         """PUT метод для тестирования"""
         return Response({'status': 'OK', 'message': 'PUT запрос получен в TaskCreateView!'})
 
+class TaskSolutionImageView(View):
+    """Изображение решения задачи: рисуется при первом запросе и дальше отдается из дискового кэша"""
+    
+    def get(self, request, task_id):
+        task = get_object_or_404(Task, id=task_id)
+        if task.status != 'completed' or not task.solution:
+            raise Http404('Решение еще не готово')
+        variant = request.GET.get('size', 'full')
+        if variant not in settings.SOLUTION_IMAGE_VARIANTS:
+            raise Http404('Неизвестный размер изображения')
+        image_format = self.choose_format(request)
+        
+        key = image_key(task.solution)
+        etag = f'"{key}-{variant}-{image_format}"'
+        if etag in request.headers.get('If-None-Match', ''):
+            response = HttpResponseNotModified()
+        else:
+            try:
+                image = get_solution_image(task.solution, variant, image_format)
+            except RenderBusy as e:
+                logger.warning(f"Изображение решения задачи {task_id} не готово: {e}")
+                response = HttpResponse('Изображение рисуется, повторите запрос позже', status=503)
+                response['Retry-After'] = str(settings.SOLUTION_RENDER_RETRY_AFTER)
+                return response
+            response = HttpResponse(image, content_type=IMAGE_FORMATS[image_format])
+        response['ETag'] = etag
+        # Формат зависит от Accept: кэши не должны отдать WebP браузеру без его поддержки
+        patch_vary_headers(response, ['Accept'])
+        if request.GET.get('v') == key:
+            # Ссылка с версией из API неизменна: новое решение получит другую ссылку
+            response['Cache-Control'] = f'public, max-age={settings.SOLUTION_IMAGE_HTTP_MAX_AGE}, immutable'
+        else:
+            # Ссылка без версии может начать отдавать другое решение, браузер сверяет ETag
+            response['Cache-Control'] = 'no-cache'
+        return response
+    
+    def choose_format(self, request):
+        """Явный ?format=, иначе WebP для клиентов, которые его принимают (он в разы меньше PNG)"""
+        image_format = request.GET.get('format')
+        if image_format in IMAGE_FORMATS:
+            return image_format
+        return 'webp' if 'image/webp' in request.headers.get('Accept', '') else 'png'
+
+class TaskStreamView(View):
+    """SSE-поток шагов решения задачи для WebApp короткими отрезками по SSE_STREAM_TIMEOUT"""
+    
+    def get(self, request, task_id):
+        task = get_object_or_404(Task, id=task_id)
+        # Браузер сам переподключается после конца отрезка и передает номер последнего события
+        try:
+            last_seq = int(request.headers.get('Last-Event-ID', 0))
+        except ValueError:
+            last_seq = 0
+        response = StreamingHttpResponse(self.event_stream(task, last_seq), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Отключаем буферизацию в nginx, иначе шаги придут одной пачкой
+        response['X-Accel-Buffering'] = 'no'
+        return response
+    
+    def event_stream(self, task, last_seq=0):
+        """События задачи в формате Server-Sent Events"""
+        if task.status in TERMINAL_STATUSES:
+            yield self.format_event('status', {'status': task.status})
+            return
+        
+        # Соединение держит WSGI-воркер, поэтому отрезок короткий, а переподключение быстрое
+        yield f'retry: {settings.SSE_RECONNECT_DELAY}\n\n'
+        events = listen(task.id, settings.SSE_STREAM_TIMEOUT, settings.SSE_HEARTBEAT_INTERVAL, last_seq)
+        for event in events:
+            if event is None:
+                # Комментарий SSE держит соединение открытым через прокси
+                yield ': ping\n\n'
+                continue
+            yield self.format_event(event['event'], event['data'], event.get('seq'))
+    
+    def format_event(self, event, data, event_id=None):
+        """Сериализация одного события SSE"""
+        lines = []
+        if event_id is not None:
+            lines.append(f'id: {event_id}')
+        lines.append(f'event: {event}')
+        lines.append(f'data: {json.dumps(data, ensure_ascii=False)}')
+        return '\n'.join(lines) + '\n\n'
+
 class StatsAPIView(APIView):
     """API для получения статистики"""
     
@@ -354,6 +420,42 @@ class StatsAPIView(APIView):
         serializer = UserStatsSerializer(stats)
         return Response(serializer.data)
 
+class MetricsAPIView(APIView):
+    """API для получения метрик производительности"""
+    
+    def get(self, request):
+        """Получить счетчики кэшей"""
+        return Response({
+            'solution_cache': solution_cache_stats(),
+            'ocr_cache': ocr_cache_stats(),
+            'ocr': ocr_stats(),
+            'queue_wait': queue_wait_stats(),
+            'llm': limiter_stats(),
+            'preprocess': preprocess_stats(),
+            'vision': vision_stats(),
+            'fanout': fanout_stats(),
+            'local_solver': local_solver_stats(),
+            'routing': routing_stats(),
+            'hedging': hedging_stats(),
+            'render': render_stats(),
+            'solution_images': image_cache_stats(),
+            'telegram': telegram_stats(),
+        })
+
+class HealthAPIView(APIView):
+    """API состояния внешних зависимостей для мониторинга"""
+    
+    def get(self, request):
+        """Предохранители Vision, решений и Telegram и число отложенных задач"""
+        breakers = breaker_stats()
+        degraded = [name for name, breaker in breakers.items() if breaker['state'] != 'closed']
+        return Response({
+            'status': 'degraded' if degraded else 'ok',
+            'degraded': degraded,
+            'breakers': breakers,
+            'parked_tasks': Task.objects.filter(status='parked').count(),
+        })
+
 class UserByTelegramIDAPIView(APIView):
     """API для получения пользователя по Telegram ID"""
     
@@ -470,37 +572,20 @@ class YooKassaWebhookView(APIView):
     def send_success_message(self, user):
         """Отправка сообщения об успешной оплате"""
         try:
-            import asyncio
-            from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
-            from config import BOT_TOKEN
-            
-            async def send_message():
-                bot = Bot(token=BOT_TOKEN)
-                
-                text = """✅ Подписка успешно оформлена!
+            text = """✅ Подписка успешно оформлена!
 
 Теперь тебе доступен безлимит на решения задач на 30 дней."""
 
-                keyboard = [
-                    [InlineKeyboardButton("🧠 Решить задачу", callback_data="solve_task")],
-                    [InlineKeyboardButton("🔐 Подписка", callback_data="subscription")],
-                    [InlineKeyboardButton("📢 Канал", url="https://t.me/your_channel")],
-                    [InlineKeyboardButton("💬 Поддержка", url="https://t.me/your_support_bot")]
-                ]
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                # Отправляем сообщение
-                await bot.send_message(
-                    chat_id=user.chat_id,
-                    text=text,
-                    reply_markup=reply_markup
-                )
-                
-                logger.info(f"Сообщение об успешной оплате отправлено пользователю {user.telegram_id}")
+            keyboard = [
+                [InlineKeyboardButton("🧠 Решить задачу", callback_data="solve_task")],
+                [InlineKeyboardButton("🔐 Подписка", callback_data="subscription")],
+                [InlineKeyboardButton("📢 Канал", url="https://t.me/your_channel")],
+                [InlineKeyboardButton("💬 Поддержка", url="https://t.me/your_support_bot")]
+            ]
             
-            # Запускаем асинхронную функцию
-            asyncio.run(send_message())
+            # Webhook YooKassa отвечает сразу, сообщение об оплате — первым в очереди telegram
+            enqueue_message(user.chat_id, text, InlineKeyboardMarkup(keyboard), priority=PRIORITY_HIGH)
+            logger.info(f"Сообщение об успешной оплате поставлено в очередь для пользователя {user.telegram_id}")
             
         except Exception as e:
             logger.error(f"Ошибка при отправке сообщения об успешной оплате: {e}")
@@ -508,38 +593,20 @@ class YooKassaWebhookView(APIView):
     def send_error_message(self, user, payment_id):
         """Отправка сообщения об ошибке оплаты"""
         try:
-            import asyncio
-            from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
-            from config import BOT_TOKEN
-            
-            async def send_message():
-                bot = Bot(token=BOT_TOKEN)
-                
-                text = """⚠️ Сложности с оплатой.
+            text = """⚠️ Сложности с оплатой.
 
 Попробуйте ещё раз или выберите другой способ."""
 
-                # Ссылка на повторную оплату через YooKassa
-                retry_url = f"https://yoomoney.ru/checkout/payments/v2/contract?orderId={payment_id}"
-                
-                keyboard = [
-                    [InlineKeyboardButton("💳 Повторить оплату", url=retry_url)],
-                    [InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu")]
-                ]
-                
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                # Отправляем сообщение
-                await bot.send_message(
-                    chat_id=user.chat_id,
-                    text=text,
-                    reply_markup=reply_markup
-                )
-                
-                logger.info(f"Сообщение об ошибке оплаты отправлено пользователю {user.telegram_id}")
+            # Ссылка на повторную оплату через YooKassa
+            retry_url = f"https://yoomoney.ru/checkout/payments/v2/contract?orderId={payment_id}"
+            
+            keyboard = [
+                [InlineKeyboardButton("💳 Повторить оплату", url=retry_url)],
+                [InlineKeyboardButton("🔙 Назад в меню", callback_data="back_to_menu")]
+            ]
             
-            # Запускаем асинхронную функцию
-            asyncio.run(send_message())
+            enqueue_message(user.chat_id, text, InlineKeyboardMarkup(keyboard), priority=PRIORITY_HIGH)
+            logger.info(f"Сообщение об ошибке оплаты поставлено в очередь для пользователя {user.telegram_id}")
             
         except Exception as e:
             logger.error(f"Ошибка при отправке сообщения об ошибке оплаты: {e}")
@@ -11,10 +11,14 @@ if ! pgrep -x "redis-server" > /dev/null; then
     brew services start redis
 fi
 
-# Запускаем Celery worker в фоне
-echo "🔄 Запускаем Celery worker..."
-celery -A zerotask_backend worker --loglevel=info &
-CELERY_PID=$!
+# Запускаем Celery воркеры в фоне: CPU-этапы, сетевые этапы и сообщения Telegram в отдельных пулах
+echo "🔄 Запускаем Celery воркеры..."
+python manage.py run_stage_worker cpu &
+CELERY_CPU_PID=$!
+python manage.py run_stage_worker io &
+CELERY_IO_PID=$!
+python manage.py run_stage_worker telegram &
+CELERY_TELEGRAM_PID=$!
 
 # Запускаем Django сервер
 echo "🌐 Запускаем Django сервер..."
@@ -37,7 +41,7 @@ echo "   - Django API: http://localhost:8002"
 echo "   - WebApp: http://localhost:8003"
 echo "   - Admin: http://localhost:8002/admin"
 echo "   - Redis: localhost:6379"
-echo "   - Celery Worker: активен"
+echo "   - Celery Workers: cpu, io, telegram"
 echo "   - Telegram Bot: активен"
 
 echo ""
@@ -47,7 +51,7 @@ echo "🛑 Для остановки всех сервисов нажмите Ct
 cleanup() {
     echo ""
     echo "🛑 Останавливаем сервисы..."
-    kill $CELERY_PID $DJANGO_PID $WEBAPP_PID $BOT_PID 2>/dev/null
+    kill $CELERY_CPU_PID $CELERY_IO_PID $CELERY_TELEGRAM_PID $DJANGO_PID $WEBAPP_PID $BOT_PID 2>/dev/null
     echo "✅ Все сервисы остановлены"
     exit 0
 }
@@ -17,7 +17,7 @@ django.setup()
 # Импорты Django моделей
 from bot.models import User, Subscription, Task
 from bot.serializers import UserSerializer, TaskSerializer
-from openai import OpenAI
+from bot.scheduling import enqueue_task
 
 # Настройка логирования
 logging.basicConfig(
@@ -28,9 +28,6 @@ logger = logging.getLogger(__name__)
 
 from config import *
 
-# Инициализация OpenAI
-client = OpenAI(api_key=OPENAI_API_KEY)
-
 # Константы для подписки
 SUBSCRIPTION_PRICE = 290
 SUBSCRIPTION_DAYS = 30
@@ -390,9 +387,8 @@ class MyGDZBot:
                 ])
             )
             
-            # Запускаем обработку задачи в Celery
-            from bot.tasks import process_task_text
-            process_task_text.delay(str(task.id))
+            # Ставим задачу в очередь Celery с приоритетом по подписке
+            await sync_to_async(enqueue_task)(task, has_subscription=has_subscription)
             
             # Уменьшаем количество пробных попыток, если нет подписки
             if not has_subscription and trials_left > 0:
@@ -471,9 +467,8 @@ class MyGDZBot:
             
 
             
-            # Запускаем обработку задачи в Celery
-            from bot.tasks import process_task_image
-            process_task_image.delay(str(task.id))
+            # Ставим задачу в очередь Celery с приоритетом по подписке
+            await sync_to_async(enqueue_task)(task, has_subscription=has_subscription)
             
             # Уменьшаем количество пробных попыток, если нет подписки
             if not has_subscription and trials_left > 0:
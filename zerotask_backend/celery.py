@@ -1,5 +1,6 @@
 import os
 from celery import Celery
+from celery.signals import worker_process_init
 
 # Устанавливаем переменную окружения для настроек Django
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'zerotask_backend.settings')
@@ -13,6 +14,12 @@ app.config_from_object('django.conf:settings', namespace='CELERY')
 # Автоматически обнаруживаем задачи в приложениях Django
 app.autodiscover_tasks()
 
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """Свой клиент OpenAI для каждого дочернего процесса воркера"""
+    from bot.llm import init_client
+    init_client()
+
 @app.task(bind=True)
 def debug_task(self):
     print(f'Request: {self.request!r}')
@@ -147,12 +147,332 @@ CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
 
 # Celery task settings
+# CPU-этапы (OpenCV) идут в очередь cpu, сетевые (OCR, LLM) — в io, исходящие сообщения — в telegram
 CELERY_TASK_ROUTES = {
-    'bot.tasks.*': {'queue': 'default'},
+    'bot.tasks.preprocess_stage': {'queue': 'cpu'},
+    'bot.tasks.send_telegram_message': {'queue': 'telegram'},
+    'bot.tasks.*': {'queue': 'io'},
 }
 
 CELERY_TASK_DEFAULT_QUEUE = 'default'
 
+# Приоритеты в Redis: 0 — наивысший. Без prefetch воркер не забирает задачи впрок
+# и следующей всегда берет задачу с наивысшим приоритетом
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'queue_order_strategy': 'priority',
+    'priority_steps': list(range(10)),
+    'sep': ':',
+}
+CELERY_TASK_DEFAULT_PRIORITY = 5
+
+# Полосы приоритета: подписчики всегда впереди пробных пользователей.
+# weight — сколько незавершенных задач пользователя идут с базовым приоритетом полосы,
+# каждые следующие weight задач получают приоритет на шаг ниже (честность между пользователями)
+TASK_PRIORITY_LANES = {
+    'subscriber': {'base_priority': 0, 'lowest_priority': 4, 'weight': 3},
+    'trial': {'base_priority': 5, 'lowest_priority': 9, 'weight': 1},
+}
+
+# Срок обработки задачи от постановки в очередь по полосам, секунд. После него сетевые этапы
+# отвечают только из кэша или локальным решателем, иначе задача откладывается (статус parked)
+# и продолжается, когда OpenAI снова доступен
+TASK_DEADLINES = {'subscriber': 90, 'trial': 180}
+PARKED_RESUME_INTERVAL = 60  # секунд между проверками отложенной задачи
+PARKED_MAX_AGE = 60 * 60  # позже отложенная задача завершается с ошибкой
+TASK_STALE_AFTER = 15 * 60  # секунд в статусе этапа, после которых задачу можно возобновить из админки
+
+# Пулы воркеров по очередям (python manage.py run_stage_worker <очередь>):
+# CPU-очередь — prefork по числу ядер, сетевая — потоки с высокой конкурентностью
+CELERY_STAGE_WORKERS = {
+    'cpu': {
+        'pool': 'prefork',
+        'concurrency': int(os.environ.get('CELERY_CPU_CONCURRENCY', os.cpu_count() or 1)),
+        'prefetch_multiplier': 1,
+        'queues': ['cpu'],
+        # Процесс пула перезапускается после задачи, если его RSS превысил лимит (КБ)
+        'max_memory_per_child': int(os.environ.get('CELERY_CPU_MAX_MEMORY_KB', 1024 * 1024)),
+    },
+    'io': {
+        'pool': 'threads',  # или 'gevent', если установлен gevent
+        'concurrency': int(os.environ.get('CELERY_IO_CONCURRENCY', 50)),
+        'prefetch_multiplier': 1,
+        'queues': ['io', 'default'],
+    },
+    # Расписание лимитов Bot API хранится в общем кэше: потоков и воркеров telegram может быть несколько
+    'telegram': {
+        'pool': 'threads',
+        'concurrency': 8,
+        'prefetch_multiplier': 1,
+        'queues': ['telegram'],
+    },
+}
+
+# Кэш: Redis в продакшене, пустой CACHE_REDIS_URL — локальная замена в памяти процесса.
+# Для Redis под кэш рекомендуется maxmemory-policy volatile-lru: вытесняются только ключи с TTL.
+CACHE_REDIS_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/1')
+
+# Кэш готовых решений по нормализованному тексту задачи
+SOLUTION_CACHE_ENABLED = True
+SOLUTION_CACHE_TTL = 60 * 60 * 24 * 30  # 30 дней
+SOLUTION_CACHE_MAX_ENTRIES = 10000
+# Меняйте версию при изменении промпта, модели или локального решателя, чтобы не отдавать старые решения
+SOLUTION_CACHE_VERSION = 4
+
+# Кэш результатов OCR по перцептивному хэшу обработанного изображения
+OCR_CACHE_ENABLED = True
+# Максимальное расстояние Хэмминга между pHash (до 3 поиск полный, 0 — только тот же хэш).
+# Пересжатое или сдвинутое на несколько пикселей фото дает 0-2 бита, другая страница той же верстки — от 14
+OCR_CACHE_MAX_DISTANCE = 3
+# Совпадение подтверждается размерами обработанного изображения и dHash с этим порогом
+# (у того же фото 0-1 бит, у другой страницы той же верстки — от 12)
+OCR_CACHE_MAX_VERIFY_DISTANCE = 4
+# Записи, не использованные дольше TTL, и самые старые сверх MAX_ENTRIES удаляются
+# (проверка на каждой OCR_CACHE_PRUNE_EVERY-й новой записи)
+OCR_CACHE_TTL = 60 * 60 * 24 * 30  # 30 дней
+OCR_CACHE_MAX_ENTRIES = 50000
+OCR_CACHE_PRUNE_EVERY = 100
+
+# Потоковая выдача шагов решения в WebApp через Server-Sent Events
+SOLUTION_STREAMING_ENABLED = True
+# Секунд на один отрезок SSE-соединения: он занимает WSGI-воркер, дальше браузер переподключается
+# с Last-Event-ID и получает только новые события
+SSE_STREAM_TIMEOUT = 25
+SSE_HEARTBEAT_INTERVAL = 10
+SSE_RECONNECT_DELAY = 1000  # мс до переподключения после конца отрезка
+
+# OCR-движок: 'vision' (OpenAI), 'tesseract' (локально, CPU) или 'hybrid' —
+# Tesseract для четкого печатного текста, Vision при низкой уверенности
+OCR_BACKEND = os.environ.get('OCR_BACKEND', 'vision')
+OCR_TESSERACT_CMD = 'tesseract'
+OCR_TESSERACT_LANG = 'rus+eng'
+OCR_TESSERACT_TIMEOUT = 20  # секунд
+OCR_HYBRID_MIN_CONFIDENCE = 0.85
+OCR_HYBRID_MIN_CHARS = 5
+
+# Фото задач: 'separate' — OCR и решение двумя запросами (кэши, локальный решатель и параллельное решение
+# нескольких задач работают как обычно), 'combined' — текст и решение одним запросом Vision в JSON
+# (минус один сетевой запрос и одна очередь; OCR_BACKEND в этом режиме не используется)
+IMAGE_SOLVE_MODE = os.environ.get('IMAGE_SOLVE_MODE', 'separate')
+# Запрос совмещенного режима: ответ длиннее обычного решения на распознанный текст в JSON
+IMAGE_SOLVE_MODEL = 'gpt-4o'
+IMAGE_SOLVE_MAX_TOKENS = 2500
+IMAGE_SOLVE_TIMEOUT = 60  # секунд
+
+# Несколько пронумерованных задач в одном условии решаются параллельно (Celery chord)
+PROBLEM_FANOUT_ENABLED = True
+PROBLEM_FANOUT_MAX = 8  # больше подзадач — соседние задачи решаются вместе
+
+# Арифметика, линейные и квадратные уравнения решаются локально (SymPy) без вызова LLM
+LOCAL_SOLVER_ENABLED = True
+
+# Маршрутизация решений по сложности задачи: длина, число операций, тема и класс дают оценку,
+# задача уходит по первому маршруту с max_score не ниже оценки (последний маршрут — без порога).
+# max_tokens = min_tokens + длина условия × LLM_ROUTING_TOKENS_PER_CHAR, но не больше max_tokens маршрута
+LLM_ROUTING_ENABLED = True
+LLM_ROUTES = {
+    'light': {'model': 'gpt-4o-mini', 'max_score': 1, 'min_tokens': 400, 'max_tokens': 800},
+    'standard': {'model': 'gpt-4o', 'max_score': 4, 'min_tokens': 700, 'max_tokens': 1500},
+    'heavy': {'model': 'gpt-4', 'max_score': None, 'min_tokens': 1000, 'max_tokens': 2500},
+}
+LLM_DEFAULT_ROUTE = 'heavy'  # при выключенной маршрутизации
+LLM_ROUTING_CHARS_PER_POINT = 150
+LLM_ROUTING_OPERATORS_PER_POINT = 6
+LLM_ROUTING_TOKENS_PER_CHAR = 3
+
+# Хеджирование запросов решения: если первый токен не пришел за скользящий p90 задержки,
+# отправляется второй запрос (можно к другой модели), побеждает первый ответивший, второй отменяется.
+# Доля хеджей ограничена: каждый запрос добавляет LLM_HEDGE_MAX_RATIO в бюджет, хедж тратит 1.
+# Пока замеров меньше LLM_HEDGE_MIN_SAMPLES, хеджа нет. bench_llm --scenario hedge (первый токен 50 мс,
+# медленные 1 с): 2% медленных — p99 1015 -> 560 мс, 5% — p95 1007 -> 560 мс; 10% — p90 попадает на
+# медленные ответы, хедж опаздывает и только удваивает запросы (p95 1009 -> 1016 мс). Включать, только
+# если доля медленных ответов в продакшене заметно ниже 1 - LLM_HEDGE_PERCENTILE
+LLM_HEDGING_ENABLED = False
+LLM_HEDGE_MODEL = ''  # пусто — та же модель, что у основного запроса
+LLM_HEDGE_MAX_RATIO = 0.1
+LLM_HEDGE_BURST = 5  # хеджей подряд после затишья
+LLM_HEDGE_PERCENTILE = 0.9
+LLM_HEDGE_WINDOW = 200  # последних замеров первого токена на модель
+LLM_HEDGE_MIN_SAMPLES = 20
+LLM_HEDGE_MIN_DELAY = 0.5
+
+# Предохранители внешних сервисов ('vision', 'completion', 'telegram'), общие для кластера:
+# после BREAKER_FAILURE_THRESHOLD сбоев подряд запросы сразу отклоняются, через
+# BREAKER_RESET_TIMEOUT пропускается один пробный запрос (BREAKER_PROBE_TIMEOUT — его предельное время)
+BREAKER_ENABLED = True
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_TIMEOUT = 30
+BREAKER_PROBE_TIMEOUT = 90
+
+# Исходящие сообщения Telegram: очередь telegram, воркер run_stage_worker telegram с общим пулом
+# соединений и лимиты по GCRA в кэше LLM_RATE_LIMIT_CACHE, общие для всех воркеров. Bot API разрешает ~30 сообщений/с на бота, в личный чат — около
+# одного в секунду, в группу или канал — 20 в минуту; ответ 429 повторяется через retry_after
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org')
+TELEGRAM_TIMEOUT = 10  # секунд на запрос к Bot API
+TELEGRAM_POOL_MAX_CONNECTIONS = 8
+TELEGRAM_GLOBAL_RATE = 25  # сообщений в секунду, с запасом до лимита
+TELEGRAM_GLOBAL_BURST = 25
+TELEGRAM_CHAT_INTERVAL = 1.0  # секунд между сообщениями в личный чат
+TELEGRAM_GROUP_INTERVAL = 3.0  # в группу или канал
+TELEGRAM_MAX_INLINE_WAIT = 1.0  # дольше — сообщение возвращается в очередь с задержкой
+TELEGRAM_MAX_ATTEMPTS = 5
+TELEGRAM_RETRY_BACKOFF = 2  # секунд, удваивается с каждой попыткой
+TELEGRAM_MESSAGE_TTL = 15 * 60  # более старые сообщения не отправляются
+
+# Изображение решения: ширина фиксирована, высота по тексту, строки переносятся.
+# Шрифты ищутся по порядку (имя в системных каталогах шрифтов или путь), нужен шрифт с кириллицей
+SOLUTION_IMAGE_FONTS = {
+    'regular': ['DejaVuSans.ttf', 'LiberationSans-Regular.ttf', 'Arial.ttf', 'arial.ttf'],
+    'bold': ['DejaVuSans-Bold.ttf', 'LiberationSans-Bold.ttf', 'Arial Bold.ttf', 'arialbd.ttf'],
+}
+# Варианты: полный для WebApp на компьютере и уменьшенный для телефонов (?size=mobile).
+# max_bytes — бюджет на файл: палитра сокращается по SOLUTION_IMAGE_PALETTE_STEPS, пока файл не уложится
+SOLUTION_IMAGE_VARIANTS = {
+    'full': {'width': 900, 'font_size': 26, 'padding': 32, 'max_bytes': 200 * 1024},
+    'mobile': {'width': 540, 'font_size': 20, 'padding': 20, 'max_bytes': 100 * 1024},
+}
+SOLUTION_IMAGE_LINE_SPACING = 1.4
+SOLUTION_IMAGE_MAX_HEIGHT = 8000  # длиннее — обрезается
+SOLUTION_IMAGE_TEXT_COLOR = '#1f1f1f'  # если оба цвета серые, изображение рисуется в оттенках серого
+SOLUTION_IMAGE_LABEL_COLOR = '#1a4f8b'
+# Цветов в палитре: текст на белом — в основном оттенки сглаживания, 16 цветов на глаз не отличить от RGB
+SOLUTION_IMAGE_PALETTE_STEPS = [16, 8, 4]
+SOLUTION_IMAGE_PNG_COMPRESS_LEVEL = 6  # 0-9: выше — меньше файл, но дольше кодирование
+SOLUTION_IMAGE_WEBP_METHOD = 4  # 0-6: выше — меньше файл, но дольше кодирование
+# Процессов пула рендеринга в веб-процессе; 0 — рисовать в самом процессе (в prefork-воркерах Celery всегда так).
+# bench_render на 1 CPU: в процессе 6.1 мс короткое / 48.9 мс среднее решение, пул из 2 — 16.7 / 106.4 мс
+# (передача решения и PNG между процессами дороже самой отрисовки). Включать, только если bench_render
+# на целевой машине показывает выигрыш
+SOLUTION_RENDER_WORKERS = 0
+SOLUTION_RENDER_TIMEOUT = 30  # пул не успел — 503 с Retry-After, а не отрисовка еще и в веб-потоке
+SOLUTION_RENDER_RETRY_AFTER = 10
+# Изображение решения рисуется при первом запросе (/api/tasks/<id>/solution.png) и хранится в дисковом
+# кэше; сверх лимита удаляются давно не запрошенные файлы (LRU по времени последнего запроса)
+SOLUTION_IMAGE_CACHE_DIR = os.environ.get('SOLUTION_IMAGE_CACHE_DIR', os.path.join(BASE_DIR, '.cache', 'solution_images'))
+SOLUTION_IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Вытеснение обходит весь каталог, поэтому запускается раз в столько промахов на процесс:
+# между проходами кэш может превысить лимит на столько же файлов (до ~200 КБ каждый)
+SOLUTION_IMAGE_EVICT_EVERY = 50
+SOLUTION_IMAGE_HTTP_MAX_AGE = 60 * 60 * 24 * 365  # ссылка с версией решения не меняется
+# Меняйте версию при изменении оформления, чтобы не отдавать старые изображения
+SOLUTION_IMAGE_VERSION = 1
+
+# Общий клиент OpenAI на процесс (пул keep-alive соединений)
+LLM_BASE_URL = os.environ.get('LLM_BASE_URL', '')  # пусто — api.openai.com
+LLM_POOL_MAX_CONNECTIONS = 20
+LLM_POOL_MAX_KEEPALIVE = 10
+LLM_POOL_KEEPALIVE_EXPIRY = 120  # секунд
+LLM_TIMEOUT = 60
+LLM_CONNECT_TIMEOUT = 10
+
+# Кластерный лимит запросов к OpenAI: token bucket в общем кэше для всех воркеров
+# Лимит общий только для процессов с общим кэшем ratelimit: при воркерах на нескольких машинах нужен Redis
+# (файловый кэш разработки делит лимит лишь между процессами одной машины). Если блокировка
+# состояния не освободилась за ratelimit.LOCK_TTL, запрос получает RateLimitExceeded, а не идет без лимита
+LLM_RATE_LIMIT_ENABLED = True
+LLM_RATE_LIMIT_CACHE = 'ratelimit'
+LLM_RATE_LIMIT_RPM = 500
+LLM_RATE_LIMIT_TPM = 80000
+LLM_RATE_LIMIT_MAX_WAIT = 20  # секунд ожидания в очереди лимитера, дальше — ошибка
+LLM_RATE_LIMIT_RETRIES = 3
+LLM_IMAGE_TOKEN_ESTIMATE = 1100
+# AIMD-конкурентность: рост на 1 за окно успешных запросов, снижение при 429 и росте задержки
+LLM_CONCURRENCY_INITIAL = 16
+LLM_CONCURRENCY_MIN = 2
+LLM_CONCURRENCY_MAX = 64
+LLM_CONCURRENCY_DECREASE = 0.5
+LLM_CONCURRENCY_LATENCY_DECREASE = 0.9
+LLM_LATENCY_TARGET = 20  # секунд
+
+# Подготовка изображения для Vision: уменьшение до читаемой высоты символов и сжатие
+VISION_IMAGE_FORMAT = 'jpeg'  # 'jpeg' или 'webp'
+VISION_IMAGE_QUALITY = 80
+VISION_MIN_QUALITY = 40
+VISION_MAX_BYTES = 500_000
+VISION_TARGET_TEXT_HEIGHT = 24  # пикселей на строчный символ
+VISION_MIN_LONG_SIDE = 768
+VISION_MAX_LONG_SIDE = 2048
+
+# Бюджет памяти на задачу: больше стольких пикселей не декодируем (JPEG уменьшается при декодировании)
+PREPROCESS_MAX_PIXELS = 16_000_000
+# Изображения с таким числом пикселей в заголовке отклоняются сразу с просьбой переснять
+PREPROCESS_MAX_SOURCE_PIXELS = 200_000_000
+# PNG, WebP и другие не-JPEG декодируются целиком и только потом уменьшаются, поэтому предел ниже
+PREPROCESS_MAX_FULL_DECODE_PIXELS = 50_000_000
+# Проверка качества фото до OCR: нечитаемые фото сразу отклоняются с просьбой переснять
+IMAGE_QUALITY_GATE_ENABLED = True
+IMAGE_MIN_SHARPNESS = 15  # дисперсия лапласиана на копии 1000 px
+IMAGE_MIN_BRIGHTNESS = 60  # яркость фона, 0-255
+IMAGE_MIN_CONTRAST = 40  # размах яркости от текста до фона
+IMAGE_MIN_TEXT_DENSITY = 0.003  # доля пикселей текста
+# Разметка страницы: поиск листа, перспектива, выравнивание наклона и обрезка полей вокруг текста
+PREPROCESS_LAYOUT_ENABLED = True
+PREPROCESS_MAX_SKEW = 15  # градусов; больший наклон считаем не наклоном, а особенностью макета
+PREPROCESS_CROP_MAX_AREA = 0.6  # вырезаем, только если текст занимает меньше этой доли страницы
+# 'union' — все блоки текста страницы (несколько задач не теряются);
+# 'center' — только блок у центра кадра, если пользователи фотографируют одно упражнение со страницы
+PREPROCESS_CROP_MODE = 'union'
+PREPROCESS_PAGE_MAX_TEXT_HEIGHT = 0.025  # снимок целой страницы: символы ниже этой доли высоты кадра
+# Профиль предобработки перед OCR: none, fast (CLAHE + медианный фильтр, десятки мс),
+# quality (CLAHE + NLM, около 2 с CPU на фото 12 Мп — для сравнения в bench_preprocess, не для потока задач)
+PREPROCESS_PROFILE = 'fast'
+# Предобработка идет в памяти; сохранять результат на диск (для отладки и возобновления) — по желанию.
+# Вырезанная задача тоже живет только в кэше images: после вытеснения OCR заново вырезает ее из фото
+PREPROCESS_PERSIST_INTERMEDIATES = False
+# Обработанное изображение передается этапу OCR через кэш images: в состоянии цепочки только ключ
+PREPROCESS_IMAGE_TTL = 60 * 60
+
+if CACHE_REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_REDIS_URL,
+        },
+        'solutions': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_REDIS_URL,
+            'TIMEOUT': SOLUTION_CACHE_TTL,
+            'KEY_PREFIX': 'zerotask',
+        },
+        'ratelimit': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_REDIS_URL,
+        },
+        'images': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_REDIS_URL,
+            'TIMEOUT': PREPROCESS_IMAGE_TTL,
+            'KEY_PREFIX': 'zerotask',
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'zerotask-default',
+        },
+        'solutions': {
+            # LocMemCache вытесняет давно не читанные записи при превышении MAX_ENTRIES (LRU)
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'zerotask-solutions',
+            'TIMEOUT': SOLUTION_CACHE_TTL,
+            'OPTIONS': {
+                'MAX_ENTRIES': SOLUTION_CACHE_MAX_ENTRIES,
+                'CULL_FREQUENCY': 10,
+            },
+        },
+        'ratelimit': {
+            # Файловый кэш делит лимит между локальными процессами воркеров
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(BASE_DIR, '.cache', 'ratelimit'),
+        },
+        'images': {
+            # Этапы cpu и io — разные процессы, поэтому кэш файловый, а не в памяти
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(BASE_DIR, '.cache', 'images'),
+            'TIMEOUT': PREPROCESS_IMAGE_TTL,
+        },
+    }
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 